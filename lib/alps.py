@@ -21,4 +21,14 @@ def uenv_repo_path(path: str=None) -> str:
 
     terminal.error("No repository path available: set UENV_REPO_PATH or use the --repo flag")
 
-
+# the paths of read-only repositories shared by all users, e.g. a site-wide
+# image store, that are searched before the repository of the user
+def uenv_site_repo_paths() -> list:
+    paths = os.environ.get("UENV_SITE_REPO_PATH", "")
+    return [p for p in paths.split(":") if p]
+
+# the paths of the repositories of other users or projects on the same file
+# system, from which images are linked instead of downloaded
+def uenv_peer_repo_paths() -> list:
+    paths = os.environ.get("UENV_PEER_REPO_PATH", "")
+    return [p for p in paths.split(":") if p]
@@ -0,0 +1,227 @@
+import json
+import os
+import time
+
+import datastore
+from datastore import DataStore
+import jfrog
+import lock
+import terminal
+
+# The JFrog catalog is mirrored on disk next to the index.db of the local
+# repository, with one database for each namespace:
+#
+#   $repo/catalog/meta.json   for each namespace, the time of the last sync, the
+#                             ETag/Last-Modified validators, and the high water
+#                             mark of the dates of the entries in the mirror
+#   $repo/catalog/deploy.db   the deploy namespace
+#   $repo/catalog/build.db    the build namespace
+#
+# The mirrored databases are used directly while they are younger than the TTL.
+# Once the TTL has expired the listing is revalidated with a conditional request,
+# so that the catalog is only downloaded when it has changed. When it has changed,
+# every entry is compared with the mirror, and only the entries that were added,
+# changed or removed are applied to it.
+# Each namespace is only loaded when it is requested. The mirrors have a search
+# index, so that uenv image find can look up patterns and text without reading
+# the whole catalog.
+#
+#   $repo/catalog/sync.lock   held while a namespace is synced, so that meta.json
+#                             and the mirrors are updated by one process at a time
+
+# the default time to live of the cache in seconds
+default_ttl = 300
+
+# the number of seconds that a sync waits for another process to finish syncing
+sync_timeout = datastore.writer_timeout
+
+namespaces = ["deploy", "build"]
+
+class CatalogError(Exception):
+    """Exception raised when the catalog can't be read from the cache or downloaded."""
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return self.message
+
+def catalog_ttl() -> float:
+    """
+    The time to live of the catalog cache in seconds.
+    Set with the UENV_CATALOG_TTL environment variable.
+    """
+    ttl = os.environ.get("UENV_CATALOG_TTL")
+    if ttl is None:
+        return default_ttl
+    try:
+        return float(ttl)
+    except ValueError:
+        terminal.warning(f"ignoring invalid UENV_CATALOG_TTL={ttl}: using the default {default_ttl} seconds")
+        return default_ttl
+
+class CatalogCache():
+    def __init__(self, repo_path: str, ttl: float=None, url: str=jfrog.listing_url, mirror_url: str=None):
+        self._path = repo_path + "/catalog"
+        self._meta_path = self._path + "/meta.json"
+        self._ttl = catalog_ttl() if ttl is None else ttl
+        self._url = url
+        self._mirror_url = jfrog.listing_mirror_url() if mirror_url is None else mirror_url
+
+    @property
+    def path(self):
+        return self._path
+
+    def db_path(self, namespace: str) -> str:
+        return f"{self._path}/{namespace}.db"
+
+    def is_cached(self, namespace: str) -> bool:
+        if not (os.path.isfile(self.db_path(namespace)) and namespace in self.read_meta()):
+            return False
+        # mirrors with an older schema are downloaded again, instead of being upgraded
+        try:
+            database = DataStore(self.db_path(namespace), readonly=True)
+        except (datastore.RepoNotFoundError, datastore.RepoDBError) as err:
+            terminal.info(f"unable to open the cached {namespace} catalog: {str(err)}")
+            return False
+        version = database.version
+        database.close()
+        return version == datastore.db_version
+
+    def read_meta(self) -> dict:
+        try:
+            with open(self._meta_path, "r") as fid:
+                return json.load(fid)
+        except Exception as err:
+            terminal.info(f"unable to read catalog meta data {self._meta_path}: {str(err)}")
+            return {}
+
+    def write_meta(self, namespace: str, meta: dict):
+        """update the meta data of namespace: only call this while the sync lock is held"""
+        all_meta = self.read_meta()
+        all_meta[namespace] = meta
+        tmp_path = f"{self._meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fid:
+            json.dump(all_meta, fid)
+        os.replace(tmp_path, self._meta_path)
+
+    def age(self, namespace: str) -> float:
+        """seconds since the cached namespace was downloaded or revalidated"""
+        return time.time() - self.read_meta().get(namespace, {}).get("fetched", 0)
+
+    def open(self, namespace: str) -> DataStore:
+        """return the cached database of namespace"""
+        database = DataStore(self.db_path(namespace))
+        # mirrors written by older versions of uenv are indexed the first time they are used
+        database.create_search_index()
+        return database
+
+    def load(self, namespace: str, refresh: bool=False, offline: bool=False) -> DataStore:
+        """
+        Return the database of namespace, syncing the mirror only if required.
+
+        refresh: ignore the TTL, and sync the mirror with the full catalog.
+        offline: use the mirror, whatever its age, without contacting the middleware.
+        """
+        if namespace not in namespaces:
+            raise CatalogError(f"namespace must be one of {', '.join(namespaces)}")
+
+        cached = self.is_cached(namespace)
+
+        if offline:
+            if not cached:
+                raise CatalogError(f"no cached {namespace} catalog is available in {self._path} - run without --offline to download it.")
+            terminal.info(f"using cached {namespace} catalog in {self._path} (offline)")
+            return self.open(namespace)
+
+        if not refresh and cached:
+            age = self.age(namespace)
+            if age < self._ttl:
+                terminal.info(f"using cached {namespace} catalog in {self._path} ({age:.0f}s old, ttl {self._ttl:.0f}s)")
+                return self.open(namespace)
+
+        try:
+            self.sync(namespace, refresh=refresh)
+        except CatalogError as err:
+            if not cached:
+                raise
+            terminal.warning(f"{str(err)}")
+            terminal.warning(f"using the cached {namespace} catalog, which was last updated {self.age(namespace)/60:.0f} minutes ago")
+
+        return self.open(namespace)
+
+    def sync(self, namespace: str, refresh: bool=False) -> dict:
+        """
+        Update the mirror of namespace with the changes in the remote catalog.
+
+        refresh: download the catalog unconditionally, even if the validators
+                 of the last sync show that it has not been modified.
+
+        Returns the number of records that were added, changed, removed and
+        unchanged, or None if the catalog has not been modified since the last sync.
+        """
+        if namespace not in namespaces:
+            raise CatalogError(f"namespace must be one of {', '.join(namespaces)}")
+
+        sync_lock = lock.FileLock(self._path + "/sync.lock")
+        if not sync_lock.acquire(sync_timeout):
+            raise CatalogError(f"timed out waiting for another process to update the catalog in {self._path}")
+        try:
+            return self._sync(namespace, refresh)
+        finally:
+            sync_lock.release()
+
+    def _sync(self, namespace: str, refresh: bool) -> dict:
+        # the mirror and meta data are read after the lock is acquired, so that
+        # the changes of a sync that finished while waiting are seen
+        cached = self.is_cached(namespace)
+        meta = self.read_meta().get(namespace, {}) if cached else {}
+
+        try:
+            if refresh:
+                chunks, validators = jfrog.fetch_listing(self._url, mirror_url=self._mirror_url)
+            else:
+                chunks, validators = jfrog.fetch_listing(self._url, meta.get("etag"), meta.get("last_modified"),
+                                                         self._mirror_url)
+
+            if chunks is None:
+                terminal.info(f"cached {namespace} catalog in {self._path} is up to date")
+                counts = None
+            elif cached:
+                since = None if refresh else meta.get("high_water_mark")
+                terminal.info(f"applying changes to {self.db_path(namespace)}, last synced up to {since}")
+                database = self.open(namespace)
+                counts = jfrog.sync_namespace(chunks, namespace, database, since)
+                meta["high_water_mark"] = database.latest_date
+                database.close()
+            else:
+                database = jfrog.load_namespace(chunks, namespace)
+                # the index is maintained when the mirror is synced
+                database.create_search_index()
+                self.store(namespace, database)
+                counts = {"added": database.images.count, "changed": 0, "removed": 0, "unchanged": 0}
+                meta["high_water_mark"] = database.latest_date
+                database.close()
+        except (RuntimeError, datastore.RepoDBError) as err:
+            raise CatalogError(str(err))
+
+        terminal.info(f"synced {namespace} catalog: {counts}")
+
+        meta["etag"] = validators["etag"] or meta.get("etag")
+        meta["last_modified"] = validators["last_modified"] or meta.get("last_modified")
+        meta["fetched"] = time.time()
+        self.write_meta(namespace, meta)
+
+        return counts
+
+    def store(self, namespace: str, database: DataStore):
+        """create the mirror of namespace from a database"""
+        os.makedirs(self._path, exist_ok=True)
+        path = self.db_path(namespace)
+        terminal.info(f"writing cached catalog {path}")
+        # write to a temporary file that is moved into place, so that other processes
+        # never read a partially written database
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        database.save(tmp_path)
+        os.replace(tmp_path, path)
@@ -1,14 +1,26 @@
+import contextlib
+import fcntl
 import json
+import operator
 import os
+import pathlib
+import random
 import shutil
 import sqlite3
+import time
+from datetime import datetime, timezone
 
 from record import Record
+import lock
 import terminal
 import names
 
 UENV_CLI_API_VERSION=1
 
+# staging directories that have not been modified for this many seconds are
+# removed from the repository
+staging_ttl = 24*3600
+
 class RepoNotFoundError(Exception):
     """Exception raised when unable to open a FileSystem repository."""
 
@@ -136,108 +148,410 @@ FROM tags
     INNER JOIN uenv   ON uenv.version_id = tags.version_id
     INNER JOIN images ON images.sha256   = tags.sha256;
 
+PRAGMA user_version = 2;
+
+COMMIT;
+""",
+        3: """
+BEGIN;
+
+PRAGMA foreign_keys=on;
+
+CREATE TABLE images (
+    sha256 TEXT PRIMARY KEY CHECK(length(sha256)==64),
+    id TEXT UNIQUE CHECK(length(id)==16),
+    date TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+
+CREATE TABLE uenv (
+    version_id INTEGER PRIMARY KEY,
+    system TEXT NOT NULL,
+    uarch TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    -- the same definition as the column added by the migration from v2
+    version_key TEXT NOT NULL DEFAULT '',
+    UNIQUE (system, uarch, name, version)
+);
+
+CREATE TABLE tags (
+    version_id INTEGER,
+    tag TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (version_id, tag),
+    FOREIGN KEY (version_id)
+        REFERENCES uenv (version_id)
+            ON DELETE CASCADE
+            ON UPDATE CASCADE,
+    FOREIGN KEY (sha256)
+        REFERENCES images (sha256)
+            ON DELETE CASCADE
+            ON UPDATE CASCADE
+);
+
+-- for convenient generation of the Record type used internally by uenv-image
+CREATE VIEW records AS
+SELECT
+    uenv.system  AS system,
+    uenv.uarch   AS uarch,
+    uenv.name      AS name,
+    uenv.version   AS version,
+    tags.tag       AS tag,
+    images.date    AS date,
+    images.size    AS size,
+    tags.sha256    AS sha256,
+    images.id      AS id,
+    uenv.version_key AS version_key
+FROM tags
+    INNER JOIN uenv   ON uenv.version_id = tags.version_id
+    INNER JOIN images ON images.sha256   = tags.sha256;
+
+PRAGMA user_version = 3;
+
 COMMIT;
 """}
 
 # the version schema is an integer, bumped every time it is modified
-db_version = 2
+db_version = 3
 create_db_command = create_db_commands[db_version]
 
+def schema_statements(version: int) -> list:
+    """the statements of create_db_commands[version], without the enclosing transaction"""
+    statements = []
+    statement = ""
+    for line in create_db_commands[version].splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statement = statement.strip()
+            if statement not in ["BEGIN;", "COMMIT;"]:
+                statements.append(statement)
+            statement = ""
+    return statements
+
+# The migrations that upgrade a database in place from each schema version to
+# the next, so that a database is upgraded to db_version by applying them in
+# turn, e.g. v1 -> v2 -> v3. Each is a list of statements that copy the data
+# with set-based INSERT ... SELECT, which are run in a single transaction with
+# those of the other migrations. When the schema is modified, add the migration
+# from the previous version here.
+migrations = {
+    # v1 records the system and uarch of each image, v2 of each uenv
+    1: [
+        "DROP VIEW records",
+        "ALTER TABLE images RENAME TO v1_images",
+        "ALTER TABLE uenv RENAME TO v1_uenv",
+        "ALTER TABLE tags RENAME TO v1_tags",
+        # the records are joined once, and the rowid of each tag preserves their order
+        "CREATE TEMP TABLE v1_records AS "
+        "SELECT v1_images.system AS system, v1_images.uarch AS uarch, v1_uenv.name AS name, "
+        "       v1_uenv.version AS version, v1_tags.tag AS tag, v1_tags.sha256 AS sha256, v1_tags.rowid AS pos "
+        "FROM v1_tags "
+        "    INNER JOIN v1_uenv   ON v1_uenv.version_id = v1_tags.version_id "
+        "    INNER JOIN v1_images ON v1_images.sha256   = v1_tags.sha256",
+    ] + schema_statements(2) + [
+        # rows are inserted in the order of the primary key of each table where
+        # possible, and the last of duplicate tags is kept
+        "INSERT INTO images (sha256, id, date, size) "
+        "SELECT sha256, id, date, size FROM v1_images "
+        "WHERE sha256 IN (SELECT sha256 FROM temp.v1_records) ORDER BY sha256",
+        "INSERT INTO uenv (system, uarch, name, version) "
+        "SELECT system, uarch, name, version FROM temp.v1_records "
+        "GROUP BY system, uarch, name, version ORDER BY MIN(pos)",
+        "INSERT OR REPLACE INTO tags (version_id, tag, sha256) "
+        "SELECT uenv.version_id, v1_records.tag, v1_records.sha256 FROM temp.v1_records "
+        "    INNER JOIN uenv ON uenv.system  = v1_records.system "
+        "                   AND uenv.uarch   = v1_records.uarch "
+        "                   AND uenv.name    = v1_records.name "
+        "                   AND uenv.version = v1_records.version "
+        "ORDER BY uenv.version_id, v1_records.tag, v1_records.pos",
+        "DROP TABLE temp.v1_records",
+        "DROP TABLE v1_tags",
+        "DROP TABLE v1_uenv",
+        "DROP TABLE v1_images",
+    ],
+    # v3 records the version_key of each uenv, see names.version_key
+    2: [
+        "DROP VIEW records",
+        "ALTER TABLE uenv ADD COLUMN version_key TEXT NOT NULL DEFAULT ''",
+        "UPDATE uenv SET version_key = version_key(version)",
+    ] + [statement for statement in schema_statements(3) if "CREATE VIEW records" in statement],
+}
+
+# Indexes for the filters used by find_records and get_record. The unique key of
+# uenv only serves filters that start with system and uarch, so that filters on
+# name, version or tag alone would otherwise scan the whole records view. The
+# indexes include the columns that are joined on, so that they cover the query.
+# They are created when a database is opened, so that repositories created by
+# older versions are also indexed.
+indexes = {
+    "uenv_name": "CREATE INDEX IF NOT EXISTS uenv_name ON uenv (name, version, system, uarch, version_id)",
+    "tags_tag": "CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag, version_id, sha256)",
+    "tags_sha256": "CREATE INDEX IF NOT EXISTS tags_sha256 ON tags (sha256, version_id, tag)",
+    # the versions of each uenv in version order, to find the latest version
+    "uenv_version_key": "CREATE INDEX IF NOT EXISTS uenv_version_key ON uenv (name, system, uarch, version_key, version_id)",
+}
+
+# the columns of the records view that can be used as filters
+record_fields = ['system', 'uarch', 'name', 'version', 'tag', 'sha']
+
+# The full-text index of the records, over the fields in search_fields of each
+# tag, that answers the text and glob patterns of find_records. It uses the
+# trigram tokenizer of FTS5 (sqlite 3.34), so that every substring of at least
+# three characters, and GLOB patterns, are looked up in the index. The rowid of
+# each entry is that of its tag, and triggers update the index when tags are
+# added and removed. The index is optional, and is only created for the catalog
+# mirrors by create_search_index, because a repository on a shared file system
+# may also be written by sqlite builds without FTS5. Without it, find_records
+# matches text with LIKE on the records view.
+search_fields = ['name', 'version', 'tag', 'system', 'uarch']
+
+create_search_commands = [
+    "CREATE VIRTUAL TABLE main.search USING fts5(name, version, tag, system, uarch, tokenize='trigram')",
+    """CREATE TRIGGER main.search_insert AFTER INSERT ON tags BEGIN
+           INSERT INTO search (rowid, name, version, tag, system, uarch)
+           SELECT new.rowid, name, version, new.tag, system, uarch FROM uenv WHERE version_id = new.version_id;
+       END""",
+    # tags replaced by INSERT OR REPLACE are also deleted with this trigger,
+    # because recursive triggers are enabled in each write transaction
+    """CREATE TRIGGER main.search_delete AFTER DELETE ON tags BEGIN
+           DELETE FROM search WHERE rowid = old.rowid;
+       END""",
+    "INSERT INTO search (rowid, name, version, tag, system, uarch) "
+    "SELECT tags.rowid, uenv.name, uenv.version, tags.tag, uenv.system, uarch "
+    "FROM tags INNER JOIN uenv ON uenv.version_id = tags.version_id",
+]
+
+# The entries of the search index joined with their records, which are looked up
+# by the rowid of their tag. The columns are those of the records view, and tag_rowid.
+search_source = ("search CROSS JOIN ("
+                 "SELECT uenv.system AS system, uenv.uarch AS uarch, uenv.name AS name, uenv.version AS version, "
+                 "tags.tag AS tag, images.date AS date, images.size AS size, tags.sha256 AS sha256, "
+                 "images.id AS id, uenv.version_key AS version_key, tags.rowid AS tag_rowid "
+                 "FROM tags "
+                 "INNER JOIN uenv ON uenv.version_id = tags.version_id "
+                 "INNER JOIN images ON images.sha256 = tags.sha256"
+                 ") AS records ON records.tag_rowid = search.rowid")
+
+# The statistics of each image pull. The table is created the first time a pull
+# is recorded, so that repositories created by older versions remain valid.
+create_pulls_command = """
+CREATE TABLE IF NOT EXISTS pulls (
+    pull_id INTEGER PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    label TEXT NOT NULL,
+    source TEXT NOT NULL,
+    method TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    retries INTEGER NOT NULL,
+    date TEXT NOT NULL
+);
+"""
+
+# the number of uses of an image that are counted in its usage file, which
+# bounds the size of the file
+max_recorded_uses = 4096
+
+# the image eviction policies of FileSystemRepo.collect_garbage:
+#   lru:  the least recently used images are removed first
+#   size: images are removed in order of size times the time since they were
+#         last used, so that large images that are rarely used go first
+gc_policies = ["lru", "size"]
+
+def parse_size(size: str) -> int:
+    """
+    Parse a size in bytes, with an optional K, M, G or T suffix, e.g. 200G.
+    Raises ValueError if size is invalid.
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    size = size.strip().upper().rstrip("B")
+    scale = 1
+    if size and size[-1] in units:
+        scale = units[size[-1]]
+        size = size[:-1]
+    value = int(float(size) * scale)
+    if value < 0:
+        raise ValueError(f"the size must not be negative")
+    return value
+
+def disk_usage(path: str, exclusive: bool=False) -> int:
+    """
+    The number of bytes allocated to the files in path. If exclusive is set,
+    files with other hard links, e.g. images linked from a peer repository, are
+    not counted, so that the result is the number of bytes freed by removing path.
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if not exclusive or st.st_nlink == 1:
+                total += st.st_blocks * 512
+    return total
+
+# Many processes can open the same index.db at once, e.g. every rank of a job
+# that runs srun uenv run, while a pull adds images to it. Processes that only
+# resolve images open the database read-only. Writers serialise on a lock file
+# next to the database (see lock.FileLock), rather than only on the locks that
+# sqlite takes itself, so that a writer waits for at most writer_timeout seconds
+# outside of sqlite's busy handler, and a lock left by a crashed node is broken
+# once its heartbeat stops. Writers begin their transactions immediately so
+# that they wait for readers before they modify anything. When sqlite reports
+# that the database is busy, the operation is retried with a randomised
+# exponential backoff for at most busy_timeout seconds.
+busy_timeout = 60.0
+
+# the number of seconds that a writer waits for the writer lock
+writer_timeout = 60.0
+
+def is_busy(err: Exception) -> bool:
+    """whether err is raised because another connection has locked the database"""
+    return isinstance(err, sqlite3.OperationalError) and ("locked" in str(err) or "busy" in str(err))
+
+def retry_busy(operation, timeout: float=busy_timeout):
+    """Return operation(), retrying while the database is busy for at most timeout seconds."""
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    while True:
+        try:
+            return operation()
+        except sqlite3.OperationalError as err:
+            if not is_busy(err) or time.monotonic() + delay > deadline:
+                raise
+            terminal.info(f"the database is busy, retrying in {delay:.2f} seconds")
+        time.sleep(random.uniform(0.5, 1.5)*delay)
+        delay = min(2*delay, 1.0)
+
+def readonly_uri(path: str) -> str:
+    """the URI that opens the database in path read-only"""
+    return pathlib.Path(path).absolute().as_uri() + "?mode=ro"
+
+def schema_version(store: sqlite3.Connection, schema: str="main") -> int:
+    """
+    The schema version of the database attached to store as schema, or -1 if
+    the schema is not recognised.
+
+    The version is recorded in PRAGMA user_version, which is read from the
+    database header. Databases created before the version was recorded are
+    identified by the columns of their images table, which are read from the
+    schema without reading the table:
+        v1: images (date, id, sha256, size, system, uarch);
+        v2: images (date, id, sha256, size);
+    """
+    version = store.execute(f"PRAGMA {schema}.user_version").fetchone()[0]
+    if version:
+        return version
+    columns = sorted(row[1] for row in store.execute(f"PRAGMA {schema}.table_info(images)"))
+    if columns == ["date", "id", "sha256", "size"]:
+        return 2
+    if columns == ["date", "id", "sha256", "size", "system", "uarch"]:
+        return 1
+    return -1
+
+# return 1: repo is fully up to date
+# return 0: repo needs upgrading
+# return -1: unrecoverable error
+def version_status(version: int) -> int:
+    """the status of a repository whose database has schema version"""
+    if version==db_version:
+        return 1
+    elif version in migrations:
+        return 0
+    return -1
+
 # returns the version of the database in repo_path
 #  returns -1 if there was an error or unknown database format
 def repo_version(repo_path: str):
+    db_path = f"{repo_path}/index.db"
     try:
         # open the suspect database read only
-        db_path = f"{repo_path}/index.db"
-        db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
-        result = db.execute("SELECT * FROM images")
-        columns = [description[0] for description in result.description]
-        columns.sort()
-        db.close()
-
-        # the image tables in v1 and v2 have the respective columns:
-        # v1: images (date, id, sha256, size, system, uarch);
-        # v2: images (date, id, sha256, size);
-
-        version = -1
-        if columns == ["date", "id", "sha256", "size"]:
-            version = 2
-        elif columns == ["date", "id", "sha256", "size", "system", "uarch"]:
-            version = 1
+        db = sqlite3.connect(readonly_uri(db_path), uri=True)
+        try:
+            version = retry_busy(lambda: schema_version(db))
+        finally:
+            db.close()
         terminal.info(f"database {db_path} matches schema version {version}")
-
         return version
     except Exception as err:
         terminal.info(f"exception opening {db_path}: {str(err)}")
         return -1
 
 # return 2: repo does not exist
-# return 1: repo is fully up to date
-# return 0: repo needs upgrading
-# return -1: unrecoverable error
+# otherwise the version_status of the repo
 def repo_status(repo_path: str):
     index_path = repo_path + "/index.db"
     if not os.path.exists(index_path):
         return 2
 
-    version = repo_version(repo_path)
+    return version_status(repo_version(repo_path))
 
-    if version==db_version:
-        return 1
-    elif version==1:
-        return 0
+def repo_upgrade(repo_path: str) -> dict:
+    """
+    Upgrade the database in repo_path to db_version in place, after saving a
+    copy of it in index-v{version}.db.
 
-    return -1
-
-def repo_upgrade(repo_path: str):
+    Returns a dictionary with the version that the database was upgraded "from"
+    and "to", the path of the "backup" and the time taken in "seconds", or None
+    if the database was already up to date.
+    """
     version = repo_version(repo_path)
-    if version==2:
-        return
+    if version==db_version:
+        return None
     elif version==-1:
         raise RepoDBError("unable to upgrade database due to fatal error.")
 
-    if version==1:
-        # load the existing database using the v1 schema
-        db1_path = repo_path + "/index.db"
-        db1 = DataStore(db1_path)
-
-        # create a new database with the v2 schema
-        db2_path = repo_path + "/index-v1.db"
-        if os.path.exists(db2_path):
-            os.remove(db2_path)
-        FileSystemRepo.create(repo_path, exists_ok=False, db_name="index-v1.db")
-
-        # apply the records from the old database to the new db
-        db2 = DataStore(db2_path, create_command=create_db_commands[2])
-        for r in db1.images.records:
-            db2.add_record(r)
-
-        # close the databases
-        db1.close()
-        db2.close()
-
-        dbswp_path = repo_path + "/index-back.db"
-        shutil.move(db1_path, dbswp_path)
-        shutil.copy(db2_path, db1_path)
-        shutil.move(dbswp_path, db2_path)
+    start = time.perf_counter()
+    backup = f"{repo_path}/index-v{version}.db"
+    store = DataStore(f"{repo_path}/index.db")
+    try:
+        store.upgrade(backup)
+    finally:
+        store.close()
+    report = {"from": version, "to": db_version, "backup": backup, "seconds": time.perf_counter() - start}
+    terminal.info(f"upgraded {repo_path}/index.db from schema version {version} to {db_version} "
+                  f"in {report['seconds']:.3f} seconds, the original database is in {backup}")
+    return report
 
 
 class RecordSet():
-    def __init__(self, records, request):
-        self._shas = set([r.sha256 for r in records])
-        self._records = records
-        sha2record = {}
-        for sha in self._shas:
-            sha2record[sha] = [r for r in records if r.sha256==sha]
-        self._sha2record = sha2record
+    """
+    The records that match request.
+
+    records is either a list of Record, or a function that returns the list, so
+    that the records are only read from the database when they are used. counts
+    is an optional function that returns the number of records and of distinct
+    sha256 in the set, which is used to test whether the set is empty or unique
+    without reading the records.
+    """
+    def __init__(self, records, request, counts=None):
+        self._records = records if isinstance(records, list) else None
+        self._load = None if isinstance(records, list) else records
+        self._counts = counts
+        self._summary = None
+        self._sha2record = None
         self._request = request
 
+    def _totals(self):
+        """the number of records and of distinct sha256"""
+        if self._summary is None:
+            if self._records is None and self._counts is not None:
+                self._summary = self._counts()
+            else:
+                self._summary = (len(self.records), len(self.sha2record))
+        return self._summary
+
     @property
     def shas(self):
-        return list(self._shas)
+        return list(self.sha2record)
 
     @property
     def records(self):
+        if self._records is None:
+            self._records = self._load()
+            self._load = None
         return self._records
 
     @property
@@ -246,19 +560,28 @@ class RecordSet():
 
     @property
     def sha2record(self):
+        if self._sha2record is None:
+            sha2record = {}
+            for r in self.records:
+                sha2record.setdefault(r.sha256, []).append(r)
+            self._sha2record = sha2record
         return self._sha2record
 
+    @property
+    def count(self):
+        return self._totals()[0]
+
     @property
     def is_unique_sha(self):
-        return len(self._shas)==1
+        return self._totals()[1]==1
 
     @property
     def is_unique_record(self):
-        return len(self._records)==1
+        return self._totals()[0]==1
 
     @property
     def is_empty(self):
-        return len(self._shas)==0
+        return self._totals()[0]==0
 
     def ambiguous_request_message(self):
         """
@@ -267,74 +590,348 @@ class RecordSet():
         lines = []
         lines = [f"more than one uenv matches the spec {terminal.colorize(self.request, 'yellow')}",
                  f"the options are:"]
-        for r in self._records:
+        for r in self.records:
             lines.append(f"  {terminal.colorize(r.full_name, 'white'):34}  {terminal.colorize(r.id, 'cyan')}")
 
         return lines
 
 class DataStore:
-    def __init__(self, path=None, create_command=create_db_command):
+    def __init__(self, path=None, create_command=create_db_command, readonly: bool=False):
         """
         If path is a string, attempt to open the database at that location,
 
         Otherwise creat a new empty in-memory database.
 
+        If readonly is True the database on disk is opened read-only, e.g. to
+        resolve images, and can't be modified.
+
         raises an execption if opening an on-disk database and the file is not
         found, or if sqlite3 raises and execption when opening the databse.
         """
+        self._path = path
+        self._readonly = readonly
+        self._writer_lock = None
+        self._layers = []
+        self._search = None
         if path is None:
             self._store = sqlite3.connect(":memory:")
+            self._store.create_function("version_key", 1, names.version_key)
             self._store.executescript(create_db_command)
+            self._version = db_version
+            self._update_schema()
         else:
             if not os.path.isfile(path):
                 raise RepoNotFoundError(f"repository database file {path} does not exist")
             try:
-                self._store = sqlite3.connect(path)
+                # URIs are enabled, so that read-only layers can be attached
+                self._store = sqlite3.connect(readonly_uri(path) if readonly else path, uri=True)
+                # the version keys of uenv are computed by sqlite when records are added and upgraded
+                self._store.create_function("version_key", 1, names.version_key)
             except Exception as err:
                 raise RepoDBError(str(err))
 
-            # Ppening a connection does not check the validity of the database.
-            # Run a query to check that the database is valid.
+            # Opening a connection does not check the validity of the database.
+            # Reading the version and preparing a query of the records view check
+            # the header and the schema, without reading any of the tables, so
+            # that the cost of opening a database does not depend on its size.
             try:
-                _ = self._store.execute("SELECT * FROM records")
+                self._version = retry_busy(lambda: schema_version(self._store))
+                retry_busy(lambda: self._store.execute("SELECT * FROM records LIMIT 0").fetchall())
             except Exception as err:
                 raise RepoDBError(str(err))
+            if not readonly and self._version == db_version:
+                self._update_schema()
+
+    @property
+    def readonly(self) -> bool:
+        return self._readonly
+
+    @property
+    def version(self) -> int:
+        """the schema version of the database, see schema_version"""
+        return self._version
 
+    def _search_table(self) -> bool:
+        """whether the database has the search index"""
+        if self._search is None:
+            self._search = self._store.execute(
+                "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = 'search'").fetchone() is not None
+        return self._search
+
+    @property
+    def has_search_index(self) -> bool:
+        """whether find_records can use the search index, see create_search_index"""
+        # the records of the layers are not indexed
+        return self._search_table() and not self._layers
+
+    def create_search_index(self) -> bool:
+        """
+        Create the search index of the records if it does not exist. Returns
+        whether find_records can use the index, which it can't if sqlite was
+        built without FTS5 or the trigram tokenizer, or if another process is
+        writing to the database.
+        """
+        if not self._search_table():
+            try:
+                with self._transaction(timeout=0) as cursor:
+                    for command in create_search_commands:
+                        cursor.execute(command)
+            except (sqlite3.Error, RepoDBError) as err:
+                terminal.info(f"unable to create the search index: {str(err)}")
+                return False
+            self._search = True
+        return self.has_search_index
+
+    @contextlib.contextmanager
+    def _writer(self, timeout: float=writer_timeout):
+        """
+        Hold the writer lock of a database on disk. The lock is reentrant, so
+        that transactions can be run while it is held. Raises RepoDBError if
+        the database is read-only, or if the lock is not acquired within
+        timeout seconds.
+        """
+        if self._readonly:
+            raise RepoDBError(f"the database {self._path} was opened read-only")
+        if self._path is None or self._writer_lock is not None:
+            yield
+            return
+        writer = lock.FileLock(self._path + ".lock")
+        try:
+            acquired = writer.acquire(timeout)
+        except OSError as err:
+            raise RepoDBError(f"unable to lock {self._path} for writing: {str(err)}")
+        if not acquired:
+            raise RepoDBError(f"timed out waiting for another process to finish writing to {self._path}")
+        self._writer_lock = writer
+        try:
+            yield
+        finally:
+            self._writer_lock = None
+            writer.release()
+
+    @contextlib.contextmanager
+    def _transaction(self, timeout: float=writer_timeout):
+        """
+        A write transaction, that yields a cursor and is committed when the
+        block exits, or rolled back if it raises. The writer lock is held for
+        the duration of the transaction.
+        """
+        with self._writer(timeout):
+            cursor = self._store.cursor()
+            # foreign key enforcement can't be changed inside a transaction
+            cursor.execute("PRAGMA foreign_keys=on;")
+            cursor.execute("PRAGMA recursive_triggers=on;")
+            retry_busy(lambda: cursor.execute("BEGIN IMMEDIATE;"))
+            try:
+                yield cursor
+                retry_busy(self._store.commit)
+            except BaseException:
+                self._store.rollback()
+                raise
+
+    def _update_schema(self):
+        """
+        Record the schema version and create the indexes that are missing, if
+        the database can be written.
+        """
+        stamped = self._store.execute("PRAGMA main.user_version").fetchone()[0] == db_version
+        existing = {row[0] for row in self._store.execute("SELECT name FROM main.sqlite_master WHERE type = 'index'")}
+        missing = [command for name, command in indexes.items() if name not in existing]
+        if stamped and not missing:
+            return
+        try:
+            # the schema is updated by the next process if another is writing
+            with self._transaction(timeout=0) as cursor:
+                for command in missing:
+                    cursor.execute(command)
+                if not stamped:
+                    cursor.execute(f"PRAGMA main.user_version = {db_version}")
+        except (sqlite3.Error, RepoDBError) as err:
+            # e.g. a read-only repository, or an old schema that is about to be upgraded
+            terminal.info(f"unable to index the database: {str(err)}")
+
+    def upgrade(self, backup: str=None):
+        """
+        Upgrade the schema of the database to db_version in place, by applying
+        the migrations from its version in a single transaction. If backup is
+        provided, a copy of the database is saved there with the sqlite backup
+        API first, while the writer lock is held.
+        """
+        version = self._version
+        if version == db_version:
+            return
+        if version < 1 or version > db_version or any(v not in migrations for v in range(version, db_version)):
+            raise RepoDBError(f"unable to upgrade a database with schema version {version}")
+        try:
+            with self._writer():
+                # the backup can't be made while this connection is writing
+                if backup is not None:
+                    self.save(backup)
+                with self._transaction() as cursor:
+                    while version < db_version:
+                        terminal.info(f"migrating database from schema version {version} to {version+1}")
+                        for statement in migrations[version]:
+                            cursor.execute(statement)
+                        version += 1
+                    for command in indexes.values():
+                        cursor.execute(command)
+                    cursor.execute(f"PRAGMA main.user_version = {db_version}")
+        except sqlite3.Error as err:
+            raise RepoDBError(str(err))
+        self._version = db_version
 
     def add_record(self, r: Record):
         """
         Add a record to the database.
         """
 
-        cursor = self._store.cursor()
-
-        cursor.execute("BEGIN;")
-        cursor.execute("PRAGMA foreign_keys=on;")
-        cursor.execute("INSERT OR IGNORE INTO images (sha256, id, date, size) VALUES (?, ?, ?, ?)",
-                       (r.sha256, r.id, r.date, r.size))
-        # Insert a new system/uarch/name/version to the uenv table if no existing images exist
-        cursor.execute("INSERT OR IGNORE INTO uenv (system, uarch, name, version) VALUES (?, ?, ?, ?)",
-                       (r.system, r.uarch, r.name, r.version))
-        # Retrieve the version_id of the system/uarch/name/version identifier
-        # This requires a SELECT query to get the correct version_id whether or not
-        # a new row was added in the last INSERT
-        cursor.execute("SELECT version_id FROM uenv WHERE system = ? AND uarch = ? AND name = ? AND version = ?",
-                       (r.system, r.uarch, r.name, r.version))
-        version_id = cursor.fetchone()[0]
-        # Check whether an image with the same tag already exists in the repos
-        cursor.execute("SELECT version_id, tag, sha256 FROM tags WHERE version_id = ? AND tag = ?",
-                       (version_id, r.tag))
-        existing_tag = cursor.fetchone()
-        # If the tag exists, update the entry in the table with the new sha256
-        if existing_tag:
-            cursor.execute("UPDATE tags SET sha256 = ? WHERE version_id = ? AND tag = ?",
-                           (r.sha256, version_id, r.tag))
-        # Else add a new row
-        else:
-            cursor.execute("INSERT INTO tags (version_id, tag, sha256) VALUES (?, ?, ?)",
-                           (version_id, r.tag, r.sha256))
-        # Commit the transaction
-        self._store.commit()
+        with self._transaction() as cursor:
+            cursor.execute("INSERT OR IGNORE INTO images (sha256, id, date, size) VALUES (?, ?, ?, ?)",
+                           (r.sha256, r.id, r.date, r.size))
+            # Insert a new system/uarch/name/version to the uenv table if no existing images exist
+            cursor.execute("INSERT OR IGNORE INTO uenv (system, uarch, name, version, version_key) VALUES (?, ?, ?, ?, ?)",
+                           (r.system, r.uarch, r.name, r.version, names.version_key(r.version)))
+            # Retrieve the version_id of the system/uarch/name/version identifier
+            # This requires a SELECT query to get the correct version_id whether or not
+            # a new row was added in the last INSERT
+            cursor.execute("SELECT version_id FROM uenv WHERE system = ? AND uarch = ? AND name = ? AND version = ?",
+                           (r.system, r.uarch, r.name, r.version))
+            version_id = cursor.fetchone()[0]
+            # Check whether an image with the same tag already exists in the repos
+            cursor.execute("SELECT version_id, tag, sha256 FROM tags WHERE version_id = ? AND tag = ?",
+                           (version_id, r.tag))
+            existing_tag = cursor.fetchone()
+            # If the tag exists, update the entry in the table with the new sha256
+            if existing_tag:
+                cursor.execute("UPDATE tags SET sha256 = ? WHERE version_id = ? AND tag = ?",
+                               (r.sha256, version_id, r.tag))
+            # Else add a new row
+            else:
+                cursor.execute("INSERT INTO tags (version_id, tag, sha256) VALUES (?, ?, ?)",
+                               (version_id, r.tag, r.sha256))
+
+    def _stage_records(self, cursor, records):
+        """
+        Stream records into the temporary staging table.
+        The staging rowid preserves the input order.
+        """
+        cursor.execute("""CREATE TEMP TABLE IF NOT EXISTS staging (
+                            system TEXT, uarch TEXT, name TEXT, version TEXT, tag TEXT,
+                            date TEXT, size INTEGER, sha256 TEXT, id TEXT)""")
+        cursor.execute("DELETE FROM staging")
+        cursor.executemany("INSERT INTO staging VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           ((r.system, r.uarch, r.name, r.version, r.tag, r.date, r.size, r.sha256, r.id)
+                            for r in records))
+
+    def _apply_staged_records(self, cursor):
+        """
+        Add the records in the staging table, updating each table with one set-based statement.
+        """
+        cursor.execute("""INSERT OR IGNORE INTO images (sha256, id, date, size)
+                          SELECT sha256, id, date, size FROM staging ORDER BY rowid""")
+        cursor.execute("""INSERT OR IGNORE INTO uenv (system, uarch, name, version, version_key)
+                          SELECT system, uarch, name, version, version_key(version) FROM staging ORDER BY rowid""")
+        # replace the sha256 of existing tags
+        cursor.execute("""INSERT OR REPLACE INTO tags (version_id, tag, sha256)
+                          SELECT uenv.version_id, staging.tag, staging.sha256 FROM staging
+                              INNER JOIN uenv ON uenv.system  = staging.system
+                                             AND uenv.uarch   = staging.uarch
+                                             AND uenv.name    = staging.name
+                                             AND uenv.version = staging.version
+                          ORDER BY staging.rowid""")
+        cursor.execute("DELETE FROM staging")
+
+    def add_records(self, records):
+        """
+        Add records from an iterable to the database in a single transaction.
+
+        The result is the same as calling add_record for each record in order,
+        i.e. if more than one record has the same system/uarch/name/version:tag
+        the sha256 of the last one is used.
+        """
+
+        with self._transaction() as cursor:
+            self._stage_records(cursor, records)
+            self._apply_staged_records(cursor)
+
+    def sync_records(self, records, since: str=None) -> dict:
+        """
+        Update the database in a single transaction, so that it contains exactly
+        the records in an iterable.
+
+        Records that are not in the database are added, and records in the
+        database that are not in the iterable are removed, along with the images
+        and uenv that are no longer tagged. Records that are already in the
+        database are updated if their sha256 has changed, whatever their date,
+        e.g. when a tag is moved to an older image.
+
+        If since is provided, e.g. the latest date of the last sync, the number
+        of changed records that are dated at or before since is reported.
+
+        Returns a dictionary with the number of records that were "added",
+        "changed", "removed" and "unchanged".
+        """
+
+        with self._transaction() as cursor:
+            self._stage_records(cursor, records)
+            cursor.execute("CREATE INDEX IF NOT EXISTS temp.staging_key ON staging (system, uarch, name, version, tag)")
+
+            # classify each staged record against the existing tags
+            cursor.execute("DROP TABLE IF EXISTS temp.delta")
+            cursor.execute("""CREATE TEMP TABLE delta AS
+                              SELECT staging.rowid AS pos,
+                                     CASE
+                                         WHEN tags.sha256 IS NULL THEN 'added'
+                                         WHEN tags.sha256 != staging.sha256 THEN 'changed'
+                                         ELSE 'unchanged'
+                                     END AS status,
+                                     staging.date AS date
+                              FROM staging
+                                  LEFT JOIN uenv ON uenv.system  = staging.system
+                                                AND uenv.uarch   = staging.uarch
+                                                AND uenv.name    = staging.name
+                                                AND uenv.version = staging.version
+                                  LEFT JOIN tags ON tags.version_id = uenv.version_id
+                                                AND tags.tag        = staging.tag""")
+            counts = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0}
+            for status, count in cursor.execute("SELECT status, COUNT(*) FROM delta GROUP BY status").fetchall():
+                counts[status] = count
+            if since is not None:
+                retagged = cursor.execute("SELECT COUNT(*) FROM delta WHERE status = 'changed' AND date <= ?",
+                                          (since,)).fetchone()[0]
+                if retagged:
+                    terminal.info(f"{retagged} changed records are dated at or before {since}")
+
+            # remove tags that are not in the staged records
+            cursor.execute("""DELETE FROM tags WHERE rowid IN (
+                                  SELECT tags.rowid FROM tags
+                                      INNER JOIN uenv ON uenv.version_id = tags.version_id
+                                  WHERE NOT EXISTS (
+                                      SELECT 1 FROM staging
+                                      WHERE staging.system  = uenv.system
+                                        AND staging.uarch   = uenv.uarch
+                                        AND staging.name    = uenv.name
+                                        AND staging.version = uenv.version
+                                        AND staging.tag     = tags.tag))""")
+            counts["removed"] = cursor.rowcount
+
+            # only apply the added and changed records
+            cursor.execute("DELETE FROM staging WHERE rowid IN (SELECT pos FROM delta WHERE status = 'unchanged')")
+            cursor.execute("DROP TABLE temp.delta")
+            self._apply_staged_records(cursor)
+            self._remove_orphans(cursor)
+
+            return counts
+
+    def _remove_orphans(self, cursor):
+        """remove images and uenv that have no tags"""
+        cursor.execute("DELETE FROM images WHERE sha256 NOT IN (SELECT sha256 FROM tags)")
+        cursor.execute("DELETE FROM uenv WHERE version_id NOT IN (SELECT version_id FROM tags)")
+
+    @property
+    def latest_date(self) -> str:
+        """the most recent date of all images in the database, or None if it is empty"""
+        return self._store.execute("SELECT MAX(date) FROM images").fetchone()[0]
 
     def dump(self):
         """
@@ -369,29 +966,70 @@ class DataStore:
     def to_record(self, r):
         return Record(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7])
 
-    def find_records(self, **constraints):
-        if not constraints:
+    def find_records(self, text: str=None, **constraints):
+        """
+        The records that match constraints on the fields in record_fields.
+
+        Values of system, uarch, name, version and tag that are glob patterns,
+        e.g. name="*cuda*" or version="24.*", match every value of the field
+        that matches the pattern. The version "latest" matches the latest
+        version of each uenv, see names.latest_version.
+
+        If text is provided, only the records with text in their name, version,
+        tag, system or uarch are returned, the most relevant first. Matches of
+        the name are the most relevant.
+
+        Patterns and text are looked up in the search index if the database
+        has one, see create_search_index.
+        """
+        if not constraints and not text:
             raise ValueError("At least one constraint must be provided")
 
         for field in constraints:
-            if (field != "sha") and (field not in ['system', 'uarch', 'name', 'version', 'tag', 'sha']):
+            if field not in record_fields:
                 raise ValueError(f"Invalid field: {field}. Must be one of 'system', 'uarch', 'name', 'version', 'tag', 'sha'")
 
+        # The values are bound as parameters, so that the text of the query only
+        # depends on the fields, and sqlite3 reuses the prepared statement.
+        indexed = self.has_search_index
+        # The trigram tokenizer only indexes substrings of at least three characters.
+        # Text is looked up in the index in preference to patterns, because sqlite
+        # may crash when GLOB and MATCH constraints on the index are combined.
+        match = indexed and text is not None and len(text) >= 3
+        source = "records"
+        clauses = []
+        parameters = []
         if "sha" in constraints:
             sha = constraints["sha"]
-
-            if len(sha)<64:
-                items = self._store.execute(f"SELECT * FROM records WHERE id = '{sha}'")
-            else:
-                items = self._store.execute(f"SELECT * FROM records WHERE sha256 = '{sha}'")
-
+            clauses.append("records.id = ?" if len(sha)<64 else "records.sha256 = ?")
+            parameters.append(sha)
             request = sha
         else:
-            query_criteria = " AND ".join([f"{field} = '{value}'"
-                                           for field, value in constraints.items()])
-
-            # Find matching records for each constraint
-            items = self._store.execute(f"SELECT * FROM records WHERE {query_criteria}")
+            # the fields are sorted so that the same combination uses the same statement
+            latest = constraints.get("version") == names.latest_version
+            fields = sorted(field for field in constraints if not (latest and field == "version"))
+            for field in fields:
+                if not names.is_pattern(constraints[field]):
+                    clauses.append(f"records.{field} = ?")
+                elif indexed and not match:
+                    clauses.append(f"search.{field} GLOB ?")
+                    source = search_source
+                else:
+                    clauses.append(f"records.{field} GLOB ?")
+                parameters.append(constraints[field])
+            if latest:
+                # The latest version of each uenv, i.e. of each name on each system
+                # and uarch, that has the tag if one is requested. The versions are
+                # visited in version order with the uenv_version_key index, so that
+                # only the latest one is read.
+                newest = ("SELECT newest.version_key FROM records AS newest "
+                          "WHERE newest.name = records.name AND newest.system = records.system "
+                          "AND newest.uarch = records.uarch")
+                if "tag" in constraints:
+                    newest += " AND newest.tag = ?"
+                    parameters.append(constraints["tag"])
+                newest += " ORDER BY newest.version_key DESC LIMIT 1"
+                clauses.append(f"records.version_key = ({newest})")
 
             ns = constraints.get("name",    "*")
             vs = constraints.get("version", "*")
@@ -400,17 +1038,198 @@ class DataStore:
             ss = constraints.get("system",  "all")
             request = f"{ns}/{vs}:{ts}@{us} on {ss}"
 
-        results = [self.to_record(r) for r in items];
-        results.sort(reverse=True)
-        return RecordSet(results, request)
+        rank = None
+        if text:
+            escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            if match:
+                source = search_source
+                clauses.append("search MATCH ?")
+                parameters.append('"' + text.replace('"', '""') + '"')
+            else:
+                like = " OR ".join(f"records.{field} LIKE ? ESCAPE '\\'" for field in search_fields)
+                clauses.append(f"({like})")
+                parameters += [f"%{escaped}%"]*len(search_fields)
+            # names equal to text first, then names that start with it, then names
+            # that contain it, then the records where another field contains it
+            rank = ("CASE WHEN records.name LIKE ? ESCAPE '\\' THEN 0 "
+                    "WHEN records.name LIKE ? ESCAPE '\\' THEN 1 "
+                    "WHEN records.name LIKE ? ESCAPE '\\' THEN 2 ELSE 3 END",
+                    [escaped, f"{escaped}%", f"%{escaped}%"])
+            request = f"{request} containing '{text}'"
+
+        return self._select(" AND ".join(clauses), parameters, request, ordered=True, source=source, rank=rank)
+
+    def _select(self, where: str, parameters: list, request: str, ordered: bool=False,
+                source: str="records", rank: tuple=None) -> RecordSet:
+        """
+        The records in source that match the where clause. The records are read
+        when they are first used, and the size of the set is counted with an
+        aggregate query if it is needed before then.
+
+        If rank is provided, it is a tuple of an SQL expression and its
+        parameters, and the records are ordered by its value, lowest first.
+        Records with the same rank are ordered as they are otherwise.
+        """
+        where = f" WHERE {where}" if where else ""
+        rank_column, rank_parameters = (f", {rank[0]}", rank[1]) if rank else ("", [])
+
+        def load():
+            rows = retry_busy(lambda: self._store.execute(f"SELECT records.*{rank_column} FROM {source}{where}",
+                                                          rank_parameters + parameters).fetchall())
+            results = [(row[-1], self.to_record(row)) for row in rows]
+            if ordered:
+                results.sort(key=lambda result: result[1].sort_key, reverse=True)
+            if rank:
+                # the sort is stable, so that the order of equally relevant records is kept
+                results.sort(key=operator.itemgetter(0))
+            return [r for _, r in results]
+
+        def counts():
+            return tuple(retry_busy(lambda: self._store.execute(
+                f"SELECT COUNT(*), COUNT(DISTINCT records.sha256) FROM {source}{where}", parameters).fetchone()))
+
+        return RecordSet(load, request, counts)
+
+    def image_tags(self) -> dict:
+        """
+        Return a dictionary that maps the sha256 of each image in this database
+        to its number of tags.
+        """
+        query = """SELECT images.sha256, COUNT(tags.tag)
+                   FROM main.images LEFT JOIN main.tags ON tags.sha256 = images.sha256
+                   GROUP BY images.sha256"""
+        try:
+            return dict(self._store.execute(query))
+        except sqlite3.Error as err:
+            raise RepoDBError(str(err))
+
+    def remove_images(self, shas: list):
+        """
+        Remove images, their tags, and the uenv that have no other tags from
+        the database in a single transaction.
+        """
+        with self._transaction() as cursor:
+            cursor.executemany("DELETE FROM main.tags WHERE sha256 = ?", [(sha,) for sha in shas])
+            self._remove_orphans(cursor)
+
+    def add_layers(self, paths: list) -> list:
+        """
+        Attach the read-only databases at paths, and replace the records view
+        with the union of the records of each attached database and of this
+        database, so that queries search all of them with a single statement.
+        The databases are searched in order: a database only adds the records
+        whose system/uarch/name/version:tag is in none of the databases before
+        it. Records are still only added to this database.
+
+        Databases that can't be read, or whose schema is not the current
+        version, are ignored. Returns the paths of the attached databases.
+        """
+        sources = []
+        attached = []
+        for path in paths:
+            schema = f"layer{len(attached)}"
+            try:
+                self._store.execute(f"ATTACH DATABASE ? AS {schema}", (readonly_uri(path),))
+            except sqlite3.Error as err:
+                terminal.warning(f"unable to open the repository database {path}: {str(err)}")
+                continue
+            try:
+                version = retry_busy(lambda: schema_version(self._store, schema))
+            except sqlite3.Error as err:
+                terminal.info(f"unable to read the schema of {path}: {str(err)}")
+                version = -1
+            if version != db_version:
+                terminal.warning(f"the repository database {path} is not compatible with this version of uenv and is ignored")
+                self._store.execute(f"DETACH DATABASE {schema}")
+                continue
+            attached.append(path)
+            sources.append(f"{schema}.records")
+        sources.append("main.records")
+        selects = []
+        for source in sources:
+            shadowed = " AND ".join(
+                f"NOT EXISTS (SELECT 1 FROM {earlier} AS e WHERE e.system = r.system AND e.uarch = r.uarch "
+                f"AND e.name = r.name AND e.version = r.version AND e.tag = r.tag)"
+                for earlier in sources[:len(selects)])
+            selects.append(f"SELECT r.* FROM {source} AS r" + (f" WHERE {shadowed}" if shadowed else ""))
+        try:
+            # views in the temp schema take precedence over those in main
+            self._store.execute("DROP VIEW IF EXISTS temp.records")
+            self._store.execute(f"CREATE TEMP VIEW records AS {' UNION ALL '.join(selects)}")
+        except sqlite3.Error as err:
+            raise RepoDBError(str(err))
+        self._layers = attached
+        return attached
+
+    def add_pull(self, sha256: str, label: str, stats: dict):
+        """
+        Record the statistics of a pull of the image sha256, where stats is the
+        dictionary returned by registry.pull_uenv or oras.pull_uenv.
+        """
+        date = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+        try:
+            with self._transaction() as cursor:
+                cursor.execute(create_pulls_command)
+                cursor.execute(
+                    "INSERT INTO pulls (sha256, label, source, method, bytes, seconds, retries, date) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (sha256, label, stats["source"], stats["method"], stats["bytes"], stats["seconds"],
+                     stats["retries"], date))
+        except sqlite3.Error as err:
+            raise RepoDBError(str(err))
+
+    def _query_pulls(self, query: str, parameters=()) -> list:
+        try:
+            cursor = self._store.execute(query, parameters)
+        except sqlite3.OperationalError as err:
+            # no pulls have been recorded
+            if "no such table" in str(err):
+                return []
+            raise RepoDBError(str(err))
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def pull_summary(self) -> list:
+        """
+        The statistics of the recorded pulls, aggregated over each source and
+        method, slowest mean rate first. Rates are in bytes/second.
+        """
+        return self._query_pulls(
+            "SELECT source, method, COUNT(*) AS pulls, SUM(bytes) AS bytes, SUM(seconds) AS seconds, "
+            "SUM(bytes)/MAX(SUM(seconds), 1e-6) AS rate, MIN(bytes/MAX(seconds, 1e-6)) AS min_rate, "
+            "SUM(retries) AS retries "
+            "FROM pulls GROUP BY source, method ORDER BY rate")
+
+    def recent_pulls(self, count: int) -> list:
+        """The statistics of the last count pulls, most recent first."""
+        return self._query_pulls(
+            "SELECT sha256, label, source, method, bytes, seconds, bytes/MAX(seconds, 1e-6) AS rate, "
+            "retries, date FROM pulls ORDER BY pull_id DESC LIMIT ?", (count,))
+
+    def save(self, path: str):
+        """
+        Write a copy of the database to a new file at path.
+        Any existing file at path is overwritten.
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            target = sqlite3.connect(path)
+            # Connection.backup is not available in Python 3.6
+            if hasattr(self._store, "backup"):
+                self._store.backup(target)
+            else:
+                target.executescript("\n".join(self._store.iterdump()))
+            target.close()
+        except Exception as err:
+            raise RepoDBError(str(err))
 
     def close(self):
         self._store.close()
 
     @property
     def images(self):
-        items = self._store.execute(f"SELECT * FROM records")
-        return RecordSet([self.to_record(r) for r in items], "{*}/{*}:{*}@{*} on all")
+        return self._select("", [], "{*}/{*}:{*}@{*} on all")
 
     # return a list of records that match a sha
     def get_record(self, sha: str) -> Record:
@@ -422,16 +1241,50 @@ class DataStore:
         if not names.is_valid_sha(sha):
             raise ValueError(f"{sha} is not a valid 64 character sha256 or 16 character id")
         if names.is_full_sha256(sha):
-            results = self._store.execute(f"SELECT * FROM records WHERE sha256 = '{sha}'")
-        elif names.is_id(sha):
-            results = self._store.execute(f"SELECT * FROM records WHERE id  = '{sha}'")
+            return self._select("sha256 = ?", [sha], sha)
+        return self._select("id = ?", [sha], sha)
 
-        return RecordSet([self.to_record(r) for r in results], sha)
+# the ioctl that clones a file on file systems that support reflinks (Btrfs, XFS)
+FICLONE = 0x40049409
+
+def link_file(source: str, target: str) -> str:
+    """
+    Create target with the contents of source, without copying the data if
+    possible. Returns the method used: "reflink", "hardlink" or "copy".
+    """
+    try:
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return "reflink"
+    except OSError:
+        if os.path.exists(target):
+            os.remove(target)
+    try:
+        # fails across file systems, and on files that belong to another user
+        # if the kernel protects hard links
+        os.link(source, target)
+        return "hardlink"
+    except OSError:
+        shutil.copyfile(source, target)
+        return "copy"
 
 class FileSystemRepo():
-    def __init__(self, path: str):
+    def __init__(self, path: str, layers: list=(), readonly: bool=False):
+        """
+        Open the repository in path.
+
+        layers is an ordered list of the paths of read-only repositories, e.g. a
+        site-wide image store, whose images are also available. Queries return
+        the records of all repositories, and images are looked up in each layer
+        in order before path. Images are only added to the repository in path.
+
+        If readonly is True the index is opened read-only, which is how images
+        are resolved by uenv start and run, so that the ranks of a large job
+        don't contend with each other or with a pull for the database.
+        """
         self._path = path
         self._index = path + "/index.db"
+        self._readonly = readonly
 
         if not os.path.exists(self._path):
             # error: repository does not exists
@@ -441,7 +1294,22 @@ class FileSystemRepo():
             # error: index does not exists
             raise RepoNotFoundError(f"uenv image repository not found - the index database {self._index} does not exist.")
 
-        self._database = DataStore(self._index)
+        self._database = DataStore(self._index, readonly=readonly)
+
+        # the layers are attached to the connection of this repository, and checked there
+        candidates = []
+        for layer in layers:
+            if os.path.realpath(layer) == os.path.realpath(path):
+                continue
+            if not os.path.isfile(layer + "/index.db"):
+                terminal.info(f"FileSystemRepo: the repository {layer} does not exist")
+                continue
+            candidates.append(layer)
+        self._layers = []
+        if candidates:
+            attached = self._database.add_layers([layer + "/index.db" for layer in candidates])
+            self._layers = [layer for layer in candidates if layer + "/index.db" in attached]
+            terminal.info(f"FileSystemRepo: searching the repositories {self._layers} before {path}")
 
     @staticmethod
     def create(path: str, exists_ok: bool=False, db_name: str="index.db"):
@@ -464,11 +1332,299 @@ class FileSystemRepo():
     def database(self):
         return self._database
 
+    @property
+    def status(self) -> int:
+        """the status of the repository, see version_status"""
+        return version_status(self._database.version)
+
     def add_record(self, record: Record):
         self._database.add_record(record)
 
-    # The path where an image would be stored
+    def add_records(self, records):
+        self._database.add_records(records)
+
+    def add_pull(self, sha256: str, label: str, stats: dict):
+        self._database.add_pull(sha256, label, stats)
+
+    # The use of each image is recorded in a usage file, whose modification
+    # time is the time of the last use and whose size is the number of uses,
+    # up to max_recorded_uses, so that uenv start and run, which may run on
+    # every node of a job, never write to the index. The usage file is the only
+    # record of the use of an image.
+    def _usage_path(self, sha256: str) -> str:
+        return self._path + "/usage/" + sha256
+
+    def mark_used(self, r: Record, when: float=None):
+        """
+        Record the use of r at time when, by default now, in its usage file.
+        Raises OSError if the usage file can't be written.
+        """
+        when = time.time() if when is None else when
+        path = self._usage_path(r.sha256)
+        os.makedirs(self._path + "/usage", exist_ok=True)
+        with open(path, "ab") as fid:
+            # once the count is capped, only the time of the last use is updated
+            if fid.tell() < max_recorded_uses:
+                fid.write(b".")
+        os.utime(path, (when, when))
+
+    def image_usage(self) -> dict:
+        """
+        Return a dictionary that maps the sha256 of each image in the index to
+        a dictionary with its number of "tags", and when it was "last_used" and
+        how many times ("uses"), from its usage file. last_used is None if it
+        was never used.
+        """
+        usage = {}
+        for sha, tags in self._database.image_tags().items():
+            try:
+                stat = os.stat(self._usage_path(sha))
+                usage[sha] = {"tags": tags, "last_used": stat.st_mtime, "uses": stat.st_size}
+            except FileNotFoundError:
+                usage[sha] = {"tags": tags, "last_used": None, "uses": 0}
+        return usage
+
+    # The path where an image would be stored: the path in the first layer that
+    # contains it, otherwise the path in this repository.
     # will return a path even for images that are not stored
     def image_path(self, r: Record) -> str:
+        for layer in self._layers:
+            path = layer + "/images/" + r.sha256
+            if os.path.isdir(path):
+                return path
         return self._path + "/images/" + r.sha256
 
+    # Images are downloaded to a staging path, and only moved to image_path
+    # by install_image once the download is complete and verified, so that
+    # image_path never holds a partial image.
+    def staging_path(self, r: Record) -> str:
+        return self._path + "/staging/" + r.sha256
+
+    # The lock that is held while an image is downloaded and installed, so that
+    # concurrent pulls of the same image download it once.
+    def image_lock(self, r: Record) -> lock.FileLock:
+        return self._image_lock(r.sha256)
+
+    def _image_lock(self, sha256: str) -> lock.FileLock:
+        return lock.FileLock(self._path + "/locks/" + sha256 + ".lock")
+
+    def find_peer_image(self, r: Record, peers: list) -> str:
+        """
+        Return the path of the image r in the first of the peer repositories
+        that has it in its index and image path, or None.
+        """
+        for peer in peers:
+            path = f"{peer}/images/{r.sha256}"
+            if os.path.realpath(peer) == os.path.realpath(self._path) or not os.path.isdir(path):
+                continue
+            try:
+                database = DataStore(peer + "/index.db", readonly=True)
+                try:
+                    if database.version == db_version and not database.get_record(r.sha256).is_empty:
+                        return path
+                finally:
+                    database.close()
+            except (RepoNotFoundError, RepoDBError) as err:
+                terminal.info(f"FileSystemRepo: unable to read the peer repository {peer}: {str(err)}")
+        return None
+
+    def link_image(self, r: Record, source: str, check=None) -> dict:
+        """
+        Materialise the image in source, e.g. the image path in a peer repository
+        on the same file system, in the staging path of r without downloading it.
+        Each file is cloned with a reflink where the file system supports it,
+        otherwise hard linked, otherwise copied.
+
+        The image is materialised in a temporary path, which only replaces the
+        staging path, e.g. a partial download that can be resumed, once check,
+        if provided, returns True when called with the temporary path.
+
+        Returns the number of files materialised with each method, or None if
+        check failed. Raises OSError if the image can't be materialised.
+        """
+        target = self.staging_path(r)
+        tmp_path = f"{target}.link.{os.getpid()}"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        counts = {"reflink": 0, "hardlink": 0, "copy": 0}
+        try:
+            for root, dirs, files in os.walk(source):
+                relative = os.path.relpath(root, source)
+                os.makedirs(os.path.normpath(os.path.join(tmp_path, relative)), exist_ok=True)
+                for name in files:
+                    method = link_file(os.path.join(root, name), os.path.normpath(os.path.join(tmp_path, relative, name)))
+                    counts[method] += 1
+            if check is not None and not check(tmp_path):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return None
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            os.rename(tmp_path, target)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        terminal.info(f"FileSystemRepo: materialised {source} in {target}: {counts}")
+        return counts
+
+    def install_image(self, r: Record):
+        """
+        Atomically move a downloaded image from its staging path to its image path.
+        Any existing directory at the image path is replaced.
+        """
+        source = self.staging_path(r)
+        target = self._path + "/images/" + r.sha256
+        os.makedirs(self._path + "/images", exist_ok=True)
+        if os.path.exists(target):
+            # move the old directory out of the way before removing it, so that
+            # target is never a partially removed directory
+            old = f"{source}.old.{os.getpid()}"
+            terminal.info(f"FileSystemRepo: replacing existing path {target}")
+            os.rename(target, old)
+            shutil.rmtree(old)
+        os.rename(source, target)
+        terminal.info(f"FileSystemRepo: installed {source} as {target}")
+
+        # make the rename durable before the image is added to the index
+        fd = os.open(self._path + "/images", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def collect_garbage(self, quota: int=None, policy: str="lru", dry_run: bool=False, protected=()) -> list:
+        """
+        Remove the images that are no longer needed:
+          * image directories that are not in the index ("orphan")
+          * images in the index that have no tags ("untagged")
+          * if the images use more than quota bytes, tagged images in the order
+            given by policy (see gc_policies) until they fit in the quota.
+        The size of an image is the number of bytes that removing it frees, so
+        files that are hard linked from another repository are not counted.
+        Images with a sha256 in protected, e.g. those that are mounted, and
+        images that are locked by a pull are not removed.
+
+        Returns a list of the images that were removed, or would be removed if
+        dry_run is set, as dictionaries with the "sha256", "label" (name/version:tag,
+        or None if it has no tags), "size" in bytes and "reason" of each image.
+        """
+        if policy not in gc_policies:
+            raise ValueError(f"invalid garbage collection policy {policy}: must be one of {gc_policies}")
+        images_path = self._path + "/images"
+        try:
+            entries = [e for e in os.listdir(images_path) if os.path.isdir(f"{images_path}/{e}")]
+        except FileNotFoundError:
+            entries = []
+        usage = self.image_usage()
+        sizes = {sha: disk_usage(f"{images_path}/{sha}", exclusive=True) for sha in entries}
+
+        plan = []
+        for sha in entries:
+            if sha not in usage:
+                plan.append({"sha256": sha, "size": sizes[sha], "reason": "orphan"})
+            elif usage[sha]["tags"] == 0:
+                plan.append({"sha256": sha, "size": sizes[sha], "reason": "untagged"})
+        # untagged images whose directory is already gone only need their index entry removed
+        for sha, u in usage.items():
+            if u["tags"] == 0 and sha not in sizes:
+                plan.append({"sha256": sha, "size": 0, "reason": "untagged"})
+
+        removed = {p["sha256"] for p in plan}
+        total = sum(size for sha, size in sizes.items() if sha not in removed)
+        if quota is not None and total > quota:
+            now = time.time()
+            def last_used(sha):
+                # images that have never been used were last used when they were installed
+                return usage[sha]["last_used"] or os.path.getmtime(f"{images_path}/{sha}")
+            if policy == "lru":
+                key = lambda sha: last_used(sha)
+            else:
+                key = lambda sha: -sizes[sha] * max(now - last_used(sha), 1.)
+            # images whose files are all linked from elsewhere free nothing when removed
+            candidates = [sha for sha in sizes if sha in usage and sha not in removed and sha not in protected
+                          and sizes[sha] > 0]
+            for sha in sorted(candidates, key=key):
+                if total <= quota:
+                    break
+                plan.append({"sha256": sha, "size": sizes[sha], "reason": policy})
+                total -= sizes[sha]
+            if total > quota:
+                terminal.warning(f"the images in {self._path} can't be reduced below the quota: "
+                                 f"{total} bytes are in use by images that are mounted or locked")
+
+        for p in plan:
+            records = self._database.get_record(p["sha256"]).records if p["reason"] != "orphan" else []
+            p["label"] = f"{records[0].name}/{records[0].version}:{records[0].tag}" if records else None
+
+        if not dry_run:
+            plan = self._remove_images(plan)
+        return plan
+
+    def _remove_images(self, plan: list) -> list:
+        # images that are being pulled are skipped
+        locks = []
+        removable = []
+        for p in plan:
+            image_lock = self._image_lock(p["sha256"])
+            if image_lock.acquire(timeout=0):
+                locks.append(image_lock)
+                removable.append(p)
+            else:
+                terminal.info(f"FileSystemRepo: skipping {p['sha256']}, which is locked by {image_lock.holder()}")
+        try:
+            # Remove the images from the index first, so that the index never
+            # refers to a partially removed image. A directory left behind by
+            # an interruption is removed as an orphan by the next collection.
+            self._database.remove_images([p["sha256"] for p in removable if p["reason"] != "orphan"])
+            os.makedirs(self._path + "/staging", exist_ok=True)
+            for p in removable:
+                path = f"{self._path}/images/{p['sha256']}"
+                if not os.path.exists(path):
+                    continue
+                # move the directory out of images in one step, then remove it
+                trash = f"{self._path}/staging/{p['sha256']}.gc.{os.getpid()}"
+                os.rename(path, trash)
+                shutil.rmtree(trash)
+                terminal.info(f"FileSystemRepo: removed {path} ({p['reason']})")
+            for p in removable:
+                try:
+                    os.remove(self._usage_path(p["sha256"]))
+                except FileNotFoundError:
+                    pass
+        finally:
+            for image_lock in locks:
+                image_lock.release()
+        return removable
+
+    def sweep_staging(self, ttl: float=staging_ttl):
+        """
+        Remove staging directories that have not been modified for ttl seconds,
+        i.e. downloads that were abandoned. Recent partial downloads are kept
+        so that they can be resumed, and the staging paths of images that are
+        locked, e.g. by a slow pull, are skipped.
+        """
+        staging = self._path + "/staging"
+        try:
+            entries = os.listdir(staging)
+        except OSError:
+            return
+        now = time.time()
+        for entry in entries:
+            path = f"{staging}/{entry}"
+            # staging paths are named sha256, sha256.old.pid, sha256.gc.pid or sha256.link.pid
+            image_lock = self._image_lock(entry.split(".", 1)[0])
+            try:
+                if not image_lock.acquire(timeout=0):
+                    terminal.info(f"FileSystemRepo: skipping {path}, which is locked by {image_lock.holder()}")
+                    continue
+                try:
+                    if now - os.path.getmtime(path) > ttl:
+                        terminal.info(f"FileSystemRepo: removing stale staging path {path}")
+                        if os.path.isdir(path):
+                            shutil.rmtree(path)
+                        else:
+                            os.remove(path)
+                finally:
+                    image_lock.release()
+            except OSError as err:
+                terminal.info(f"FileSystemRepo: unable to remove {path}: {str(err)}")
+
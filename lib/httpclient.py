@@ -0,0 +1,192 @@
+import concurrent.futures
+import random
+import threading
+import time
+
+import requests
+
+import terminal
+
+# Shared HTTP client used for all requests made by uenv.
+#
+# - a single requests.Session keeps connections alive and pooled between requests
+# - compressed transfer is requested explicitly
+# - every request has a connect and read timeout
+# - failed connections, timeouts and transient server errors are retried with
+#   exponential backoff and full jitter
+# - a request can be hedged: if the primary URL has not responded after a delay,
+#   the same request is sent to a secondary mirror, and the first response wins
+
+# status codes that indicate a transient error on the server side
+retry_status = {429, 500, 502, 503, 504}
+
+class RequestError(Exception):
+    """Exception raised when an HTTP request fails after all retries."""
+
+    def __init__(self, message, status=None):
+        self.message = message
+        self.status = status
+        super().__init__(self.message)
+
+    def __str__(self):
+        return self.message
+
+class _RetryableStatus(Exception):
+    def __init__(self, response):
+        self.response = response
+        super().__init__(f"HTTP {response.status_code} {response.reason}")
+
+class Client():
+    def __init__(self, retries: int=3, backoff: float=0.5, max_backoff: float=8.0,
+                 timeout: tuple=(5.0, 30.0), hedge_delay: float=2.0, pool_size: int=8):
+        """
+        retries:     the maximum number of retries after the first attempt
+        backoff:     the base delay in seconds between retries, doubled after each retry
+        max_backoff: the maximum delay in seconds between retries
+        timeout:     the (connect, read) timeouts in seconds
+        hedge_delay: seconds to wait for the primary URL before sending a hedged request
+        pool_size:   the number of connections kept alive for each host
+        """
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._timeout = timeout
+        self._hedge_delay = hedge_delay
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._session.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "retries": 0, "failures": 0, "hedged": 0, "hedge_wins": 0}
+        self._latency = []
+
+    @property
+    def session(self):
+        return self._session
+
+    @property
+    def stats(self) -> dict:
+        """counters of requests, retries, failures and hedged requests, and latency statistics"""
+        with self._lock:
+            stats = dict(self._stats)
+            if self._latency:
+                stats["latency_min"] = min(self._latency)
+                stats["latency_mean"] = sum(self._latency)/len(self._latency)
+                stats["latency_max"] = max(self._latency)
+            return stats
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _record_latency(self, latency: float):
+        with self._lock:
+            self._latency.append(latency)
+
+    def backoff(self, attempt: int) -> float:
+        """the delay before retry number attempt (starting at 1), with full jitter"""
+        return random.uniform(0, min(self._max_backoff, self._backoff * 2**(attempt-1)))
+
+    def get(self, url: str, headers: dict=None, stream: bool=False, hedge_url: str=None) -> requests.Response:
+        """
+        Perform a GET request, retrying transient errors.
+
+        If hedge_url is provided, the request is also sent to hedge_url if url has
+        not responded after hedge_delay seconds, and the first successful
+        response is returned.
+
+        Raises RequestError if the request fails, or if the response has an
+        error status.
+        """
+        if hedge_url is None:
+            return self._get(url, headers, stream)
+        return self._hedged_get(url, hedge_url, headers, stream)
+
+    def _get(self, url: str, headers: dict, stream: bool) -> requests.Response:
+        attempt = 0
+        while True:
+            self._count("requests")
+            start = time.perf_counter()
+            try:
+                response = self._session.get(url, headers=headers, stream=stream, timeout=self._timeout)
+                if response.status_code in retry_status:
+                    raise _RetryableStatus(response)
+                latency = time.perf_counter() - start
+                self._record_latency(latency)
+                terminal.info(f"GET {url}: {response.status_code} in {latency:.3f}s")
+                if response.status_code >= 400:
+                    response.close()
+                    self._count("failures")
+                    raise RequestError(f"GET {url} failed: HTTP {response.status_code} {response.reason}", response.status_code)
+                return response
+            except (requests.ConnectionError, requests.Timeout, _RetryableStatus) as err:
+                if isinstance(err, _RetryableStatus):
+                    err.response.close()
+                if attempt >= self._retries:
+                    self._count("failures")
+                    raise RequestError(f"GET {url} failed after {attempt+1} attempts: {str(err)}",
+                                       err.response.status_code if isinstance(err, _RetryableStatus) else None)
+                attempt += 1
+                delay = self.backoff(attempt)
+                terminal.info(f"GET {url}: {str(err)} - retry {attempt}/{self._retries} in {delay:.2f}s")
+                self._count("retries")
+                time.sleep(delay)
+
+    def _hedged_get(self, url: str, hedge_url: str, headers: dict, stream: bool) -> requests.Response:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        try:
+            primary = executor.submit(self._get, url, headers, stream)
+            pending = {primary}
+            done, _ = concurrent.futures.wait(pending, timeout=self._hedge_delay)
+            # send the request to the mirror if the primary is slow or has failed
+            if not done or primary.exception() is not None:
+                terminal.info(f"GET {url}: sending hedged request to {hedge_url}")
+                self._count("hedged")
+                pending.add(executor.submit(self._get, hedge_url, headers, stream))
+
+            error = None
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        response = future.result()
+                    except RequestError as err:
+                        error = err
+                        continue
+                    if future is not primary:
+                        self._count("hedge_wins")
+                    # close the response of the slower request when it arrives
+                    for other in pending:
+                        other.add_done_callback(_close_response)
+                    return response
+            raise error
+        finally:
+            executor.shutdown(wait=False)
+
+    def report(self):
+        """print the request statistics in verbose mode"""
+        stats = self.stats
+        if stats["requests"] == 0:
+            return
+        msg = (f"http: {stats['requests']} requests, {stats['retries']} retries, {stats['failures']} failures, "
+               f"{stats['hedged']} hedged ({stats['hedge_wins']} won by the mirror)")
+        if "latency_mean" in stats:
+            msg += (f", latency min/mean/max {stats['latency_min']:.3f}/"
+                    f"{stats['latency_mean']:.3f}/{stats['latency_max']:.3f}s")
+        terminal.info(msg)
+
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+_client = None
+
+def client() -> Client:
+    """the HTTP client shared by all modules"""
+    global _client
+    if _client is None:
+        _client = Client()
+    return _client
@@ -1,7 +1,10 @@
-import requests
+import codecs
+import json
+import os
 
 from datastore import DataStore
 from record import Record
+import httpclient
 import terminal
 
 
@@ -34,36 +37,226 @@ import terminal
 #}
 #
 
-def query() -> tuple:
+listing_url = "https://uenv-list.svc.cscs.ch/list"
+
+def listing_mirror_url() -> str:
+    """
+    The URL of a secondary middleware that serves the same listing, if any.
+    Set with the UENV_LIST_MIRROR_URL environment variable.
+    """
+    return os.environ.get("UENV_LIST_MIRROR_URL")
+
+def fetch_listing(url: str=listing_url, etag: str=None, last_modified: str=None, mirror_url: str=None) -> tuple:
+    """
+    Download the listing of all images from the middleware.
+
+    If etag or last_modified are provided, a conditional request is made, and
+    None is returned in place of the listing if it has not been modified.
+    If mirror_url is provided, it is queried when url is slow to respond or fails.
+
+    Returns a tuple (chunks, validators), where chunks is an iterator over the
+    body of the response, to be parsed with load_namespace, and validators is a
+    dictionary with the "etag" and "last_modified" validators of the response.
+    """
+    headers = {}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+
     try:
         # GET request to the middleware
-        url = "https://uenv-list.svc.cscs.ch/list"
         terminal.info(f"querying jfrog at {url}")
-        response = requests.get(url)
-        response.raise_for_status()
+        response = httpclient.client().get(url, headers=headers, stream=True, hedge_url=mirror_url)
+
+        validators = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+
+        if response.status_code == 304:
+            terminal.info(f"jfrog listing has not been modified")
+            return (None, validators)
+
+        return (response.iter_content(chunk_size=64*1024), validators)
+
+    except Exception as error:
+        raise RuntimeError(f"downloading image data from jfrog.svs.cscs.ch ({str(error)})")
+
+class ListingReader():
+    """
+    Incremental parser for the listing returned by the middleware.
+
+    The body is read chunk by chunk, and the entries of the "results" array are
+    decoded one at a time, so that the full listing is never held in memory.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+
+    def _read(self) -> bool:
+        """append the next chunk to the buffer, returning False at the end of the body"""
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        self._buffer = self._buffer[self._pos:] + self._utf8.decode(chunk)
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        """return the next non-whitespace character"""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in " \t\n\r":
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read():
+                raise ValueError("unexpected end of listing")
+
+    def _expect(self, c: str):
+        if self._peek() != c:
+            raise ValueError(f"expected '{c}' at '{self._buffer[self._pos:self._pos+32]}'")
+        self._pos += 1
+
+    def _value(self):
+        """decode the next JSON value"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A number might continue in the next chunk, e.g. "1." and "5e10"
+                # are decoded as 1, so it is only complete once the buffer holds
+                # a character after its longest possible extent.
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    extent = end
+                    while extent < len(self._buffer) and self._buffer[extent] in "0123456789eE.+-":
+                        extent += 1
+                    if extent == len(self._buffer) and self._read():
+                        continue
+                self._pos = end
+                return value
+            except json.JSONDecodeError:
+                if not self._read():
+                    raise
 
-        raw_records = response.json()
+    def results(self):
+        """generator over the entries in the results array"""
+        self._expect("{")
+        while self._peek() != "}":
+            key = self._value()
+            self._expect(":")
+            if key != "results":
+                self._value()
+            else:
+                self._expect("[")
+                while self._peek() != "]":
+                    yield self._value()
+                    if self._peek() == ",":
+                        self._pos += 1
+                self._pos += 1
+            if self._peek() == ",":
+                self._pos += 1
 
-        deploy_database = DataStore()
-        build_database = DataStore()
+def iter_records(entries, namespace: str, system: str=None, uarch: str=None, name: str=None):
+    """
+    Generate the records in namespace from the entries of a listing.
 
-        for record in raw_records["results"]:
-            path = record["path"]
+    Entries that do not match the optional system, uarch and name filters are
+    skipped before a Record is created.
+    """
+    prefix = namespace + "/"
+    for entry in entries:
+        path = entry["path"]
+        if not path.startswith(prefix):
+            continue
+        fields = path.split("/")
+        if len(fields) != 6:
+            raise ValueError(f"invalid path {path}")
+        if ((system is not None and fields[1] != system) or
+            (uarch  is not None and fields[2] != uarch) or
+            (name   is not None and fields[3] != name)):
+            continue
+        date = Record.to_datestring(entry["created"])
+        yield Record(*fields[1:], date, entry["size"], entry["sha256"])
 
-            date = Record.to_datetime(record["created"])
-            sha256 = record["sha256"]
-            size = record["size"]
-            if path.startswith("build/"):
-                r = Record.frompath(path[len("build/"):], date, size, sha256)
-                build_database.add_record(r)
-            if path.startswith("deploy/"):
-                r = Record.frompath(path[len("deploy/"):], date, size, sha256)
-                deploy_database.add_record(r)
+def load_namespace(chunks, namespace: str, system: str=None, uarch: str=None, name: str=None) -> DataStore:
+    """
+    Create the database of one namespace from a listing returned by fetch_listing.
 
-        return (deploy_database, build_database)
+    The entries are streamed directly into the database, and only records that
+    match the optional system, uarch and name filters are inserted.
+    """
+    if namespace!='deploy' and namespace!='build':
+        raise RuntimeError("namespace must be one of build or deploy")
+    try:
+        database = DataStore()
+        database.add_records(iter_records(ListingReader(chunks).results(), namespace, system, uarch, name))
+        return database
 
     except Exception as error:
-        raise RuntimeError(f"downloading image data from jfrog.svs.cscs.ch ({str(error)})")
+        raise RuntimeError(f"reading image data from jfrog.svs.cscs.ch ({str(error)})")
+
+def load_namespaces(chunks, filters: dict, batch_size: int=10000) -> dict:
+    """
+    Create the databases of several namespaces from a single listing returned by
+    fetch_listing, so that the listing is downloaded and parsed once.
+
+    filters maps each namespace to a function that returns whether a record of
+    the namespace is inserted, or to None to insert all of its records.
+    Returns a dictionary that maps each namespace to its database.
+    """
+    for namespace in filters:
+        if namespace!='deploy' and namespace!='build':
+            raise RuntimeError("namespace must be one of build or deploy")
+    try:
+        databases = {namespace: DataStore() for namespace in filters}
+        # records are inserted in batches, so that the listing is never held in memory
+        batches = {namespace: [] for namespace in filters}
+        for entry in ListingReader(chunks).results():
+            namespace = entry["path"].split("/", 1)[0]
+            if namespace not in filters:
+                continue
+            for r in iter_records([entry], namespace):
+                if filters[namespace] is None or filters[namespace](r):
+                    batches[namespace].append(r)
+            if len(batches[namespace]) >= batch_size:
+                databases[namespace].add_records(batches[namespace])
+                batches[namespace] = []
+        for namespace, records in batches.items():
+            databases[namespace].add_records(records)
+        return databases
+
+    except Exception as error:
+        raise RuntimeError(f"reading image data from jfrog.svs.cscs.ch ({str(error)})")
+
+def sync_namespace(chunks, namespace: str, database: DataStore, since: str=None) -> dict:
+    """
+    Apply the changes to a namespace in a listing returned by fetch_listing to
+    a database of the namespace, created by an earlier call to load_namespace
+    or sync_namespace. Every entry is compared with the database: since is only
+    used for reporting, see DataStore.sync_records.
+
+    Returns the number of records that were added, changed, removed and unchanged.
+    """
+    if namespace!='deploy' and namespace!='build':
+        raise RuntimeError("namespace must be one of build or deploy")
+    try:
+        return database.sync_records(iter_records(ListingReader(chunks).results(), namespace), since)
+
+    except Exception as error:
+        raise RuntimeError(f"reading image data from jfrog.svs.cscs.ch ({str(error)})")
+
+def query(namespace: str, system: str=None, uarch: str=None, name: str=None) -> DataStore:
+    chunks, _ = fetch_listing(mirror_url=listing_mirror_url())
+    return load_namespace(chunks, namespace, system, uarch, name)
+
+def query_namespaces(filters: dict) -> dict:
+    chunks, _ = fetch_listing(mirror_url=listing_mirror_url())
+    return load_namespaces(chunks, filters)
 
 def relative_from_record(record):
     return f"{record.system}/{record.uarch}/{record.name}/{record.version}:{record.tag}"
@@ -0,0 +1,143 @@
+import errno
+import fcntl
+import os
+import socket
+import threading
+import time
+
+import terminal
+
+# Locks are held with fcntl.lockf, i.e. POSIX record locks, which unlike flock
+# are also exclusive between nodes on shared file systems (NFS, Lustre, GPFS).
+#
+# The lock is released when the process that holds it exits, however a lock on
+# a shared file system can outlive a node that crashed or lost its connection
+# to the file server. The holder of a lock updates the modification time of the
+# lock file every heartbeat seconds, and a lock file that has not been modified
+# for stale seconds is assumed to be held by such a process. It is broken by
+# removing the file, so that the next process to lock it creates a new file.
+
+# the default number of seconds after which a lock that is not updated is stale
+default_stale = 300.0
+
+class FileLock():
+    """
+    An exclusive lock on path, that can be shared between processes on
+    different nodes. The lock file records the host and pid of the holder.
+    """
+    def __init__(self, path: str, stale: float=default_stale, heartbeat: float=None, poll: float=0.5):
+        self._path = path
+        self._stale = stale
+        self._heartbeat = stale/10 if heartbeat is None else heartbeat
+        self._poll = poll
+        self._fd = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def locked(self) -> bool:
+        """whether the lock is held by this object"""
+        return self._fd is not None
+
+    def holder(self) -> str:
+        """
+        The host and pid of the process that last acquired the lock, if known.
+        Don't call this while holding the lock: closing any descriptor of the
+        file releases the POSIX locks of the process on it.
+        """
+        try:
+            with open(self._path) as fid:
+                return fid.read().strip()
+        except OSError:
+            return ""
+
+    def acquire(self, timeout: float=None) -> bool:
+        """
+        Acquire the lock, waiting at most timeout seconds for another process to
+        release it, or indefinitely if timeout is None.
+        Returns False if the lock was not acquired.
+        """
+        if self._fd is not None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+        while True:
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as err:
+                os.close(fd)
+                if err.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+                if self._break_stale():
+                    continue
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+                time.sleep(self._poll)
+                continue
+
+            # the lock file may have been removed as stale after it was opened
+            try:
+                current = os.stat(self._path).st_ino
+            except FileNotFoundError:
+                current = None
+            if current != os.fstat(fd).st_ino:
+                os.close(fd)
+                continue
+
+            self._fd = fd
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, f"{socket.gethostname()} {os.getpid()}\n".encode(), 0)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._beat, daemon=True)
+            self._thread.start()
+            terminal.info(f"acquired lock {self._path}")
+            return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+        terminal.info(f"released lock {self._path}")
+
+    def _beat(self):
+        while not self._stop.wait(self._heartbeat):
+            try:
+                os.utime(self._fd)
+            except OSError as err:
+                terminal.info(f"unable to update lock {self._path}: {str(err)}")
+
+    def _break_stale(self) -> bool:
+        """remove the lock file if it is stale, returning True if it was removed"""
+        try:
+            st = os.stat(self._path)
+        except FileNotFoundError:
+            return True
+        if time.time() - st.st_mtime < self._stale:
+            return False
+        # check again immediately before removing the file, to narrow the window
+        # in which another process could have broken the lock and acquired a new one
+        try:
+            if os.stat(self._path).st_ino == st.st_ino:
+                terminal.warning(f"breaking stale lock {self._path} held by {self.holder() or 'unknown'}")
+                os.remove(self._path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -1,3 +1,4 @@
+import functools
 import re
 
 def is_full_sha256(s: str):
@@ -20,6 +21,7 @@ def is_valid_sha(sha:str) -> bool:
 #       "prgenv_gnu/23.11"        -> ("prgenv_gnu", "23.11", None,     None)
 #       "prgenv_gnu/23.11:latest" -> ("prgenv_gnu", "23.11", "latest", None)
 #       "prgenv_gnu:v2"           -> ("prgenv_gnu", None,    "v2",     None)
+#       "prgenv_gnu/latest"       -> ("prgenv_gnu", "latest", None,    None)
 #       "3313739553fe6553"        -> (None,         None,    None,     "3313739553fe6553")
 def parse_uenv_string(uenv: str) -> dict:
     name = version = tag = sha = None
@@ -81,3 +83,35 @@ def create_filter(uenv, require_complete=False) -> dict:
             img_filter[key] = value
 
     return img_filter
+
+def is_pattern(s: str) -> bool:
+    """whether s is a glob pattern, e.g. "prgenv-*" or "24.[0-9]", rather than a literal value"""
+    return any(c in s for c in "*?[")
+
+# the version in a description that selects the most recent version of a uenv,
+# e.g. "prgenv_gnu/latest" or "prgenv_gnu/latest:v2"
+latest_version = "latest"
+
+_version_fields = re.compile(r"[0-9]+|[^0-9._-]+")
+
+@functools.lru_cache(maxsize=4096)
+def version_key(version: str) -> str:
+    """
+    A key that sorts version strings and tags in version order, so that they can
+    be compared as strings, and indexed, by sqlite.
+
+    The version is split into numeric and alphabetic fields on ".", "-" and "_",
+    and each numeric field is prefixed with its number of digits, so that
+    numbers are compared by value, e.g.
+        "24.2"       -> "0224.012"
+        "24.10"      -> "0224.0210"
+        "v2-rc1"     -> "v.012.rc.011"
+        "1133706947" -> "101133706947"
+    """
+    fields = []
+    for field in _version_fields.findall(version):
+        if field[0].isdigit():
+            field = field.lstrip("0") or "0"
+            field = f"{len(field):02d}{field}"
+        fields.append(field)
+    return ".".join(fields)
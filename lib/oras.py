@@ -7,6 +7,16 @@ import time
 import progress
 import terminal
 
+class OrasError(Exception):
+    """Exception raised when an image can't be pulled with oras."""
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return self.message
+
 def find_oras() -> str:
     # - the oras executable is installed in the libexec path
     # - this file is installed in the libexec/lib path
@@ -66,9 +76,34 @@ def run_command(args):
         proc.terminate()
         terminal.error(f"oras command failed with unknown exception: {e}")
 
+def copy(source_address: str, target_address: str, concurrency: int=10) -> str:
+    """
+    Copy an image and its referrers from source_address to target_address.
+
+    Returns None if the copy succeeded, otherwise an error message. Unlike
+    run_command, it does not exit on failure, so that several copies can run
+    in worker threads.
+    """
+    proc = run_command_internal(["cp", "--concurrency", str(concurrency), "--recursive", source_address, target_address])
+    try:
+        stdout, stderr = proc.communicate()
+    except BaseException:
+        proc.terminate()
+        raise
+    if proc.returncode == 0:
+        terminal.info(f"oras command successful: {stdout}")
+        return None
+    return f"{stderr.strip()}\n{error_message_from_stderr(stderr)}".strip()
+
 
 def pull_uenv(source_address, image_path, target):
-    # download the image using oras
+    """
+    Download the image using oras.
+    Returns the statistics of the pull, in the same form as registry.pull_uenv.
+    Raises OrasError if the image can't be pulled, so that the caller can
+    install the other images of a batch before reporting the failure.
+    """
+    start = time.monotonic()
     try:
         # run the oras command in a separate process so that this process can
         # draw a progress bar.
@@ -80,29 +115,33 @@ def pull_uenv(source_address, image_path, target):
             time.sleep(0.2)
 
         sqfs_path = image_path + "/store.squashfs"
-        total_mb = target.size/(1024*1024)
+        total = max(target.size, 1)
+        meter = progress.Throughput()
         while proc.poll() is None:
             time.sleep(1.0)
             if os.path.exists(sqfs_path) and terminal.is_tty():
                 current_size = os.path.getsize(sqfs_path)
-                current_mb = current_size / (1024*1024)
-                p = current_mb/total_mb
-                msg = f"{int(current_mb)}/{int(total_mb)} MB"
-                progress.progress_bar(p, width=50, msg=msg)
+                meter.update(current_size)
+                progress.progress_bar(current_size/total, width=50, msg=meter.message(current_size, total))
         stdout, stderr = proc.communicate()
         if proc.returncode == 0:
             # draw a final complete progress bar
-            progress.progress_bar(1.0, width=50, msg=f"{int(total_mb)}/{int(total_mb)} MB")
+            meter.update(target.size)
+            progress.progress_bar(1.0, width=50, msg=meter.message(total, total))
             terminal.stdout("")
             terminal.info(f"oras command successful: {stdout}")
-        else:
-            msg = error_message_from_stderr(stderr)
-            terminal.error(f"image pull failed: {stderr}\n{msg}")
+            host = source_address.split("/")[0]
+            return {"source": f"https://{host}", "method": "oras", "bytes": target.size,
+                    "seconds": time.monotonic() - start, "retries": 0}
+        msg = error_message_from_stderr(stderr)
+        raise OrasError(f"{stderr}\n{msg}".strip())
     except KeyboardInterrupt:
         proc.terminate()
         terminal.stdout("")
         terminal.error(f"image pull cancelled by user.")
+    except OrasError:
+        raise
     except Exception as e:
         proc.terminate()
         terminal.stdout("")
-        terminal.error(f"image pull failed with unknown exception: {e}")
+        raise OrasError(f"unknown exception: {e}")
@@ -1,5 +1,7 @@
+import collections
 import math
 import sys
+import time
 from terminal import colorize
 
 def progress_bar(progress: float, width=25, msg="", stream=sys.stdout):
@@ -33,3 +35,90 @@ def progress_bar(progress: float, width=25, msg="", stream=sys.stdout):
     # Use '\r' to return to the start of the line
     stream.write('\r  ' + bar + " " + pc_str + " " + msg)
     stream.flush()
+
+class ProgressDisplay():
+    """
+    Draws a progress bar for each of a number of concurrent tasks, one per line.
+    Each call to draw redraws the lines in place.
+    """
+    def __init__(self, labels, width=30, stream=sys.stdout):
+        self._labels = list(labels)
+        self._label_width = max([len(l) for l in self._labels] + [0])
+        self._progress = [(0., "")]*len(self._labels)
+        self._width = width
+        self._stream = stream
+        self._drawn = False
+
+    def update(self, index: int, progress: float, msg: str=""):
+        self._progress[index] = (progress, msg)
+
+    def draw(self):
+        # move the cursor back to the first line
+        if self._drawn:
+            self._stream.write(f"\033[{len(self._labels)}A")
+        for label, (progress, msg) in zip(self._labels, self._progress):
+            progress_bar(progress, width=self._width, msg=f"{label:<{self._label_width}} {msg}", stream=self._stream)
+            # clear the remainder of the line
+            self._stream.write("\033[K\n")
+        self._stream.flush()
+        self._drawn = True
+
+def format_duration(seconds: float) -> str:
+    """format a duration in seconds as h:mm:ss or m:ss"""
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+class Throughput():
+    """
+    Measures the rate of a transfer from samples of the number of bytes transferred.
+
+    The instantaneous rate is measured over the samples in a sliding window of
+    the last window seconds, and the average rate over the whole transfer.
+    """
+    def __init__(self, window: float=5.0):
+        self._window = window
+        self._start = time.monotonic()
+        self._samples = collections.deque([(self._start, 0)])
+
+    def update(self, transferred: int, now: float=None):
+        """record that transferred bytes have been transferred since the start"""
+        now = time.monotonic() if now is None else now
+        self._samples.append((now, transferred))
+        # keep one sample older than the window, so that the window is always covered
+        while len(self._samples) > 2 and self._samples[1][0] <= now - self._window:
+            self._samples.popleft()
+
+    @property
+    def elapsed(self) -> float:
+        return self._samples[-1][0] - self._start
+
+    @property
+    def rate(self) -> float:
+        """the rate in bytes/second over the sliding window"""
+        (t0, b0), (t1, b1) = self._samples[0], self._samples[-1]
+        return (b1 - b0)/(t1 - t0) if t1 > t0 else 0.
+
+    @property
+    def average(self) -> float:
+        """the rate in bytes/second since the start of the transfer"""
+        elapsed = self.elapsed
+        return self._samples[-1][1]/elapsed if elapsed > 0 else 0.
+
+    def eta(self, remaining: int) -> float:
+        """the estimated number of seconds to transfer remaining bytes, or None if unknown"""
+        rate = self.rate or self.average
+        return remaining/rate if rate > 0 else None
+
+    def message(self, done: int, total: int) -> str:
+        """
+        A progress message, e.g. "120/500 MB 45.2 MB/s (avg 40.1 MB/s) ETA 0:08".
+        done may include bytes that were not transferred, e.g. those of a resumed download.
+        """
+        mb = 1024*1024
+        eta = self.eta(max(total - done, 0))
+        return (f"{int(done/mb)}/{int(total/mb)} MB {self.rate/mb:.1f} MB/s (avg {self.average/mb:.1f} MB/s)"
+                + (f" ETA {format_duration(eta)}" if eta is not None else ""))
@@ -1,6 +1,15 @@
 from datetime import datetime, timezone
 
+import names
+
 class Record:
+    # Catalogs hold hundreds of thousands of records, so the fields are stored in
+    # slots instead of a __dict__ per record. Records are ordered by sort_key,
+    # which is computed the first time that it is used, and reset if the tag is
+    # modified. Versions and tags are compared in version order, so that 24.10
+    # follows 24.2.
+    __slots__ = ("_system", "_uarch", "_name", "_version", "_tag", "_date", "_bytes", "_sha256", "_id", "_key")
+
     @staticmethod
     def to_datetime(date: str):
         # In Python 3.6, datetime.fromisoformat is not available.
@@ -8,6 +17,17 @@ class Record:
         dt_format = '%Y-%m-%dT%H:%M:%S.%fZ'
         return datetime.strptime(date, dt_format).replace(tzinfo=timezone.utc)
 
+    @staticmethod
+    def to_datestring(date: str):
+        # Equivalent to str(Record.to_datetime(date)), which is the format of dates
+        # stored in the database, without the cost of strptime for each record.
+        # e.g. "2023-12-04T09:05:44.034Z" -> "2023-12-04 09:05:44.034000+00:00"
+        if len(date)==24 and date[10]=="T" and date[19]=="." and date[23]=="Z":
+            if date[20:23]=="000":
+                return f"{date[:10]} {date[11:19]}+00:00"
+            return f"{date[:10]} {date[11:23]}000+00:00"
+        return str(Record.to_datetime(date))
+
 
     def __init__(self, system: str, uarch: str, name: str, version: str, tag: str, date: str, size_bytes: int, sha256: str):
         self._system  = system
@@ -19,6 +39,7 @@ class Record:
         self._bytes   = size_bytes
         self._sha256  = sha256
         self._id      = sha256[:16]
+        self._key     = None
 
     # build/eiger/zen2/cp2k/2023/1133706947
     @classmethod
@@ -36,19 +57,7 @@ class Record:
         return self.sha256==other.sha256
 
     def __lt__(self, other):
-        if self.system  < other.system: return True
-        if other.system < self.system: return False
-        if self.uarch   < other.uarch: return True
-        if other.uarch  < self.uarch: return False
-        if self.name    < other.name: return True
-        if other.name   < self.name: return False
-        if self.version < other.version: return True
-        if other.version< self.version: return False
-        if self.tag     < other.tag: return True
-        if other.tag    < self.tag: return False
-        if self.id      < other.id: return True
-        if other.id     < self.id: return False
-        return False
+        return self.sort_key < other.sort_key
 
     def __str__(self):
         return f"{self.system}/{self.uarch}/{self.name}/{self.version}:{self.tag}/{self.sha256}"
@@ -83,6 +92,15 @@ class Record:
     @tag.setter
     def tag(self, newtag):
         self._tag = newtag
+        self._key = None
+
+    @property
+    def sort_key(self) -> tuple:
+        """the fields that records are ordered by: system, uarch, name, version, tag and id"""
+        if self._key is None:
+            self._key = (self._system, self._uarch, self._name,
+                         names.version_key(self._version), names.version_key(self._tag), self._id)
+        return self._key
 
     @property
     def sha256(self):
@@ -106,7 +124,7 @@ class Record:
                 "system": self.system,
                 "uarch": self.uarch,
                 "name": self.name,
-                "date": self.datestring,
+                "date": self.date,
                 "version": self.version,
                 "tag": self.tag,
                 "sha256": self.sha256,
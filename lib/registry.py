@@ -0,0 +1,796 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+import re
+import shutil
+import tarfile
+import threading
+import time
+
+import requests
+
+import httpclient
+import progress
+import terminal
+import verify
+
+# A minimal OCI distribution client for pulling uenv images.
+#
+# An image pushed by oras is an OCI manifest with one layer per file:
+#
+#   store.squashfs   the squashfs image, stored as a plain blob
+#   meta             the meta data directory, stored as a gzipped tar archive
+#                    with the io.deis.oras.content.unpack annotation
+#
+# Each layer is named by its org.opencontainers.image.title annotation. Large
+# blobs are downloaded with concurrent HTTP range requests, each of which
+# writes its part of the blob into a preallocated file with os.pwrite.
+
+# the default number of concurrent range requests
+default_concurrency = 8
+
+# the default size of each range request in MB
+default_chunk_size = 64
+
+# the default number of images that are downloaded at the same time
+default_parallel = 2
+
+# the default number of seconds to wait for another pull of the same image
+default_lock_timeout = 3600.0
+
+manifest_media_types = ", ".join([
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+])
+
+# the file in the image path that records the progress of a pull
+state_file = ".pull.json"
+
+title_annotation = verify.title_annotation
+unpack_annotation = verify.unpack_annotation
+
+class RegistryError(Exception):
+    """Exception raised when an image can't be pulled from the registry."""
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return self.message
+
+def pull_concurrency() -> int:
+    """the number of concurrent range requests, set with UENV_PULL_CONCURRENCY"""
+    value = os.environ.get("UENV_PULL_CONCURRENCY")
+    try:
+        return max(1, int(value)) if value else default_concurrency
+    except ValueError:
+        terminal.warning(f"invalid UENV_PULL_CONCURRENCY={value}, using {default_concurrency}")
+        return default_concurrency
+
+def pull_chunk_size() -> int:
+    """the size of range requests in bytes, set in MB with UENV_PULL_CHUNK_SIZE"""
+    value = os.environ.get("UENV_PULL_CHUNK_SIZE")
+    try:
+        mb = max(1, int(value)) if value else default_chunk_size
+    except ValueError:
+        terminal.warning(f"invalid UENV_PULL_CHUNK_SIZE={value}, using {default_chunk_size}")
+        mb = default_chunk_size
+    return mb*1024*1024
+
+def pull_parallel() -> int:
+    """the number of images that are downloaded at the same time, set with UENV_PULL_PARALLEL"""
+    value = os.environ.get("UENV_PULL_PARALLEL")
+    try:
+        return max(1, int(value)) if value else default_parallel
+    except ValueError:
+        terminal.warning(f"invalid UENV_PULL_PARALLEL={value}, using {default_parallel}")
+        return default_parallel
+
+def pull_lock_timeout() -> float:
+    """
+    The number of seconds to wait for another pull of the same image to finish,
+    set with UENV_PULL_LOCK_TIMEOUT
+    """
+    value = os.environ.get("UENV_PULL_LOCK_TIMEOUT")
+    try:
+        return max(0., float(value)) if value else default_lock_timeout
+    except ValueError:
+        terminal.warning(f"invalid UENV_PULL_LOCK_TIMEOUT={value}, using {default_lock_timeout:.0f}")
+        return default_lock_timeout
+
+def parse_rate(rate: str) -> float:
+    """
+    Parse a download rate in bytes per second, with an optional K, M or G
+    suffix, e.g. 500K or 1.5G. Raises ValueError if rate is invalid.
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    rate = rate.strip().upper().rstrip("B")
+    scale = 1
+    if rate and rate[-1] in units:
+        scale = units[rate[-1]]
+        rate = rate[:-1]
+    value = float(rate) * scale
+    if value <= 0:
+        raise ValueError(f"the download rate must be positive")
+    return value
+
+def pull_rate_limit() -> float:
+    """the aggregate download rate limit in bytes per second, set with UENV_PULL_RATE_LIMIT"""
+    value = os.environ.get("UENV_PULL_RATE_LIMIT")
+    if not value:
+        return None
+    try:
+        return parse_rate(value)
+    except ValueError:
+        terminal.warning(f"invalid UENV_PULL_RATE_LIMIT={value}, the download rate is not limited")
+        return None
+
+class RateLimiter():
+    """
+    A token bucket shared by concurrent downloads, that limits their aggregate
+    rate to rate bytes per second, with bursts of up to one second.
+    """
+
+    def __init__(self, rate: float):
+        self._rate = rate
+        self._tokens = rate
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n: int):
+        """take n bytes from the bucket, sleeping until they are available"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._rate, self._tokens + (now - self._time)*self._rate)
+            self._time = now
+            # the bucket can go into debt, which the next callers wait for
+            self._tokens -= n
+            wait = -self._tokens/self._rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+def parse_address(address: str) -> tuple:
+    """
+    Split an image address into (host, repository, reference), e.g.
+    jfrog.svc.cscs.ch/uenv/deploy/santis/gh200/prgenv-gnu/24.2:v2 ->
+    ("jfrog.svc.cscs.ch", "uenv/deploy/santis/gh200/prgenv-gnu/24.2", "v2")
+    """
+    host, _, path = address.partition("/")
+    if not path:
+        raise RegistryError(f"invalid image address {address}")
+    if "@" in path:
+        repository, _, reference = path.partition("@")
+    else:
+        repository, sep, reference = path.rpartition(":")
+        if not sep or "/" in reference:
+            repository, reference = path, "latest"
+    return (host, repository, reference)
+
+def docker_credentials(host: str) -> str:
+    """
+    The base64 encoded user:password for host in the docker/oras config file,
+    or None if there are no credentials stored in the file.
+    """
+    path = os.environ.get("DOCKER_CONFIG", os.path.expanduser("~/.docker")) + "/config.json"
+    try:
+        with open(path) as fid:
+            auths = json.load(fid).get("auths", {})
+    except (OSError, ValueError):
+        return None
+    for key in [host, "https://" + host]:
+        auth = auths.get(key, {}).get("auth")
+        if auth:
+            return auth
+    return None
+
+def _parse_challenge(header: str) -> tuple:
+    """parse a WWW-Authenticate header into (scheme, parameters)"""
+    scheme, _, rest = header.partition(" ")
+    params = dict(re.findall(r'(\w+)="([^"]*)"', rest))
+    return (scheme.lower(), params)
+
+class Registry():
+    def __init__(self, url: str, concurrency: int=None, chunk_size: int=None, credentials: str=None,
+                 limiter=None):
+        """
+        url:         the base URL of the registry, e.g. https://jfrog.svc.cscs.ch
+        concurrency: the number of concurrent range requests
+        chunk_size:  the size of each range request in bytes
+        credentials: base64 encoded user:password used to authenticate
+        limiter:     a RateLimiter that limits the download rate
+        """
+        self._url = url.rstrip("/")
+        self._concurrency = pull_concurrency() if concurrency is None else concurrency
+        self._chunk_size = pull_chunk_size() if chunk_size is None else chunk_size
+        self._credentials = credentials
+        self._limiter = limiter
+        self._client = httpclient.Client(pool_size=self._concurrency, timeout=(5.0, 60.0))
+        self._auth = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._downloaded = 0
+        self._transferred = 0
+        self._resumed_ranges = 0
+        self._total = 0
+
+    def _login(self, repository: str):
+        """obtain the Authorization header for pulling from repository"""
+        try:
+            self._authenticate(repository)
+        except (requests.RequestException, ValueError) as err:
+            raise RegistryError(f"unable to authenticate with {self._url}: {str(err)}")
+
+    def _authenticate(self, repository: str):
+        response = self._client.session.get(f"{self._url}/v2/", timeout=(5.0, 30.0))
+        response.close()
+        if response.status_code != 401:
+            return
+        scheme, params = _parse_challenge(response.headers.get("WWW-Authenticate", ""))
+        if scheme == "basic":
+            if self._credentials is None:
+                raise RegistryError(f"{self._url} requires credentials")
+            self._auth = "Basic " + self._credentials
+        elif scheme == "bearer" and "realm" in params:
+            query = {"scope": f"repository:{repository}:pull"}
+            if "service" in params:
+                query["service"] = params["service"]
+            headers = {}
+            if self._credentials is not None:
+                headers["Authorization"] = "Basic " + self._credentials
+            token = self._client.session.get(params["realm"], params=query, headers=headers, timeout=(5.0, 30.0))
+            if token.status_code != 200:
+                raise RegistryError(f"unable to obtain a token from {params['realm']}: HTTP {token.status_code}")
+            body = token.json()
+            self._auth = "Bearer " + (body.get("token") or body.get("access_token"))
+        else:
+            raise RegistryError(f"unsupported authentication scheme for {self._url}")
+
+    def _get(self, repository: str, url: str, headers: dict={}, stream: bool=False):
+        headers = dict(headers)
+        if self._auth is not None:
+            headers["Authorization"] = self._auth
+        try:
+            return self._client.get(url, headers=headers, stream=stream)
+        except httpclient.RequestError as err:
+            if err.status != 401:
+                raise RegistryError(str(err))
+        # the token has expired or was never obtained
+        self._login(repository)
+        if self._auth is not None:
+            headers["Authorization"] = self._auth
+        try:
+            return self._client.get(url, headers=headers, stream=stream)
+        except httpclient.RequestError as err:
+            raise RegistryError(str(err))
+
+    def manifest(self, repository: str, reference: str) -> bytes:
+        """download the manifest of repository:reference"""
+        url = f"{self._url}/v2/{repository}/manifests/{reference}"
+        return self._get(repository, url, {"Accept": manifest_media_types}).content
+
+    def _download_range(self, repository: str, url: str, fd: int, start: int, end: int, response=None) -> bool:
+        """
+        Download bytes start..end (inclusive) of a blob to the same offset in fd.
+        Returns False if the download was cancelled before the range was complete.
+        A response that ends before the end of the range, e.g. because the
+        connection drops, is a failed attempt, and the range is resumed from
+        the last byte written. Raises RegistryError after 3 failed attempts.
+        """
+        offset = start
+        attempt = 0
+        while offset <= end:
+            if self._cancel.is_set():
+                return False
+            if response is None:
+                response = self._get(repository, url, {"Range": f"bytes={offset}-{end}"}, stream=True)
+            received = offset
+            error = None
+            try:
+                if response.status_code != 206:
+                    raise RegistryError(f"{url} does not support range requests")
+                for data in response.iter_content(chunk_size=1024*1024):
+                    if self._cancel.is_set():
+                        return False
+                    if self._limiter is not None:
+                        self._limiter.consume(len(data))
+                    os.pwrite(fd, data, offset)
+                    offset += len(data)
+                    with self._lock:
+                        self._downloaded += len(data)
+                        self._transferred += len(data)
+            except requests.RequestException as err:
+                error = str(err)
+            finally:
+                response.close()
+                response = None
+            if offset > end:
+                break
+            if error is None:
+                error = f"the response ended after {offset - received} bytes"
+            attempt += 1
+            if attempt > 3:
+                raise RegistryError(f"downloading {url} bytes {offset}-{end}: {error}")
+            with self._lock:
+                self._resumed_ranges += 1
+            terminal.info(f"downloading {url} bytes {offset}-{end}: {error} - resuming")
+        return True
+
+    def _download_stream(self, repository: str, url: str, fd: int, response=None) -> bool:
+        """
+        Download a complete blob to fd with a single request.
+        Returns False if the download was cancelled.
+        """
+        if response is None:
+            response = self._get(repository, url, stream=True)
+        try:
+            offset = 0
+            for data in response.iter_content(chunk_size=1024*1024):
+                if self._cancel.is_set():
+                    return False
+                if self._limiter is not None:
+                    self._limiter.consume(len(data))
+                os.pwrite(fd, data, offset)
+                offset += len(data)
+                with self._lock:
+                    self._downloaded += len(data)
+                    self._transferred += len(data)
+            return True
+        except requests.RequestException as err:
+            raise RegistryError(f"downloading {url}: {str(err)}")
+        finally:
+            response.close()
+
+    def download_blob(self, repository: str, digest: str, size: int, path: str, state=None):
+        """
+        Download the blob digest of size bytes to path, and verify its digest.
+
+        Blobs larger than the chunk size are downloaded with concurrent range
+        requests, unless the registry does not support range requests. If a
+        PullState is provided, the completed ranges are recorded in it, and
+        ranges that were completed by an earlier pull are not downloaded again.
+        """
+        url = f"{self._url}/v2/{repository}/blobs/{digest}"
+        ranged = size > self._chunk_size and self._concurrency > 1
+        completed = []
+        if state is not None:
+            if ranged and os.path.exists(path):
+                completed = state.ranges(digest, size)
+            else:
+                state.reset(digest, size)
+        missing = _missing_ranges(completed, size, self._chunk_size)
+        with self._lock:
+            self._downloaded += size - sum(end-start+1 for start, end in missing)
+
+        flags = os.O_WRONLY | os.O_CREAT | (0 if completed else os.O_TRUNC)
+        fd = os.open(path, flags, 0o644)
+        try:
+            if not completed and size > 0:
+                if hasattr(os, "posix_fallocate"):
+                    try:
+                        os.posix_fallocate(fd, 0, size)
+                    except OSError:
+                        os.ftruncate(fd, size)
+                else:
+                    os.ftruncate(fd, size)
+
+            if not ranged:
+                if not self._download_stream(repository, url, fd):
+                    return False
+            elif missing:
+                # the first range is requested on its own, to check that the
+                # registry supports range requests
+                start, end = missing[0]
+                first = self._get(repository, url, {"Range": f"bytes={start}-{end}"}, stream=True)
+                if first.status_code != 206:
+                    terminal.info(f"{url} does not support range requests")
+                    with self._lock:
+                        self._downloaded -= size - sum(e-s+1 for s, e in missing)
+                    if state is not None:
+                        state.reset(digest, size)
+                    if not self._download_stream(repository, url, fd, first):
+                        return False
+                elif not self._download_ranges(repository, url, fd, missing, digest, state, first):
+                    return False
+        finally:
+            os.close(fd)
+
+        try:
+            _verify_digest(path, digest)
+        except RegistryError:
+            if state is not None:
+                state.reset(digest, size)
+            raise
+        return True
+
+    def _download_ranges(self, repository: str, url: str, fd: int, ranges: list, digest: str, state, first) -> bool:
+        """download ranges of a blob concurrently, where first is the response for the first range"""
+        def download(index, start, end):
+            if not self._download_range(repository, url, fd, start, end, first if index == 0 else None):
+                return False
+            if state is not None:
+                state.add_range(digest, start, end)
+            return True
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            futures = [executor.submit(download, index, start, end) for index, (start, end) in enumerate(ranges)]
+            try:
+                return all(future.result() for future in futures)
+            except BaseException:
+                self._cancel.set()
+                raise
+
+    def pull(self, repository: str, reference: str, image_path: str, total_size: int=None, digest: str=None,
+             stamps: verify.Stamps=None, show_progress: bool=True):
+        """
+        Pull the image repository:reference into the directory image_path.
+
+        If digest is provided, the sha256 digest of the manifest must match.
+        The digest of every file is checked after it is downloaded, and recorded
+        in stamps if provided.
+        The progress of the pull is recorded in image_path, and if image_path
+        contains a partial pull of the same image, the pull is resumed.
+        If show_progress is set, a progress bar is drawn if stdout is a terminal.
+
+        Returns the statistics of the pull, see Registry.statistics.
+        """
+        start = time.monotonic()
+        retries = self._client.stats["retries"]
+        raw = self.manifest(repository, reference)
+        manifest_digest = hashlib.sha256(raw).hexdigest()
+        if digest is not None and manifest_digest != digest:
+            raise RegistryError(f"the digest of {repository}:{reference} is {manifest_digest}, expected {digest}")
+        try:
+            manifest = json.loads(raw)
+        except ValueError:
+            raise RegistryError(f"invalid manifest for {repository}:{reference}")
+        layers = manifest.get("layers", [])
+        if not layers:
+            raise RegistryError(f"{repository}:{reference} has no layers")
+        for layer in layers:
+            title = layer.get("annotations", {}).get(title_annotation)
+            if not title or "/" in title or title.startswith("."):
+                raise RegistryError(f"{repository}:{reference} has a layer with an invalid title {title}")
+
+        state = PullState(image_path, manifest_digest)
+        with open(image_path + "/manifest.json", "wb") as fid:
+            fid.write(raw)
+
+        self._cancel.clear()
+        self._downloaded = 0
+        self._transferred = 0
+        self._resumed_ranges = 0
+        self._total = total_size or sum(layer["size"] for layer in layers)
+        terminal.info(f"pulling {repository}:{reference} from {self._url} with {self._concurrency} concurrent requests")
+
+        if not show_progress:
+            self._pull_layers(repository, layers, image_path, state, stamps, manifest_digest)
+            return self.statistics(time.monotonic() - start, self._client.stats["retries"] - retries)
+
+        done = threading.Event()
+        error = []
+
+        def download():
+            try:
+                self._pull_layers(repository, layers, image_path, state, stamps, manifest_digest)
+            except BaseException as err:
+                error.append(err)
+            finally:
+                done.set()
+
+        worker = threading.Thread(target=download, daemon=True)
+        worker.start()
+        total = max(self._total, 1)
+        meter = progress.Throughput()
+        try:
+            while not done.wait(1.0):
+                meter.update(self._transferred)
+                if terminal.is_tty():
+                    progress.progress_bar(self._downloaded/total, width=50, msg=meter.message(self._downloaded, total))
+        except KeyboardInterrupt:
+            # the download threads stop at the next chunk, and the pull can be resumed
+            self._cancel.set()
+            raise
+        if error:
+            raise error[0]
+        meter.update(self._transferred)
+        if terminal.is_tty():
+            progress.progress_bar(1.0, width=50, msg=meter.message(total, total))
+            terminal.stdout("")
+        return self.statistics(time.monotonic() - start, self._client.stats["retries"] - retries)
+
+    def statistics(self, seconds: float, retries: int=0) -> dict:
+        """
+        The statistics of the current pull: the source registry, the number of
+        bytes transferred (excluding those of a resumed pull), the wall time in
+        seconds, and the number of requests that were retried or resumed.
+        """
+        return {"source": self._url, "method": "native", "bytes": self._transferred,
+                "seconds": seconds, "retries": retries + self._resumed_ranges}
+
+    @property
+    def progress(self) -> tuple:
+        """the number of bytes downloaded and the total size of the current pull"""
+        return (self._downloaded, self._total)
+
+    @property
+    def transferred(self) -> int:
+        """the number of bytes downloaded from the registry by the current pull"""
+        return self._transferred
+
+    def cancel(self):
+        """stop the current pull at the next chunk, so that it can be resumed later"""
+        self._cancel.set()
+
+    def _pull_layers(self, repository: str, layers: list, image_path: str, state, stamps, manifest_digest):
+        for layer in layers:
+            if not self._pull_layer(repository, layer, image_path, state, stamps, manifest_digest):
+                return
+        state.finish()
+
+    def _pull_layer(self, repository: str, layer: dict, image_path: str, state, stamps, manifest_digest) -> bool:
+        annotations = layer.get("annotations", {})
+        title = annotations[title_annotation]
+        digest = layer["digest"]
+        if state.is_complete(digest):
+            terminal.info(f"{title} was downloaded by an earlier pull")
+            with self._lock:
+                self._downloaded += layer["size"]
+            return True
+
+        start = time.perf_counter()
+        if annotations.get(unpack_annotation) == "true":
+            # directories are stored as archives that are unpacked in image_path
+            archive = f"{image_path}/.{title}.tar"
+            if not self.download_blob(repository, digest, layer["size"], archive, state):
+                return False
+            try:
+                _extract(archive, image_path)
+            finally:
+                os.remove(archive)
+        else:
+            path = f"{image_path}/{title}"
+            if not self.download_blob(repository, digest, layer["size"], path, state):
+                return False
+            if stamps is not None and digest.startswith("sha256:"):
+                stamps.add(f"{manifest_digest}/{title}", path, digest[len("sha256:"):])
+        state.set_complete(digest)
+        seconds = time.perf_counter() - start
+        terminal.info(f"downloaded {title} ({layer['size']} bytes) in {seconds:.2f}s")
+        return True
+
+class PullState():
+    """
+    The progress of a pull, stored in image_path/.pull.json so that a pull that
+    was interrupted can be resumed:
+
+        {
+            "digest": the digest of the manifest of the image,
+            "layers": {
+                layer digest: {"size": bytes, "ranges": [[start, end], ...], "complete": bool},
+                ...
+            }
+        }
+
+    If image_path holds anything other than a partial pull of the same image,
+    it is cleared.
+    """
+
+    def __init__(self, image_path: str, digest: str):
+        self._path = image_path + "/" + state_file
+        self._lock = threading.Lock()
+        state = None
+        try:
+            with open(self._path) as fid:
+                state = json.load(fid)
+        except (OSError, ValueError):
+            pass
+
+        self.resumed = state is not None and state.get("digest") == digest
+        if self.resumed:
+            self._state = state
+            terminal.info(f"resuming the pull in {image_path}")
+        else:
+            if os.path.exists(image_path):
+                terminal.info(f"removing existing path {image_path}")
+                shutil.rmtree(image_path)
+            os.makedirs(image_path)
+            self._state = {"digest": digest, "layers": {}}
+            self._save()
+
+    def _save(self):
+        tmp = self._path + ".tmp"
+        with open(tmp, "w") as fid:
+            json.dump(self._state, fid)
+        os.replace(tmp, self._path)
+
+    def _layer(self, digest: str, size: int=0) -> dict:
+        return self._state["layers"].setdefault(digest, {"size": size, "ranges": [], "complete": False})
+
+    def ranges(self, digest: str, size: int) -> list:
+        """the ranges of the blob digest that have been downloaded"""
+        with self._lock:
+            layer = self._layer(digest, size)
+            if layer["size"] != size:
+                layer.update({"size": size, "ranges": [], "complete": False})
+            return [tuple(r) for r in layer["ranges"]]
+
+    def add_range(self, digest: str, start: int, end: int):
+        with self._lock:
+            self._layer(digest)["ranges"].append([start, end])
+            self._save()
+
+    def reset(self, digest: str, size: int):
+        """discard the ranges of the blob digest that have been downloaded"""
+        with self._lock:
+            self._layer(digest).update({"size": size, "ranges": [], "complete": False})
+            self._save()
+
+    def is_complete(self, digest: str) -> bool:
+        with self._lock:
+            return self._state["layers"].get(digest, {}).get("complete", False)
+
+    def set_complete(self, digest: str):
+        with self._lock:
+            self._layer(digest).update({"ranges": [], "complete": True})
+            self._save()
+
+    def finish(self):
+        """remove the state once all layers have been downloaded and verified"""
+        os.remove(self._path)
+
+def is_partial_pull(image_path: str) -> bool:
+    """whether image_path holds a pull that was interrupted"""
+    return os.path.isfile(image_path + "/" + state_file)
+
+def _missing_ranges(completed: list, size: int, chunk_size: int) -> list:
+    """the ranges of a blob of size bytes not in completed, split into chunks"""
+    gaps = []
+    pos = 0
+    for start, end in sorted(completed):
+        if start > pos:
+            gaps.append((pos, start-1))
+        pos = max(pos, end+1)
+    if pos < size:
+        gaps.append((pos, size-1))
+    return [(start, min(start+chunk_size, end+1)-1)
+            for gap_start, end in gaps
+            for start in range(gap_start, end+1, chunk_size)]
+
+def _verify_digest(path: str, digest: str):
+    """check the digest of a downloaded blob, removing it if it does not match"""
+    algorithm, _, expected = digest.partition(":")
+    if algorithm != "sha256":
+        terminal.info(f"unable to verify {path} with digest {digest}")
+        return
+    sha = verify.file_sha256(path)
+    if sha != expected:
+        os.remove(path)
+        raise RegistryError(f"the sha256 of {path} is {sha}, expected {expected}")
+
+def _extract(archive: str, path: str):
+    """extract a tar archive in path, refusing entries that would be written outside path"""
+    root = pathlib.Path(path).resolve()
+    try:
+        with tarfile.open(archive) as tar:
+            for member in tar.getmembers():
+                target = (root / member.name).resolve()
+                outside = root != target and root not in target.parents
+                if member.issym() or member.islnk():
+                    outside = outside or os.path.isabs(member.linkname) or ".." in member.linkname.split("/")
+                if outside:
+                    raise RegistryError(f"refusing to extract {member.name} from {archive}")
+            tar.extractall(root.as_posix())
+    except tarfile.TarError as err:
+        raise RegistryError(f"unable to extract {archive}: {str(err)}")
+
+def _open(source_address: str, **kwargs) -> tuple:
+    """
+    Return (registry, repository, reference) for an image address. The registry
+    is accessed with https, unless the address starts with http://.
+    """
+    scheme = "https"
+    for prefix in ["http", "https"]:
+        if source_address.startswith(prefix + "://"):
+            scheme = prefix
+            source_address = source_address[len(prefix + "://"):]
+    host, repository, reference = parse_address(source_address)
+    registry = Registry(f"{scheme}://{host}", credentials=docker_credentials(host), **kwargs)
+    return (registry, repository, reference)
+
+def pull_uenv(source_address: str, image_path: str, target, stamps: verify.Stamps=None, rate_limit: float=None):
+    """
+    Pull the image at source_address into image_path, with the same interface
+    as oras.pull_uenv. Raises RegistryError if the image can't be pulled.
+    Returns the statistics of the pull.
+    """
+    registry, repository, reference = _open(source_address, limiter=RateLimiter(rate_limit) if rate_limit else None)
+    return registry.pull(repository, reference, image_path, target.size, target.sha256, stamps)
+
+def pull_many(images: list, parallel: int=None, rate_limit: float=None, stamps: verify.Stamps=None) -> dict:
+    """
+    Pull several images concurrently, where images is a list of tuples
+    (source_address, image_path, target, label).
+
+    At most parallel images are downloaded at the same time, the range requests
+    of all images share UENV_PULL_CONCURRENCY connections, and the aggregate
+    download rate is limited to rate_limit bytes per second. The progress of
+    each image is drawn on its own line if stdout is a terminal.
+
+    Returns a tuple (errors, statistics), where errors maps the index of each
+    image that could not be pulled to the RegistryError that was raised, and
+    statistics maps the index of each image that was pulled to the statistics
+    of its pull.
+    """
+    parallel = min(parallel or pull_parallel(), len(images))
+    concurrency = max(1, pull_concurrency()//parallel)
+    limiter = RateLimiter(rate_limit) if rate_limit else None
+    terminal.info(f"pulling {len(images)} images, {parallel} at a time with {concurrency} requests each"
+                  + (f", limited to {rate_limit/(1024*1024):.1f} MB/s" if limiter else ""))
+
+    registries = [None]*len(images)
+    meters = [None]*len(images)
+    status = ["waiting"]*len(images)
+    errors = {}
+    statistics = {}
+
+    def pull(index):
+        source_address, image_path, target, _ = images[index]
+        try:
+            status[index] = "downloading"
+            registry, repository, reference = _open(source_address, concurrency=concurrency, limiter=limiter)
+            meters[index] = progress.Throughput()
+            registries[index] = registry
+            statistics[index] = registry.pull(repository, reference, image_path, target.size, target.sha256,
+                                              stamps, show_progress=False)
+            status[index] = "done"
+        except RegistryError as err:
+            status[index] = "failed"
+            errors[index] = err
+
+    display = progress.ProgressDisplay([label for _, _, _, label in images]) if terminal.is_tty() else None
+
+    def draw():
+        if display is None:
+            return
+        for index, (_, _, target, _) in enumerate(images):
+            registry = registries[index]
+            downloaded, total = registry.progress if registry is not None else (0, 0)
+            total = max(total or target.size, 1)
+            if registry is None:
+                msg = f"0/{int(total/(1024*1024))} MB {status[index]}"
+            else:
+                if status[index] == "downloading":
+                    meters[index].update(registry.transferred)
+                msg = f"{meters[index].message(downloaded, total)} {status[index]}"
+            display.update(index, downloaded/total, msg)
+        display.draw()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [executor.submit(pull, index) for index in range(len(images))]
+        try:
+            while concurrent.futures.wait(futures, timeout=0.5).not_done:
+                draw()
+        except KeyboardInterrupt:
+            # stop the downloads at the next chunk, so that they can be resumed
+            for future in futures:
+                future.cancel()
+            for registry in registries:
+                if registry is not None:
+                    registry.cancel()
+            raise
+    draw()
+    for future in futures:
+        future.result()
+    return (errors, statistics)
+
+def save_manifest(source_address: str, image_path: str):
+    """
+    Download the manifest of the image at source_address to image_path, so
+    that an image pulled with oras can be verified.
+    """
+    registry, repository, reference = _open(source_address)
+    with open(image_path + "/manifest.json", "wb") as fid:
+        fid.write(registry.manifest(repository, reference))
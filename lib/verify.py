@@ -0,0 +1,166 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+
+import terminal
+
+# The sha256 of an image in the registry catalog, and in index.db, is the
+# digest of its OCI manifest. The manifest is stored as manifest.json in the
+# image path when the image is pulled, and it lists the digest of every file in
+# the image. An image is verified by checking the digest of manifest.json,
+# followed by the digest of each file listed in the manifest.
+#
+# Hashing a multi-GB squashfs file takes seconds, so the result of each check is
+# recorded as a stamp in $repo/verified.json, keyed by the inode, size and
+# modification time of the file. Files whose stamp matches are not hashed again.
+# Stamps are named sha256/title, so that they remain valid when an image is
+# moved from the staging path to the image path.
+
+# the size of the buffer used to read files that are hashed
+buffer_size = 8*1024*1024
+
+title_annotation = "org.opencontainers.image.title"
+unpack_annotation = "io.deis.oras.content.unpack"
+
+# the status of an image after it has been verified
+OK = "ok"
+MISMATCH = "mismatch"
+MISSING = "missing"
+UNVERIFIED = "unverified"
+
+def file_sha256(path: str) -> str:
+    """the sha256 digest of a file, read with a large reusable buffer"""
+    sha = hashlib.sha256()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as fid:
+        while True:
+            n = fid.readinto(buffer)
+            if not n:
+                break
+            sha.update(view[:n])
+    return sha.hexdigest()
+
+def _stat_key(path: str) -> list:
+    st = os.stat(path)
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+class Stamps():
+    """The verification stamps of the files in a repository, stored in $repo/verified.json."""
+
+    def __init__(self, repo_path: str):
+        self._path = repo_path + "/verified.json"
+        try:
+            with open(self._path) as fid:
+                self._stamps = json.load(fid)
+        except (OSError, ValueError):
+            self._stamps = {}
+
+    def is_verified(self, key: str, path: str, digest: str) -> bool:
+        """whether path has been verified to have digest since it was last modified"""
+        stamp = self._stamps.get(key)
+        try:
+            return stamp is not None and stamp["digest"] == digest and stamp["stat"] == _stat_key(path)
+        except OSError:
+            return False
+
+    def add(self, key: str, path: str, digest: str):
+        self._stamps[key] = {"digest": digest, "stat": _stat_key(path)}
+
+    def remove(self, key: str):
+        self._stamps.pop(key, None)
+
+    def save(self):
+        tmp = f"{self._path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w") as fid:
+                json.dump(self._stamps, fid)
+            os.replace(tmp, self._path)
+        except OSError as err:
+            terminal.info(f"unable to save verification stamps {self._path}: {str(err)}")
+
+def image_files(image_path: str, sha256: str) -> tuple:
+    """
+    Check the manifest of the image in image_path against its sha256.
+
+    Returns a tuple (status, files), where files is a list of (key, path, sha256)
+    of the files to verify if status is OK.
+    """
+    manifest_path = image_path + "/manifest.json"
+    if not os.path.isdir(image_path):
+        return (MISSING, [])
+    if not os.path.isfile(manifest_path):
+        return (UNVERIFIED, [])
+    with open(manifest_path, "rb") as fid:
+        raw = fid.read()
+    if hashlib.sha256(raw).hexdigest() != sha256:
+        return (MISMATCH, [])
+
+    files = []
+    try:
+        for layer in json.loads(raw).get("layers", []):
+            annotations = layer.get("annotations", {})
+            title = annotations.get(title_annotation)
+            algorithm, _, digest = layer["digest"].partition(":")
+            # unpacked directories can't be compared with their archive
+            if not title or algorithm != "sha256" or annotations.get(unpack_annotation) == "true":
+                continue
+            path = f"{image_path}/{title}"
+            if not os.path.isfile(path):
+                return (MISSING, [])
+            files.append((f"{sha256}/{title}", path, digest))
+    except (ValueError, KeyError, AttributeError):
+        return (MISMATCH, [])
+    return (OK, files)
+
+def verify_image(image_path: str, sha256: str, stamps: Stamps=None) -> str:
+    """verify the image in image_path in this process, returning its status"""
+    status, files = image_files(image_path, sha256)
+    if status != OK:
+        return status
+    for key, path, digest in files:
+        if stamps is not None and stamps.is_verified(key, path, digest):
+            continue
+        if file_sha256(path) != digest:
+            if stamps is not None:
+                stamps.remove(key)
+            return MISMATCH
+        if stamps is not None:
+            stamps.add(key, path, digest)
+    return OK
+
+def verify_images(images: list, stamps: Stamps, jobs: int=None) -> dict:
+    """
+    Verify images in parallel, where images is a list of (image_path, sha256).
+
+    The files that do not have a valid stamp are hashed by a pool of jobs
+    processes. Returns a dictionary that maps each sha256 to its status.
+    """
+    results = {}
+    pending = {}
+    for image_path, sha256 in images:
+        status, files = image_files(image_path, sha256)
+        results[sha256] = status
+        if status != OK:
+            continue
+        for key, path, digest in files:
+            if stamps.is_verified(key, path, digest):
+                terminal.info(f"{path} was verified earlier")
+            else:
+                pending[path] = (key, sha256, digest)
+
+    if pending:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(file_sha256, path): path for path in pending}
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                key, sha256, digest = pending[path]
+                if future.result() == digest:
+                    stamps.add(key, path, digest)
+                else:
+                    stamps.remove(key)
+                    results[sha256] = MISMATCH
+
+    stamps.save()
+    return results
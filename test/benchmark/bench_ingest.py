@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+"""
+Compare the time to ingest synthetic catalogs into a DataStore one record at a
+time with add_record, and in a single transaction with add_records.
+
+    ./bench_ingest.py [n ...]
+"""
+
+import pathlib
+import sys
+import time
+
+prefix = pathlib.Path(__file__).parent.resolve()
+lib =  prefix.parent.parent / "lib"
+sys.path = [lib.as_posix()] + sys.path
+
+import datastore
+import synthetic
+
+def ingest_single(records):
+    store = datastore.DataStore()
+    for r in records:
+        store.add_record(r)
+    return store
+
+def ingest_bulk(records):
+    store = datastore.DataStore()
+    store.add_records(records)
+    return store
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [10000, 100000]
+
+    print(f"{'records':>10} {'add_record':>12} {'add_records':>12} {'speedup':>8}")
+    for n in sizes:
+        records = list(synthetic.records(n))
+
+        start = time.perf_counter()
+        ingest_single(records)
+        t_single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ingest_bulk(records)
+        t_bulk = time.perf_counter() - start
+
+        print(f"{n:>10} {t_single:>11.3f}s {t_bulk:>11.3f}s {t_single/t_bulk:>7.1f}x")
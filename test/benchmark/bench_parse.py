@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+Compare the time and peak memory required to load a synthetic catalog listing
+by parsing the full JSON document, and with the streaming jfrog.load_namespace.
+
+    ./bench_parse.py [n ...]
+
+Each measurement runs in a fresh process, so that the peak RSS is not shared.
+The peak RSS of the streaming loader is dominated by the in-memory databases.
+"""
+
+import json
+import os
+import pathlib
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+prefix = pathlib.Path(__file__).parent.resolve()
+lib =  prefix.parent.parent / "lib"
+sys.path = [lib.as_posix()] + sys.path
+
+import datastore
+import jfrog
+import record
+import synthetic
+
+def chunks(path):
+    with open(path, "rb") as fid:
+        while True:
+            chunk = fid.read(64*1024)
+            if not chunk:
+                return
+            yield chunk
+
+def load_json(path):
+    """the listing is parsed in full, and dates are parsed with strptime"""
+    listing = json.loads(b"".join(chunks(path)))
+    stores = {"deploy": [], "build": []}
+    for entry in listing["results"]:
+        namespace, rel = entry["path"].split("/", 1)
+        date = record.Record.to_datetime(entry["created"])
+        stores[namespace].append(record.Record.frompath(rel, date, entry["size"], entry["sha256"]))
+    deploy = datastore.DataStore()
+    deploy.add_records(stores["deploy"])
+    build = datastore.DataStore()
+    build.add_records(stores["build"])
+    return deploy, build
+
+def load_stream(path):
+    # each namespace is loaded separately, reading the listing twice
+    return jfrog.load_namespace(chunks(path), "deploy"), jfrog.load_namespace(chunks(path), "build")
+
+def write_listing(path, n):
+    # 1 in 50 entries is deployed
+    entries = [(p if i % 50 else p.replace("build/", "deploy/", 1), s, c)
+               for i, (p, s, c) in enumerate(synthetic.listing_entries(n))]
+    with open(path, "w") as fid:
+        json.dump(jfrog_listing(entries), fid, indent=2)
+
+def jfrog_listing(entries):
+    results = [{"repo": "uenv", "path": p, "name": "manifest.json", "created": c,
+                "size": "123683707", "sha256": s,
+                "stats": [{"downloaded": c, "downloads": 11}]} for p, s, c in entries]
+    return {"results": results, "range": {"start_pos": 0, "end_pos": len(results), "total": len(results)}}
+
+def peak_rss():
+    """peak resident set size of this process in kB"""
+    try:
+        with open("/proc/self/status") as fid:
+            for line in fid:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(method, path):
+    """run in a child process: print the wall time and peak RSS increase in MB"""
+    base_rss = peak_rss()
+    start = time.perf_counter()
+    deploy, build = {"json": load_json, "stream": load_stream}[method](path)
+    elapsed = time.perf_counter() - start
+    print(f"{elapsed} {(peak_rss() - base_rss)/1024}")
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    sizes = [int(n) for n in sys.argv[1:]] or [10000, 100000, 300000]
+
+    print(f"{'entries':>10} {'MB':>6} {'json time':>10} {'json rss':>9} {'stream time':>12} {'stream rss':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            path = os.path.join(tmp, f"listing-{n}.json")
+            write_listing(path, n)
+            size_mb = os.path.getsize(path)/(1024*1024)
+            results = {}
+            for method in ["json", "stream"]:
+                out = subprocess.run([sys.executable, __file__, "--measure", method, path],
+                                     stdout=subprocess.PIPE, check=True).stdout.decode()
+                results[method] = [float(x) for x in out.split()]
+            print(f"{n:>10} {size_mb:>6.0f} "
+                  f"{results['json'][0]:>9.2f}s {results['json'][1]:>6.0f} MB "
+                  f"{results['stream'][0]:>11.2f}s {results['stream'][1]:>8.0f} MB")
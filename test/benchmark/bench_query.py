@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""
+Compare the latency of DataStore lookups on a synthetic catalog, with the
+string-interpolated queries on a database without secondary indexes that
+DataStore used previously, and with find_records and get_record. The latest
+version of a uenv is found in the baseline by reading all of its versions.
+
+    ./bench_query.py [n ...]
+"""
+
+import pathlib
+import sys
+import time
+
+prefix = pathlib.Path(__file__).parent.resolve()
+lib =  prefix.parent.parent / "lib"
+sys.path = [lib.as_posix()] + sys.path
+
+import datastore
+import names
+import synthetic
+
+# each lookup is repeated for at least this many seconds
+duration = 0.5
+
+def lookups(n: int) -> dict:
+    """filters that match entries in the middle of a catalog of n records"""
+    system, uarch, name, version, tag = synthetic.fields(n//2)
+    sha = synthetic.sha(n//2)
+    return {
+        "name": {"name": name},
+        "name/version": {"name": name, "version": version},
+        "name/version:tag": {"name": name, "version": version, "tag": tag},
+        "system/uarch/name": {"system": system, "uarch": uarch, "name": name},
+        "name/latest": {"name": name, "version": names.latest_version},
+        "system/uarch/name/latest": {"system": system, "uarch": uarch, "name": name, "version": names.latest_version},
+        "tag": {"tag": tag},
+        "sha256": {"sha": sha},
+        "id": {"sha": sha[:16]},
+    }
+
+def baseline_find(store: datastore.DataStore, **constraints):
+    """the queries of find_records before they were parameterized"""
+    latest = constraints.get("version") == names.latest_version
+    if latest:
+        constraints = {field: value for field, value in constraints.items() if field != "version"}
+    if "sha" in constraints:
+        sha = constraints["sha"]
+        column = "id" if len(sha)<64 else "sha256"
+        items = store._store.execute(f"SELECT * FROM records WHERE {column} = '{sha}'")
+    else:
+        query_criteria = " AND ".join([f"{field} = '{value}'" for field, value in constraints.items()])
+        items = store._store.execute(f"SELECT * FROM records WHERE {query_criteria}")
+    results = [store.to_record(r) for r in items]
+    if latest:
+        newest = {}
+        for r in results:
+            uenv = (r.system, r.uarch, r.name)
+            newest[uenv] = max(newest.get(uenv, ""), names.version_key(r.version))
+        results = [r for r in results if names.version_key(r.version) == newest[(r.system, r.uarch, r.name)]]
+    results.sort(reverse=True)
+    return datastore.RecordSet(results, "baseline").records
+
+def indexed_find(store: datastore.DataStore, **constraints):
+    return store.find_records(**constraints).records
+
+def measure(find, store, constraints) -> float:
+    """the mean latency of a lookup in microseconds"""
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        find(store, **constraints)
+        count += 1
+    return 1e6*(time.perf_counter() - start)/count
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [100000]
+
+    for n in sizes:
+        indexed = datastore.DataStore()
+        indexed.add_records(synthetic.records(n))
+        baseline = datastore.DataStore()
+        baseline.add_records(synthetic.records(n))
+        for index in datastore.indexes:
+            baseline._store.execute(f"DROP INDEX {index}")
+
+        print(f"{n} records, mean latency of each lookup")
+        print(f"{'filter':>24} {'baseline':>12} {'indexed':>12} {'speedup':>8}")
+        for label, constraints in lookups(n).items():
+            assert len(baseline_find(baseline, **constraints)) == len(indexed_find(indexed, **constraints))
+            t_baseline = measure(baseline_find, baseline, constraints)
+            t_indexed = measure(indexed_find, indexed, constraints)
+            print(f"{label:>24} {t_baseline:>10.1f}us {t_indexed:>10.1f}us {t_baseline/t_indexed:>7.1f}x")
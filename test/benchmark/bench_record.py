@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+Compare the time and memory to construct and sort synthetic records, with the
+Record class that stored its fields in a __dict__ and compared them one at a
+time in __lt__, and with the slotted Record sorted by its sort_key.
+
+    ./bench_record.py [n ...]
+"""
+
+import operator
+import pathlib
+import sys
+import time
+import tracemalloc
+
+prefix = pathlib.Path(__file__).parent.resolve()
+lib =  prefix.parent.parent / "lib"
+sys.path = [lib.as_posix()] + sys.path
+
+import record
+import synthetic
+
+class DictRecord:
+    """the fields and ordering of Record before it was slotted"""
+    def __init__(self, system, uarch, name, version, tag, date, size_bytes, sha256):
+        self._system  = system
+        self._uarch   = uarch
+        self._name    = name
+        self._version = version
+        self._tag     = tag
+        self._date    = date
+        self._bytes   = size_bytes
+        self._sha256  = sha256
+        self._id      = sha256[:16]
+
+    def __lt__(self, other):
+        if self.system  < other.system: return True
+        if other.system < self.system: return False
+        if self.uarch   < other.uarch: return True
+        if other.uarch  < self.uarch: return False
+        if self.name    < other.name: return True
+        if other.name   < self.name: return False
+        if self.version < other.version: return True
+        if other.version< self.version: return False
+        if self.tag     < other.tag: return True
+        if other.tag    < self.tag: return False
+        if self.id      < other.id: return True
+        if other.id     < self.id: return False
+        return False
+
+    system = property(operator.attrgetter("_system"))
+    uarch = property(operator.attrgetter("_uarch"))
+    name = property(operator.attrgetter("_name"))
+    version = property(operator.attrgetter("_version"))
+    tag = property(operator.attrgetter("_tag"))
+    id = property(operator.attrgetter("_id"))
+
+def construct(cls, fields: list) -> tuple:
+    """construct a record for each entry in fields: returns (records, seconds, MB)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    records = [cls(*f) for f in fields]
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return records, elapsed, size/(1024*1024)
+
+def sort(records: list, key=None) -> float:
+    start = time.perf_counter()
+    records.sort(key=key, reverse=True)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [100000]
+
+    print(f"{'records':>10} {'':>8} {'construct':>10} {'memory':>9} {'sort':>8}")
+    for n in sizes:
+        # the fields are created up front, and shuffled so that the sort does some work
+        fields = []
+        for i in range(n):
+            j = (i*7919) % n
+            fields.append(synthetic.fields(j) + ("2024-03-04 09:05:44.034000+00:00", 1024, synthetic.sha(j)))
+
+        old, t_old, mb_old = construct(DictRecord, fields)
+        s_old = sort(old)
+        new, t_new, mb_new = construct(record.Record, fields)
+        s_new = sort(new, key=operator.attrgetter("sort_key"))
+        assert [r.id for r in old] == [r.id for r in new]
+
+        print(f"{n:>10} {'dict':>8} {t_old:>9.3f}s {mb_old:>7.1f}MB {s_old:>7.3f}s")
+        print(f"{'':>10} {'slotted':>8} {t_new:>9.3f}s {mb_new:>7.1f}MB {s_new:>7.3f}s")
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+Compare the latency of searching a synthetic catalog for text and patterns, by
+reading every record and matching it in Python as scripts did previously, with
+find_records on a database without the search index, which matches with LIKE
+and GLOB, and on a database with the search index.
+
+    ./bench_search.py [n ...]
+"""
+
+import fnmatch
+import pathlib
+import sys
+import time
+
+prefix = pathlib.Path(__file__).parent.resolve()
+lib =  prefix.parent.parent / "lib"
+sys.path = [lib.as_posix()] + sys.path
+
+import datastore
+import synthetic
+
+# each search is repeated for at least this many seconds
+duration = 0.5
+
+def searches(n: int) -> dict:
+    """text and patterns that match entries of a catalog of n records"""
+    tag = synthetic.fields(n//2)[4]
+    return {
+        "name text": {"text": "cdf"},
+        "tag text": {"text": tag[-6:]},
+        "name prefix": {"name": "prgenv*"},
+        "tag glob": {"tag": f"*{tag[-6:-1]}?"},
+    }
+
+def baseline_search(store: datastore.DataStore, text: str=None, **constraints):
+    """read the whole catalog, and match each record"""
+    results = []
+    for r in store.images.records:
+        if text is not None and not any(text.lower() in getattr(r, f).lower() for f in datastore.search_fields):
+            continue
+        if all(fnmatch.fnmatchcase(getattr(r, f), p) for f, p in constraints.items()):
+            results.append(r)
+    return results
+
+def find(store: datastore.DataStore, text: str=None, **constraints):
+    return store.find_records(text, **constraints).records
+
+def measure(search, store, constraints) -> float:
+    """the mean latency of a search in milliseconds"""
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        search(store, **constraints)
+        count += 1
+    return 1e3*(time.perf_counter() - start)/count
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [100000]
+
+    for n in sizes:
+        plain = datastore.DataStore()
+        start = time.perf_counter()
+        plain.add_records(synthetic.records(n))
+        t_plain = time.perf_counter() - start
+
+        indexed = datastore.DataStore()
+        indexed.create_search_index()
+        start = time.perf_counter()
+        indexed.add_records(synthetic.records(n))
+        t_indexed = time.perf_counter() - start
+        assert indexed.has_search_index
+
+        print(f"{n} records, added in {t_plain:.2f}s without and {t_indexed:.2f}s with the search index")
+        print(f"{'search':>12} {'matches':>8} {'read all':>10} {'LIKE':>10} {'indexed':>10}")
+        for label, constraints in searches(n).items():
+            matches = len(find(indexed, **constraints))
+            assert matches == len(baseline_search(plain, **constraints)) == len(find(plain, **constraints))
+            t_all = measure(baseline_search, plain, constraints)
+            t_like = measure(find, plain, constraints)
+            t_index = measure(find, indexed, constraints)
+            print(f"{label:>12} {matches:>8} {t_all:>8.1f}ms {t_like:>8.1f}ms {t_index:>8.1f}ms")
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+"""
+Compare the time to upgrade a synthetic v1 repository to the current schema,
+by reading the records into Python and adding them to a new database as
+repo_upgrade did previously, and with the in-place migrations of repo_upgrade.
+
+    ./bench_upgrade.py [n ...]
+"""
+
+import pathlib
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+prefix = pathlib.Path(__file__).parent.resolve()
+lib =  prefix.parent.parent / "lib"
+sys.path = [lib.as_posix()] + sys.path
+
+import datastore
+import synthetic
+
+def create_v1(path: str, n: int):
+    """a v1 index.db in path with n synthetic records"""
+    store = sqlite3.connect(f"{path}/index.db")
+    store.executescript(datastore.create_db_commands[1])
+    versions = {}
+    with store:
+        for r in synthetic.records(n):
+            store.execute("INSERT INTO images (sha256, id, date, size, uarch, system) VALUES (?, ?, ?, ?, ?, ?)",
+                          (r.sha256, r.id, r.date, r.size, r.uarch, r.system))
+            key = (r.name, r.version)
+            if key not in versions:
+                store.execute("INSERT INTO uenv (name, version) VALUES (?, ?)", key)
+                versions[key] = store.execute("SELECT last_insert_rowid()").fetchone()[0]
+            store.execute("INSERT OR REPLACE INTO tags (version_id, tag, sha256) VALUES (?, ?, ?)",
+                          (versions[key], r.tag, r.sha256))
+    store.close()
+
+def copy_upgrade(repo_path: str):
+    """the upgrade of repo_upgrade before it migrated the database in place"""
+    db1_path = repo_path + "/index.db"
+    db1 = datastore.DataStore(db1_path)
+    db2_path = repo_path + "/index-v1.db"
+    datastore.FileSystemRepo.create(repo_path, exists_ok=False, db_name="index-v1.db")
+    db2 = datastore.DataStore(db2_path)
+    db2.add_records(db1.images.records)
+    db1.close()
+    db2.close()
+    dbswp_path = repo_path + "/index-back.db"
+    shutil.move(db1_path, dbswp_path)
+    shutil.copy(db2_path, db1_path)
+    shutil.move(dbswp_path, db2_path)
+
+def measure(upgrade, source: str, n: int) -> float:
+    with tempfile.TemporaryDirectory() as repo_path:
+        shutil.copy(f"{source}/index.db", f"{repo_path}/index.db")
+        start = time.perf_counter()
+        upgrade(repo_path)
+        elapsed = time.perf_counter() - start
+        assert datastore.repo_version(repo_path) == datastore.db_version
+        assert datastore.DataStore(f"{repo_path}/index.db", readonly=True).images.count == n
+        return elapsed
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [10000, 100000]
+
+    print(f"{'records':>10} {'copy':>10} {'in place':>10} {'speedup':>8}")
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as source:
+            create_v1(source, n)
+            t_copy = measure(copy_upgrade, source, n)
+            t_place = measure(datastore.repo_upgrade, source, n)
+        print(f"{n:>10} {t_copy:>9.3f}s {t_place:>9.3f}s {t_copy/t_place:>7.1f}x")
@@ -0,0 +1,33 @@
+import hashlib
+
+import record
+
+systems = ["santis", "todi", "balfrin", "eiger"]
+uarchs = ["gh200", "zen2", "zen3", "a100"]
+names = ["prgenv-gnu", "prgenv-nvfortran", "icon", "cp2k", "gromacs", "netcdf-tools", "linalg", "editors"]
+
+def sha(i: int) -> str:
+    return hashlib.sha256(str(i).encode()).hexdigest()
+
+def fields(i: int):
+    """the (system, uarch, name, version, tag) of the i'th synthetic catalog entry"""
+    system = systems[i % len(systems)]
+    uarch = uarchs[(i // len(systems)) % len(uarchs)]
+    name = names[(i // 16) % len(names)]
+    version = f"{23 + (i // 128) % 3}.{(i // 384) % 12 + 1}"
+    tag = f"{1000000000 + i}"
+    return system, uarch, name, version, tag
+
+def records(n: int):
+    """generate n synthetic records, in the style of CI build artifacts"""
+    for i in range(n):
+        system, uarch, name, version, tag = fields(i)
+        yield record.Record(system, uarch, name, version, tag,
+                            "2024-03-04 09:05:44.034000+00:00", 1024*1024*(i % 4096 + 1), sha(i))
+
+def listing_entries(n: int, namespace: str="build"):
+    """generate n synthetic (path, sha256, created) entries of a catalog listing"""
+    for i in range(n):
+        path = "/".join((namespace,) + fields(i))
+        created = f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}T{i % 24:02d}:{i % 60:02d}:{(7*i) % 60:02d}.{i % 1000:03d}Z"
+        yield path, sha(i), created
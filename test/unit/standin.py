@@ -0,0 +1,162 @@
+import hashlib
+import http.server
+import json
+import socketserver
+import threading
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that time out or close the connection early are expected in tests
+        pass
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.standin.requests.append({"path": self.path, "headers": dict(self.headers)})
+        status, headers, body = self.server.standin.respond(self)
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StandinServer:
+    """
+    A local HTTP server that stands in for a remote service in tests.
+
+    Derived classes implement respond(request), which returns a tuple
+    (status, headers, body) with body a bytes object.
+    """
+    def __init__(self):
+        self.requests = []
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        self._server.standin = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def respond(self, request):
+        return (404, {}, b"")
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class ListingServer(StandinServer):
+    """
+    Stands in for the uenv-list middleware, serving snapshots of the catalog.
+    The catalog is set as a list of (path, sha256, created) tuples.
+    """
+    def __init__(self, entries=[]):
+        super().__init__()
+        self.set_entries(entries)
+
+    def set_entries(self, entries):
+        self.body = json.dumps(listing(entries)).encode()
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:16] + '"'
+
+    def respond(self, request):
+        if request.headers.get("If-None-Match") == self.etag:
+            return (304, {"ETag": self.etag}, b"")
+        return (200, {"ETag": self.etag, "Content-Type": "application/json"}, self.body)
+
+def listing(entries):
+    """create a listing in the format returned by the uenv-list middleware"""
+    results = [{
+            "repo": "uenv",
+            "path": path,
+            "name": "manifest.json",
+            "created": created,
+            "size": "1024",
+            "sha256": sha256,
+            "stats": [{"downloaded": created, "downloads": 1}],
+        } for path, sha256, created in entries]
+    return {"results": results, "range": {"start_pos": 0, "end_pos": len(results), "total": len(results)}}
+
+class RegistryServer(StandinServer):
+    """
+    Stands in for an OCI registry that serves images pushed by oras.
+
+    Images are added with add_image(repository, reference, files), where files
+    maps the title of each layer to its contents. If token is set, requests
+    must be authorized with a bearer token obtained from /token. Range requests
+    are supported unless ranges is False, and the body of the response to a
+    range request is cut short after max_range bytes if it is set.
+    """
+    def __init__(self, token=None, ranges=True, max_range=None):
+        super().__init__()
+        self.token = token
+        self.ranges = ranges
+        self.max_range = max_range
+        self.manifests = {}
+        self.blobs = {}
+
+    def add_image(self, repository, reference, files):
+        layers = []
+        for title, contents in files.items():
+            digest = "sha256:" + hashlib.sha256(contents).hexdigest()
+            self.blobs[digest] = contents
+            layers.append({
+                "mediaType": "application/vnd.oci.image.layer.v1.tar",
+                "digest": digest,
+                "size": len(contents),
+                "annotations": {"org.opencontainers.image.title": title},
+            })
+        self.manifests[(repository, reference)] = {"schemaVersion": 2, "layers": layers}
+
+    def add_directory(self, repository, reference, title, archive):
+        """add a gzipped tar archive of a directory as a layer of an image"""
+        digest = "sha256:" + hashlib.sha256(archive).hexdigest()
+        self.blobs[digest] = archive
+        self.manifests[(repository, reference)]["layers"].append({
+            "mediaType": "application/vnd.oci.image.layer.v1.tar+gzip",
+            "digest": digest,
+            "size": len(archive),
+            "annotations": {
+                "org.opencontainers.image.title": title,
+                "io.deis.oras.content.unpack": "true",
+            },
+        })
+
+    def digest(self, repository, reference):
+        """the sha256 of the manifest of an image, i.e. its sha256 in the catalog"""
+        return hashlib.sha256(json.dumps(self.manifests[(repository, reference)]).encode()).hexdigest()
+
+    def respond(self, request):
+        path = request.path.split("?")[0]
+        if path == "/token":
+            return (200, {"Content-Type": "application/json"}, json.dumps({"token": self.token}).encode())
+        if self.token is not None and request.headers.get("Authorization") != f"Bearer {self.token}":
+            challenge = f'Bearer realm="{self.url}/token",service="standin"'
+            return (401, {"WWW-Authenticate": challenge}, b"")
+        if path == "/v2/":
+            return (200, {}, b"")
+        repository, _, reference = path[len("/v2/"):].rpartition("/")
+        repository, _, kind = repository.rpartition("/")
+        if kind == "manifests" and (repository, reference) in self.manifests:
+            body = json.dumps(self.manifests[(repository, reference)]).encode()
+            return (200, {"Content-Type": "application/vnd.oci.image.manifest.v1+json"}, body)
+        if kind == "blobs" and reference in self.blobs:
+            blob = self.blobs[reference]
+            byte_range = request.headers.get("Range")
+            if self.ranges and byte_range is not None:
+                start, end = (int(x) for x in byte_range[len("bytes="):].split("-"))
+                end = min(end, len(blob)-1)
+                headers = {"Content-Range": f"bytes {start}-{end}/{len(blob)}"}
+                body = blob[start:end+1]
+                if self.max_range is not None:
+                    body = body[:self.max_range]
+                return (206, headers, body)
+            return (200, {}, blob)
+        return (404, {}, b"")
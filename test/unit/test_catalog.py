@@ -0,0 +1,211 @@
+import multiprocessing
+import shutil
+import sqlite3
+import unittest
+
+import catalog
+import lock
+import scratch
+import standin
+
+snapshot = [
+    ("deploy/santis/gh200/prgenv-gnu/24.2/v1",   "a"*64, "2024-03-04T09:05:44.034Z"),
+    ("deploy/santis/gh200/prgenv-gnu/24.2/v2",   "b"*64, "2024-04-04T09:05:44.000Z"),
+    ("build/santis/gh200/prgenv-gnu/24.2/12345", "b"*64, "2024-04-03T19:15:04.123Z"),
+    ("build/santis/gh200/icon/2024/12346",       "c"*64, "2024-04-05T10:00:00.000Z"),
+]
+
+class TestCatalogCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("catalog_cache")
+        self.server = standin.ListingServer(snapshot)
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def cache(self, ttl):
+        return catalog.CatalogCache(self.path.as_posix(), ttl=ttl, url=self.server.url)
+
+    def test_download(self):
+        cache = self.cache(ttl=60)
+        self.assertFalse(cache.is_cached("deploy"))
+
+        deploy = cache.load("deploy")
+        self.assertTrue(cache.is_cached("deploy"))
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(deploy.find_records(name="prgenv-gnu").records), 2)
+        # the mirror is indexed for patterns and text
+        self.assertTrue(deploy.has_search_index)
+        self.assertEqual(len(deploy.find_records("gnu", version="24.*").records), 2)
+
+        # the build namespace is only loaded when it is requested
+        self.assertFalse(cache.is_cached("build"))
+        build = cache.load("build")
+        self.assertTrue(cache.is_cached("build"))
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(build.find_records(name="icon").records), 1)
+        self.assertTrue(build.find_records(name="prgenv-gnu", tag="v1").is_empty)
+
+    def test_ttl(self):
+        cache = self.cache(ttl=60)
+        cache.load("deploy")
+
+        # the cached catalog is used while it is younger than the ttl
+        deploy = cache.load("deploy")
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(deploy.find_records(name="prgenv-gnu").records), 2)
+
+        # --refresh downloads the catalog unconditionally
+        cache.load("deploy", refresh=True)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertNotIn("If-None-Match", self.server.requests[-1]["headers"])
+
+    def test_old_schema(self):
+        cache = self.cache(ttl=60)
+        cache.load("deploy").close()
+
+        # a mirror written with an older schema is downloaded again
+        con = sqlite3.connect(cache.db_path("deploy"))
+        con.execute("PRAGMA user_version = 2")
+        con.close()
+        self.assertFalse(cache.is_cached("deploy"))
+        deploy = cache.load("deploy")
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(["24.2"]*2, [r.version for r in deploy.find_records(name="prgenv-gnu", version="latest").records])
+
+    def test_sync_lock(self):
+        # POSIX locks are per process, so the sync lock is held by a child process
+        cache = self.cache(ttl=0)
+        cache.load("deploy")
+        context = multiprocessing.get_context("fork")
+        ready = context.Event()
+        release = context.Event()
+        def hold():
+            sync_lock = lock.FileLock(cache.path + "/sync.lock")
+            sync_lock.acquire()
+            ready.set()
+            release.wait(10)
+            sync_lock.release()
+        process = context.Process(target=hold)
+        process.start()
+        timeout = catalog.sync_timeout
+        catalog.sync_timeout = 0.1
+        try:
+            self.assertTrue(ready.wait(10))
+            with self.assertRaises(catalog.CatalogError):
+                cache.sync("deploy")
+            # the cached catalog is used while another process is syncing
+            deploy = cache.load("deploy")
+            self.assertEqual(len(deploy.find_records(name="prgenv-gnu").records), 2)
+        finally:
+            catalog.sync_timeout = timeout
+            release.set()
+            process.join()
+        self.assertEqual(len(self.server.requests), 1)
+        cache.sync("deploy")
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_revalidate(self):
+        cache = self.cache(ttl=0)
+        cache.load("deploy")
+
+        # an expired cache is revalidated with the ETag of the last download
+        deploy = cache.load("deploy")
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[-1]["headers"]["If-None-Match"], self.server.etag)
+        self.assertEqual(len(deploy.find_records(name="prgenv-gnu").records), 2)
+
+        # a modified catalog is downloaded
+        self.server.set_entries(snapshot[:1])
+        deploy = cache.load("deploy")
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(deploy.find_records(name="prgenv-gnu").records), 1)
+
+    def test_offline(self):
+        cache = self.cache(ttl=0)
+        with self.assertRaises(catalog.CatalogError):
+            cache.load("deploy", offline=True)
+
+        cache.load("deploy")
+        deploy = cache.load("deploy", offline=True)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(deploy.find_records(name="prgenv-gnu").records), 2)
+
+    def test_stale_fallback(self):
+        cache = self.cache(ttl=0)
+        cache.load("deploy")
+
+        # the cached catalog is used when the middleware can't be reached
+        self.server.close()
+        deploy = cache.load("deploy")
+        self.assertEqual(len(deploy.find_records(name="prgenv-gnu").records), 2)
+
+class TestCatalogSync(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("catalog_sync")
+        self.server = standin.ListingServer(snapshot)
+        self.cache = catalog.CatalogCache(self.path.as_posix(), ttl=0, url=self.server.url)
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def tags(self, namespace):
+        db = self.cache.open(namespace)
+        tags = sorted(f"{r.name}/{r.version}:{r.tag}@{r.sha256[0]}" for r in db.images.records)
+        db.close()
+        return tags
+
+    def test_successive_snapshots(self):
+        counts = self.cache.sync("build")
+        self.assertEqual(counts["added"], 2)
+        self.assertEqual(self.cache.read_meta()["build"]["high_water_mark"], "2024-04-05 10:00:00+00:00")
+
+        # an unmodified catalog is not applied
+        self.assertIsNone(self.cache.sync("build"))
+
+        # the next pipeline adds a build, retags an image, and removes an old build
+        self.server.set_entries([
+            ("build/santis/gh200/icon/2024/12346",       "d"*64, "2024-04-06T10:00:00.000Z"),
+            ("build/santis/gh200/icon/2024/12347",       "e"*64, "2024-04-06T11:00:00.000Z"),
+        ])
+        counts = self.cache.sync("build")
+        self.assertEqual(counts, {"added": 1, "changed": 1, "removed": 1, "unchanged": 0})
+        self.assertEqual(self.tags("build"), ["icon/2024:12346@d", "icon/2024:12347@e"])
+        self.assertEqual(self.cache.read_meta()["build"]["high_water_mark"], "2024-04-06 11:00:00+00:00")
+
+        # the images that are no longer tagged are removed
+        db = self.cache.open("build")
+        self.assertTrue(db.get_record("b"*64).is_empty)
+        self.assertTrue(db.get_record("c"*64).is_empty)
+
+        # the deploy namespace has not been mirrored
+        self.assertFalse(self.cache.is_cached("deploy"))
+
+    def test_high_water_mark(self):
+        self.cache.sync("build")
+
+        # a tag that is moved to an image older than the high water mark is applied
+        self.server.set_entries(snapshot[:2] + [
+            ("build/santis/gh200/prgenv-gnu/24.2/12345", "f"*64, "2024-04-03T19:15:04.123Z"),
+            ("build/santis/gh200/icon/2024/12346",       "c"*64, "2024-04-05T10:00:00.000Z"),
+        ])
+        counts = self.cache.sync("build")
+        self.assertEqual(counts, {"added": 0, "changed": 1, "removed": 0, "unchanged": 1})
+        self.assertEqual(self.tags("build"), ["icon/2024:12346@c", "prgenv-gnu/24.2:12345@f"])
+
+        # a refresh finds nothing else to apply
+        counts = self.cache.sync("build", refresh=True)
+        self.assertEqual(counts, {"added": 0, "changed": 0, "removed": 0, "unchanged": 2})
+
+    def test_load_uses_mirror(self):
+        self.cache.load("deploy")
+        self.server.set_entries(snapshot[1:])
+        deploy = self.cache.load("deploy")
+        self.assertEqual(["v2"], [r.tag for r in deploy.find_records(name="prgenv-gnu").records])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,13 @@
+import multiprocessing
+import os
+import pathlib
 import shutil
 import sqlite3
+import time
 import unittest
 
 import datastore
+import lock
 import record
 import scratch
 import inputs
@@ -29,6 +34,21 @@ duplicate_records = [
     record.Record("balfrin", "zen3",  "netcdf-tools", "2024", "v1", "2024/02/12", 1024, "z"*64),
 ]
 
+def create_v2_db(path):
+    """create a v2 index.db with the prgenv-gnu records in path"""
+    con = sqlite3.connect(str(path))
+    con.executescript(datastore.create_db_commands[2])
+    with con:
+        for r in prgenvgnu_records:
+            con.execute("INSERT OR IGNORE INTO images (sha256, id, date, size) VALUES (?, ?, ?, ?)",
+                        (r.sha256, r.id, r.date, r.size))
+            con.execute("INSERT OR IGNORE INTO uenv (system, uarch, name, version) VALUES (?, ?, ?, ?)",
+                        (r.system, r.uarch, r.name, r.version))
+            con.execute("INSERT INTO tags (version_id, tag, sha256) "
+                        "SELECT version_id, ?, ? FROM uenv WHERE name = ? AND version = ?",
+                        (r.tag, r.sha256, r.name, r.version))
+    con.close()
+
 def create_prgenv_repo(con):
     # add some records that will be inserted into the database
     # these defined different versions of prgenv-gnu
@@ -212,6 +232,253 @@ class TestInMemory(unittest.TestCase):
         self.assertEqual("v2", records[0].tag)
         self.assertEqual("default", records[1].tag)
 
+class TestQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.store = datastore.DataStore(path=None)
+        create_full_repo(self.store)
+
+    def plan(self, query, parameters):
+        rows = self.store._store.execute(f"EXPLAIN QUERY PLAN {query}", parameters)
+        return " ".join(row[-1] for row in rows)
+
+    def test_indexes(self):
+        # filters that don't start with system and uarch use the secondary indexes
+        self.assertRegex(self.plan("SELECT * FROM records WHERE name = ?", ("icon",)), "uenv_name|uenv_version_key")
+        self.assertIn("uenv_name", self.plan("SELECT * FROM records WHERE name = ? AND version = ?", ("icon", "2024")))
+        self.assertIn("tags_tag", self.plan("SELECT * FROM records WHERE tag = ?", ("v1",)))
+        self.assertIn("tags_sha256", self.plan("SELECT * FROM records WHERE sha256 = ?", ("a"*64,)))
+        self.assertNotIn("SCAN", self.plan("SELECT * FROM records WHERE id = ?", ("a"*16,)))
+
+    def test_latest(self):
+        for r in [record.Record("santis", "gh200", "prgenv-gnu", "24.10", "v1", "monday", 1024, "d"*64),
+                  record.Record("santis", "gh200", "prgenv-gnu", "24.10", "v2", "monday", 1024, "e"*64),
+                  record.Record("todi",   "gh200", "prgenv-gnu", "24.7",  "v1", "monday", 1024, "f"*64),
+                  record.Record("santis", "gh200", "prgenv-gnu", "24.11-rc1", "v3", "monday", 1024, "9"*64)]:
+            self.store.add_record(r)
+        self.store.remove_images(["9"*64])
+
+        # versions are ordered by value, so that 24.10 is more recent than 24.2
+        results = self.store.find_records(name="prgenv-gnu", version="latest", system="santis")
+        self.assertEqual([("24.10", "v2"), ("24.10", "v1")], [(r.version, r.tag) for r in results.records])
+        self.assertEqual(2, results.count)
+        self.assertEqual(["e"*64], [r.sha256 for r in
+                                    self.store.find_records(name="prgenv-gnu", version="latest", tag="v2").records])
+        # the latest version that has the tag
+        self.assertEqual(["24.2"], [r.version for r in
+                                    self.store.find_records(name="prgenv-gnu", version="latest", tag="default").records])
+        # the latest version on each system and uarch
+        self.assertEqual([("todi", "24.7"), ("santis", "24.10"), ("santis", "24.10")],
+                         [(r.system, r.version) for r in
+                          self.store.find_records(name="prgenv-gnu", version="latest").records])
+        self.assertTrue(self.store.find_records(name="prgenv-gnu", version="latest", tag="v9").is_empty)
+        self.assertEqual(["2024"]*3, [r.version for r in self.store.find_records(name="icon", version="latest").records])
+
+        # the newest version is found with the index, without reading the other versions
+        query = ("SELECT * FROM records WHERE records.name = ? AND records.version_key = ("
+                 "SELECT newest.version_key FROM records AS newest WHERE newest.name = records.name "
+                 "AND newest.system = records.system AND newest.uarch = records.uarch "
+                 "ORDER BY newest.version_key DESC LIMIT 1)")
+        plan = self.plan(query, ("prgenv-gnu",))
+        self.assertIn("uenv_version_key (name=? AND system=? AND uarch=?)", plan)
+        self.assertNotIn("SCAN", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_parameters(self):
+        # values are bound as parameters, and never interpreted as SQL
+        self.assertTrue(self.store.find_records(name="icon' OR '1'='1").is_empty)
+        self.assertTrue(self.store.find_records(sha="a'"*8).is_empty)
+        self.assertEqual(3, len(self.store.find_records(name="icon").records))
+
+    def test_existing_repo(self):
+        # repositories created without the indexes are indexed when they are opened
+        path = scratch.make_scratch_path("query_indexes")
+        datastore.FileSystemRepo.create(path.as_posix())
+        con = sqlite3.connect((path / "index.db").as_posix())
+        for index in datastore.indexes:
+            con.execute(f"DROP INDEX IF EXISTS {index}")
+        con.commit()
+        con.close()
+
+        repo = datastore.FileSystemRepo(path.as_posix())
+        names = {row[0] for row in repo.database._store.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertTrue(set(datastore.indexes) <= names)
+        shutil.rmtree(path, ignore_errors=True)
+
+class TestSearch(unittest.TestCase):
+    """find_records with patterns and text, with and without the search index"""
+
+    def setUp(self):
+        self.stores = []
+        for indexed in [False, True]:
+            store = datastore.DataStore(path=None)
+            create_full_repo(store)
+            store.add_records([
+                record.Record("santis", "gh200", "icon-tools", "1.0",  "v1",        "monday", 1024, "3"*64),
+                record.Record("santis", "gh200", "nwp-icon",   "2024", "v1",        "monday", 1024, "4"*64),
+                record.Record("santis", "gh200", "cp2k",       "2024", "with-icon", "monday", 1024, "5"*64)])
+            if indexed:
+                self.assertTrue(store.create_search_index())
+            self.assertEqual(indexed, store.has_search_index)
+            self.stores.append(store)
+
+    def find(self, *args, **constraints):
+        """the records that match in each store, which must be the same"""
+        results = [[(r.full_name, r.system, r.uarch) for r in store.find_records(*args, **constraints).records]
+                   for store in self.stores]
+        self.assertEqual(results[0], results[1])
+        counts = [store.find_records(*args, **constraints).count for store in self.stores]
+        self.assertEqual([len(results[0])]*2, counts)
+        return [name for name, _, _ in results[0]]
+
+    def test_patterns(self):
+        self.assertEqual(5, len(self.find(name="prgenv*")))
+        self.assertEqual(["prgenv-gnu/24.2:v1", "prgenv-gnu/24.2:default"], self.find(name="prgenv*", version="24.*"))
+        self.assertEqual(4, len(self.find(name="*cdf*")))
+        self.assertEqual(9, len(self.find(name="[ip]*")))
+        self.assertEqual(9, len(self.find(version="2?2*")))
+        self.assertEqual(["prgenv-gnu/24.2:default", "prgenv-gnu/23.11:v2", "prgenv-gnu/23.11:default"],
+                         self.find(name="prgenv*", tag="[dv][e2]*"))
+        self.assertEqual(2, len(self.find(name="netcdf-tools", system="bal*")))
+        self.assertEqual(["prgenv-gnu/24.2:v1", "prgenv-gnu/24.2:default"], self.find(name="prgenv*", version="latest"))
+        self.assertEqual([], self.find(name="*", tag="v3*"))
+        # patterns only match whole values
+        self.assertEqual([], self.find(name="prgenv"))
+
+    def test_text(self):
+        # exact matches of the name first, then names that start with and contain the
+        # text, then other fields, and otherwise in the usual order
+        expected = ["icon/2024:v2", "icon/2024:v1", "icon/2024:default", "icon-tools/1.0:v1",
+                    "nwp-icon/2024:v1", "cp2k/2024:with-icon"]
+        self.assertEqual(expected, self.find("icon"))
+        self.assertEqual(expected, self.find("ICON", system="santis"))
+        self.assertEqual(expected[:4], self.find("icon", name="i*"))
+        self.assertEqual(4, len(self.find("cdf")))
+        self.assertEqual(5, len(self.find("tools", tag="v1")))
+        self.assertEqual(["netcdf-tools/2024:v1"], self.find("zen3", name="netcdf*"))
+        self.assertEqual(["netcdf-tools/2024:v1"], self.find("a100"))
+        # text that is too short for the index is matched without it
+        self.assertEqual(["prgenv-gnu/23.11:v2", "icon/2024:v2"], self.find("v2"))
+        # text is matched literally
+        self.assertEqual([], self.find("%"))
+        self.assertEqual([], self.find("i_on"))
+        self.assertEqual([], self.find('ic"on'))
+
+    def test_index_maintained(self):
+        unindexed, indexed = self.stores
+
+        def check():
+            tags = indexed._store.execute("SELECT COUNT(*) FROM tags").fetchone()[0]
+            self.assertEqual(tags, indexed._store.execute("SELECT COUNT(*) FROM search").fetchone()[0])
+            self.assertEqual(self.find("prgenv"), self.find(name="prgenv*"))
+
+        # replace a tag, and add new ones
+        for store in self.stores:
+            store.add_record(record.Record("santis", "gh200", "prgenv-gnu", "24.2", "v1", "monday", 1024, "6"*64))
+            store.add_records([record.Record("santis", "gh200", "prgenv-gnu", "24.2", "v1", "monday", 1024, "7"*64),
+                               record.Record("santis", "gh200", "prgenv-gnu", "24.10", "v1", "monday", 1024, "8"*64)])
+        check()
+        self.assertEqual("7"*64, indexed.find_records("prgenv", version="24.2", tag="v1").records[0].sha256)
+        self.assertEqual(["prgenv-gnu/24.10:v1"], self.find(name="prgenv*", version="latest"))
+
+        for store in self.stores:
+            store.remove_images(["8"*64])
+        check()
+        self.assertEqual([], self.find(name="prgenv*", version="24.1?"))
+
+        for store in self.stores:
+            store.sync_records(prgenvgnu_records[:2] + icon_records)
+        check()
+        self.assertEqual(["prgenv-gnu/23.11:v2", "prgenv-gnu/23.11:default"], self.find("gnu"))
+
+    def test_plan(self):
+        # patterns and text are looked up in the index, then joined with the records
+        store = self.stores[1]
+        for constraints in [{"name": "prgenv*", "system": "santis"}, {"text": "icon"}]:
+            query = " ".join(row[-1] for row in store._store.execute(
+                f"EXPLAIN QUERY PLAN SELECT * FROM {datastore.search_source} WHERE "
+                + ("search.name GLOB ? AND records.system = ?" if "name" in constraints else "search MATCH ?"),
+                list(constraints.values())))
+            self.assertIn("search VIRTUAL TABLE", query)
+            self.assertIn("SEARCH tags USING INTEGER PRIMARY KEY", query)
+            self.assertNotIn("SCAN uenv", query)
+            self.assertNotIn("SCAN tags", query)
+
+class TestRecordSet(unittest.TestCase):
+
+    def test_group(self):
+        results = datastore.RecordSet(prgenvgnu_records, "prgenv-gnu")
+        self.assertEqual(["a"*64, "c"*64, "b"*64], results.shas)
+        self.assertEqual(prgenvgnu_records[:2], results.sha2record["a"*64])
+        self.assertEqual(5, results.count)
+        self.assertFalse(results.is_unique_sha)
+
+    def test_lazy(self):
+        loads = []
+        def load():
+            loads.append(1)
+            return list(icon_records)
+
+        # the counts are used until the records are read
+        results = datastore.RecordSet(load, "icon", lambda: (3, 2))
+        self.assertFalse(results.is_empty)
+        self.assertFalse(results.is_unique_sha)
+        self.assertEqual(3, results.count)
+        self.assertEqual([], loads)
+        self.assertEqual(icon_records, results.records)
+        self.assertEqual(icon_records, results.records)
+        self.assertEqual([1], loads)
+
+        # without counts the records are read
+        results = datastore.RecordSet(load, "icon")
+        self.assertFalse(results.is_unique_record)
+        self.assertEqual(2, len(loads))
+
+    def test_aggregate(self):
+        store = datastore.DataStore(path=None)
+        create_full_repo(store)
+        for constraints in [{"name": "icon"}, {"tag": "v1"}, {"sha": "a"*64}, {"sha": "1"*16}, {"name": "none"}]:
+            counted = store.find_records(**constraints)
+            loaded = store.find_records(**constraints)
+            loaded.records
+            self.assertEqual(counted.count, loaded.count)
+            self.assertEqual(counted.is_empty, loaded.is_empty)
+            self.assertEqual(counted.is_unique_sha, loaded.is_unique_sha)
+            self.assertEqual(counted.is_unique_record, loaded.is_unique_record)
+        self.assertEqual(12, store.images.count)
+
+class TestAddRecords(unittest.TestCase):
+
+    def test_matches_add_record(self):
+        # adding records in bulk gives the same database as adding them one at a time
+        single = datastore.DataStore(path=None)
+        create_full_repo(single)
+
+        bulk = datastore.DataStore(path=None)
+        bulk.add_records(prgenvgnu_records + icon_records + duplicate_records)
+
+        self.assertEqual([str(r) for r in single.images.records],
+                         [str(r) for r in bulk.images.records])
+
+    def test_replace_tag(self):
+        store = datastore.DataStore(path=None)
+        store.add_records(prgenvgnu_records)
+
+        # a tag that is applied more than once refers to the last image
+        v1 = record.Record("santis", "gh200", "prgenv-gnu", "24.2", "v1", "monday", 1024, "d"*64)
+        v2 = record.Record("santis", "gh200", "prgenv-gnu", "24.2", "v2", "monday", 1024, "d"*64)
+        v2e = record.Record("santis", "gh200", "prgenv-gnu", "24.2", "v2", "monday", 1024, "e"*64)
+        store.add_records(iter([v1, v2, v2e]))
+
+        self.assertEqual(["default"], [r.tag for r in store.find_records(sha="b"*64).records])
+        self.assertEqual(["v1"], [r.tag for r in store.find_records(sha="d"*64).records])
+        self.assertEqual(["v2"], [r.tag for r in store.find_records(sha="e"*64).records])
+
+    def test_empty(self):
+        store = datastore.DataStore(path=None)
+        store.add_records([])
+        self.assertTrue(store.images.is_empty)
+
 class TestInvalidRepository(unittest.TestCase):
     def setUp(self):
         self.path = scratch.make_scratch_path("repository_create")
@@ -242,6 +509,65 @@ class TestInvalidRepository(unittest.TestCase):
         with self.assertRaises(datastore.RepoDBError):
             repo = datastore.FileSystemRepo(rpath.as_posix())
 
+class TestSchemaVersion(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("schema_version")
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def user_version(self):
+        con = sqlite3.connect((self.path / "index.db").as_posix())
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        con.close()
+        return version
+
+    def test_new_repo(self):
+        datastore.FileSystemRepo.create(self.path.as_posix())
+        self.assertEqual(datastore.db_version, self.user_version())
+        repo = datastore.FileSystemRepo(self.path.as_posix(), readonly=True)
+        self.assertEqual(datastore.db_version, repo.database.version)
+        self.assertEqual(1, repo.status)
+
+    def test_unversioned_repo(self):
+        # repositories created before the version was recorded are identified by their columns
+        create_v2_db(self.path / "index.db")
+        con = sqlite3.connect((self.path / "index.db").as_posix())
+        con.execute("PRAGMA user_version = 0")
+        con.commit()
+        con.close()
+        self.assertEqual(2, datastore.repo_version(self.path.as_posix()))
+
+        # the database is not modified until it is upgraded
+        self.assertEqual(2, datastore.FileSystemRepo(self.path.as_posix(), readonly=True).database.version)
+        repo = datastore.FileSystemRepo(self.path.as_posix())
+        self.assertEqual(2, repo.database.version)
+        self.assertEqual(0, repo.status)
+        self.assertEqual(0, self.user_version())
+
+    def test_v1_repo(self):
+        shutil.copy(inputs.database(1), self.path / "index.db")
+        repo = datastore.FileSystemRepo(self.path.as_posix())
+        self.assertEqual(1, repo.database.version)
+        self.assertEqual(0, repo.status)
+        # the database is not modified until it is upgraded
+        self.assertEqual(0, self.user_version())
+
+    def test_unknown_schema(self):
+        con = sqlite3.connect((self.path / "index.db").as_posix())
+        con.execute("CREATE TABLE records (name TEXT)")
+        con.commit()
+        con.close()
+        self.assertEqual(-1, datastore.repo_status(self.path.as_posix()))
+        self.assertEqual(-1, datastore.FileSystemRepo(self.path.as_posix()).status)
+
+        # a database without the records view is invalid
+        os.remove(self.path / "index.db")
+        sqlite3.connect((self.path / "index.db").as_posix()).close()
+        with self.assertRaises(datastore.RepoDBError):
+            datastore.FileSystemRepo(self.path.as_posix())
+
 class TestRepositoryCreate(unittest.TestCase):
 
     def setUp(self):
@@ -264,6 +590,467 @@ class TestRepositoryCreate(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.path, ignore_errors=True)
 
+class TestStaging(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("repository_staging")
+        datastore.FileSystemRepo.create(self.path.as_posix())
+        self.repo = datastore.FileSystemRepo(self.path.as_posix())
+        self.record = prgenvgnu_records[0]
+
+    def stage(self, contents):
+        staging = pathlib.Path(self.repo.staging_path(self.record))
+        staging.mkdir(parents=True)
+        (staging / "store.squashfs").write_text(contents)
+
+    def test_install_image(self):
+        self.stage("image")
+        self.assertFalse(os.path.exists(self.repo.image_path(self.record)))
+
+        self.repo.install_image(self.record)
+        image = pathlib.Path(self.repo.image_path(self.record))
+        self.assertEqual((image / "store.squashfs").read_text(), "image")
+        self.assertFalse(os.path.exists(self.repo.staging_path(self.record)))
+
+        # an existing image path is replaced
+        self.stage("new image")
+        self.repo.install_image(self.record)
+        self.assertEqual((image / "store.squashfs").read_text(), "new image")
+        self.assertEqual(os.listdir(self.path / "staging"), [])
+
+    def test_sweep_staging(self):
+        self.stage("partial")
+        recent = self.repo.staging_path(prgenvgnu_records[3])
+        os.makedirs(recent)
+
+        old = time.time() - datastore.staging_ttl - 60
+        os.utime(self.repo.staging_path(self.record), (old, old))
+        self.repo.sweep_staging()
+        self.assertFalse(os.path.exists(self.repo.staging_path(self.record)))
+        self.assertTrue(os.path.exists(recent))
+
+    def test_sweep_locked(self):
+        # POSIX locks are per process, so the image is locked by a child process
+        self.stage("partial")
+        old = time.time() - datastore.staging_ttl - 60
+        os.utime(self.repo.staging_path(self.record), (old, old))
+        context = multiprocessing.get_context("fork")
+        ready = context.Event()
+        release = context.Event()
+        def hold():
+            image_lock = self.repo.image_lock(self.record)
+            image_lock.acquire()
+            ready.set()
+            release.wait(10)
+            image_lock.release()
+        process = context.Process(target=hold)
+        process.start()
+        try:
+            self.assertTrue(ready.wait(10))
+            self.repo.sweep_staging()
+            self.assertTrue(os.path.exists(self.repo.staging_path(self.record)))
+        finally:
+            release.set()
+            process.join()
+        self.repo.sweep_staging()
+        self.assertFalse(os.path.exists(self.repo.staging_path(self.record)))
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+class TestPullStats(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("repository_pulls")
+        datastore.FileSystemRepo.create(self.path.as_posix())
+        self.repo = datastore.FileSystemRepo(self.path.as_posix())
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def stats(self, source, size, seconds, retries=0):
+        return {"source": source, "method": "native", "bytes": size, "seconds": seconds, "retries": retries}
+
+    def test_no_pulls(self):
+        self.assertEqual(self.repo.database.pull_summary(), [])
+        self.assertEqual(self.repo.database.recent_pulls(10), [])
+
+    def test_pull_stats(self):
+        mb = 1024*1024
+        r = prgenvgnu_records[0]
+        self.repo.add_pull(r.sha256, "prgenv-gnu/24.2:v1", self.stats("https://fast", 100*mb, 1.0))
+        self.repo.add_pull(r.sha256, "prgenv-gnu/24.2:v2", self.stats("https://slow", 100*mb, 10.0, 2))
+        self.repo.add_pull(r.sha256, "prgenv-gnu/24.2:v3", self.stats("https://slow", 100*mb, 40.0, 1))
+
+        # the statistics are persisted in the repository
+        database = datastore.FileSystemRepo(self.path.as_posix()).database
+        summary = database.pull_summary()
+        self.assertEqual([row["source"] for row in summary], ["https://slow", "https://fast"])
+        slow = summary[0]
+        self.assertEqual(slow["pulls"], 2)
+        self.assertEqual(slow["bytes"], 200*mb)
+        self.assertEqual(slow["retries"], 3)
+        self.assertAlmostEqual(slow["rate"], 4*mb)
+        self.assertAlmostEqual(slow["min_rate"], 2.5*mb)
+
+        recent = database.recent_pulls(2)
+        self.assertEqual([row["label"] for row in recent], ["prgenv-gnu/24.2:v3", "prgenv-gnu/24.2:v2"])
+        self.assertAlmostEqual(recent[0]["rate"], 2.5*mb)
+
+class TestLayers(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("repository_layers")
+        self.site = (self.path / "site").as_posix()
+        self.user = (self.path / "user").as_posix()
+        datastore.FileSystemRepo.create(self.site)
+        datastore.FileSystemRepo.create(self.user)
+        site = datastore.FileSystemRepo(self.site)
+        site.add_records(prgenvgnu_records[:3])
+        for sha in ["a"*64, "c"*64]:
+            os.makedirs(f"{self.site}/images/{sha}")
+        user = datastore.FileSystemRepo(self.user)
+        # the user has a copy of an image in the site repository
+        user.add_records(prgenvgnu_records[2:])
+        for sha in ["c"*64, "b"*64]:
+            os.makedirs(f"{self.user}/images/{sha}")
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_find_records(self):
+        repo = datastore.FileSystemRepo(self.user, layers=[self.site])
+        results = repo.database.find_records(name="prgenv-gnu")
+        self.assertEqual(sorted(results.records), sorted(prgenvgnu_records))
+        self.assertEqual(len(repo.database.find_records(version="23.11", tag="v1").records), 1)
+        self.assertFalse(repo.database.get_record("a"*64).is_empty)
+
+        # the records of the layers are not in the search index
+        self.assertFalse(repo.database.create_search_index())
+        self.assertEqual(5, len(repo.database.find_records("gnu").records))
+        self.assertEqual(3, len(repo.database.find_records(version="23.1?").records))
+
+    def test_precedence(self):
+        # the user repository has a tag that points to a different image in the site repository
+        moved = record.Record("santis", "gh200", "prgenv-gnu", "23.11", "default", "tuesday", 1024, "9"*64)
+        datastore.FileSystemRepo(self.user).add_record(moved)
+        repo = datastore.FileSystemRepo(self.user, layers=[self.site])
+        results = repo.database.find_records(name="prgenv-gnu", version="23.11", tag="default")
+        self.assertTrue(results.is_unique_sha)
+        self.assertEqual(results.records, [prgenvgnu_records[0]])
+        self.assertEqual(5, len(repo.database.find_records(name="prgenv-gnu").records))
+        self.assertTrue(repo.database.get_record("9"*64).is_empty)
+
+        # without the site repository, the tag in the user repository is used
+        repo = datastore.FileSystemRepo(self.user)
+        self.assertEqual(repo.database.find_records(version="23.11", tag="default").records, [moved])
+
+    def test_image_path(self):
+        repo = datastore.FileSystemRepo(self.user, layers=[self.site])
+        # images are found in the first repository that has them
+        self.assertEqual(repo.image_path(prgenvgnu_records[0]), f"{self.site}/images/{'a'*64}")
+        self.assertEqual(repo.image_path(prgenvgnu_records[2]), f"{self.site}/images/{'c'*64}")
+        self.assertEqual(repo.image_path(prgenvgnu_records[3]), f"{self.user}/images/{'b'*64}")
+
+    def test_add_records(self):
+        repo = datastore.FileSystemRepo(self.user, layers=[self.site])
+        new = record.Record("santis", "gh200", "icon", "2024", "v1", "monday", 1024, "1"*64)
+        repo.add_record(new)
+        self.assertEqual(repo.database.find_records(name="icon").records, [new])
+        # the site repository is not modified
+        self.assertTrue(datastore.FileSystemRepo(self.site).database.find_records(name="icon").is_empty)
+
+    def test_invalid_layer(self):
+        missing = (self.path / "missing").as_posix()
+        repo = datastore.FileSystemRepo(self.user, layers=[missing, self.user])
+        self.assertEqual(sorted(repo.database.images.records), sorted(prgenvgnu_records[2:]))
+
+class TestPeers(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("repository_peers")
+        self.peer = (self.path / "peer").as_posix()
+        self.user = (self.path / "user").as_posix()
+        datastore.FileSystemRepo.create(self.peer)
+        datastore.FileSystemRepo.create(self.user)
+        self.record = prgenvgnu_records[0]
+        datastore.FileSystemRepo(self.peer).add_record(self.record)
+        image = pathlib.Path(self.peer) / "images" / self.record.sha256
+        (image / "meta").mkdir(parents=True)
+        (image / "store.squashfs").write_text("image")
+        (image / "meta" / "env.json").write_text("{}")
+        self.repo = datastore.FileSystemRepo(self.user)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_find_peer_image(self):
+        missing = (self.path / "missing").as_posix()
+        self.assertEqual(self.repo.find_peer_image(self.record, [missing, self.user, self.peer]),
+                         f"{self.peer}/images/{self.record.sha256}")
+        self.assertIsNone(self.repo.find_peer_image(prgenvgnu_records[2], [self.peer]))
+
+    def test_link_image(self):
+        source = self.repo.find_peer_image(self.record, [self.peer])
+        counts = self.repo.link_image(self.record, source)
+        self.assertEqual(sum(counts.values()), 2)
+        staging = pathlib.Path(self.repo.staging_path(self.record))
+        self.assertEqual((staging / "store.squashfs").read_text(), "image")
+        self.assertEqual((staging / "meta" / "env.json").read_text(), "{}")
+
+        # removing the image from the peer does not affect the linked image
+        shutil.rmtree(source)
+        self.assertEqual((staging / "store.squashfs").read_text(), "image")
+
+    def test_link_check(self):
+        # a partial download is only replaced by an image that passes the check
+        staging = pathlib.Path(self.repo.staging_path(self.record))
+        staging.mkdir(parents=True)
+        (staging / ".pull.json").write_text("{}")
+        source = self.repo.find_peer_image(self.record, [self.peer])
+        self.assertIsNone(self.repo.link_image(self.record, source, lambda path: False))
+        self.assertEqual(os.listdir(staging), [".pull.json"])
+        self.assertEqual(os.listdir(staging.parent), [staging.name])
+
+        counts = self.repo.link_image(self.record, source, lambda path: os.path.isfile(path + "/store.squashfs"))
+        self.assertEqual(sum(counts.values()), 2)
+        self.assertEqual(sorted(os.listdir(staging)), ["meta", "store.squashfs"])
+
+    def test_link_file(self):
+        source = (self.path / "source").as_posix()
+        with open(source, "w") as fid:
+            fid.write("data")
+        target = (self.path / "target").as_posix()
+        self.assertIn(datastore.link_file(source, target), ["reflink", "hardlink", "copy"])
+        with open(target) as fid:
+            self.assertEqual(fid.read(), "data")
+
+class TestGarbageCollection(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("repository_gc")
+        self.repo_path = self.path.as_posix()
+        datastore.FileSystemRepo.create(self.repo_path)
+        self.repo = datastore.FileSystemRepo(self.repo_path)
+        self.repo.add_records(prgenvgnu_records)
+        # images a, b and c use 1, 2 and 3 blocks of 64 kB
+        for sha, blocks in [("a"*64, 1), ("b"*64, 2), ("c"*64, 3), ("d"*64, 1)]:
+            os.makedirs(f"{self.repo_path}/images/{sha}")
+            with open(f"{self.repo_path}/images/{sha}/store.squashfs", "wb") as fid:
+                fid.write(b"x" * (blocks*65536))
+        # d is an image directory that is not in the index, and e an untagged image
+        store = sqlite3.connect(f"{self.repo_path}/index.db")
+        store.execute("INSERT INTO images (sha256, id, date, size) VALUES (?, ?, ?, ?)", ("e"*64, "e"*16, "monday", 0))
+        store.commit()
+        store.close()
+        self.repo.mark_used(prgenvgnu_records[0], when=100)
+        self.repo.mark_used(prgenvgnu_records[3], when=200)
+        self.repo.mark_used(prgenvgnu_records[3], when=300)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def removed(self, plan):
+        return [(p["sha256"][0], p["reason"]) for p in plan]
+
+    def test_parse_size(self):
+        self.assertEqual(datastore.parse_size("1000"), 1000)
+        self.assertEqual(datastore.parse_size("200G"), 200*1024**3)
+        self.assertEqual(datastore.parse_size("1.5tb"), int(1.5*1024**4))
+        for size in ["", "big", "-1G"]:
+            with self.assertRaises(ValueError):
+                datastore.parse_size(size)
+
+    def test_usage(self):
+        usage = self.repo.image_usage()
+        self.assertEqual(usage["b"*64], {"tags": 2, "last_used": 300, "uses": 2})
+        self.assertEqual(usage["c"*64], {"tags": 1, "last_used": None, "uses": 0})
+        self.assertEqual(usage["e"*64]["tags"], 0)
+        self.assertEqual(self.repo.database.image_tags()["a"*64], 2)
+
+        # the number of uses in a usage file is capped
+        limit = datastore.max_recorded_uses
+        datastore.max_recorded_uses = 3
+        try:
+            for when in [400, 500, 600]:
+                self.repo.mark_used(prgenvgnu_records[0], when=when)
+        finally:
+            datastore.max_recorded_uses = limit
+        usage = self.repo.image_usage()
+        self.assertEqual((usage["a"*64]["last_used"], usage["a"*64]["uses"]), (600, 3))
+
+    def test_orphans(self):
+        plan = self.repo.collect_garbage(dry_run=True)
+        self.assertEqual(sorted(self.removed(plan)), [("d", "orphan"), ("e", "untagged")])
+        self.assertTrue(os.path.exists(f"{self.repo_path}/images/{'d'*64}"))
+
+        self.repo.collect_garbage()
+        self.assertFalse(os.path.exists(f"{self.repo_path}/images/{'d'*64}"))
+        self.assertNotIn("e"*64, self.repo.image_usage())
+        self.assertEqual(self.repo.collect_garbage(), [])
+
+    def test_lru(self):
+        # c was never used, so it was last used when it was installed
+        plan = self.repo.collect_garbage(quota=4*65536, dry_run=True)
+        self.assertEqual(self.removed(plan)[2:], [("a", "lru"), ("b", "lru")])
+        plan = self.repo.collect_garbage(quota=5*65536, protected={"b"*64})
+        self.assertEqual(self.removed(plan)[2:], [("a", "lru")])
+        self.assertEqual(plan[2]["label"], "prgenv-gnu/23.11:default")
+        self.assertTrue(self.repo.database.get_record("a"*64).is_empty)
+        self.assertFalse(os.path.exists(self.repo.image_path(prgenvgnu_records[0])))
+        self.assertTrue(os.path.exists(self.repo.image_path(prgenvgnu_records[3])))
+
+    def test_lru_usage_files(self):
+        # a was used after b, so b is removed first
+        self.repo.mark_used(prgenvgnu_records[0], when=400)
+        plan = self.repo.collect_garbage(quota=4*65536)
+        self.assertEqual(self.removed(plan)[2:], [("b", "lru")])
+        self.repo.collect_garbage(quota=0)
+        self.assertFalse(os.path.exists(f"{self.repo_path}/usage/{'a'*64}"))
+
+    def test_hardlinked(self):
+        # the files of c are linked from a peer repository, so removing c frees nothing
+        os.makedirs(f"{self.path}/peer")
+        os.link(f"{self.repo_path}/images/{'c'*64}/store.squashfs", f"{self.path}/peer/store.squashfs")
+        self.assertEqual(datastore.disk_usage(f"{self.repo_path}/images/{'c'*64}", exclusive=True), 0)
+        self.assertGreater(datastore.disk_usage(f"{self.repo_path}/images/{'c'*64}"), 0)
+        plan = self.repo.collect_garbage(quota=0, dry_run=True)
+        self.assertEqual(self.removed(plan)[2:], [("a", "lru"), ("b", "lru")])
+
+    def test_size(self):
+        # the largest image is removed first, unless it was used much more recently
+        plan = self.repo.collect_garbage(quota=4*65536, policy="size", dry_run=True)
+        self.assertEqual(self.removed(plan)[2:], [("b", "size")])
+
+    def test_locked(self):
+        # POSIX locks are per process, so the image is locked by a child process
+        context = multiprocessing.get_context("fork")
+        ready = context.Event()
+        release = context.Event()
+        def hold():
+            image_lock = self.repo.image_lock(prgenvgnu_records[0])
+            image_lock.acquire()
+            ready.set()
+            release.wait(10)
+            image_lock.release()
+        process = context.Process(target=hold)
+        process.start()
+        try:
+            self.assertTrue(ready.wait(10))
+            plan = self.repo.collect_garbage(quota=0)
+        finally:
+            release.set()
+            process.join()
+        self.assertNotIn(("a", "lru"), self.removed(plan))
+        self.assertFalse(self.repo.database.get_record("a"*64).is_empty)
+
+class TestConcurrency(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("repository_concurrency")
+        self.repo_path = self.path.as_posix()
+        datastore.FileSystemRepo.create(self.repo_path)
+        datastore.FileSystemRepo(self.repo_path).add_records(prgenvgnu_records)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_readonly(self):
+        repo = datastore.FileSystemRepo(self.repo_path, readonly=True)
+        self.assertTrue(repo.database.readonly)
+        self.assertEqual(5, len(repo.database.find_records(name="prgenv-gnu").records))
+        with self.assertRaises(datastore.RepoDBError):
+            repo.add_record(icon_records[0])
+        # the use of an image is recorded without writing to the index
+        repo.mark_used(prgenvgnu_records[0])
+        self.assertEqual(1, repo.image_usage()["a"*64]["uses"])
+
+    def test_writer_lock(self):
+        # POSIX locks are per process, so the writer lock is held by a child process
+        context = multiprocessing.get_context("fork")
+        ready = context.Event()
+        release = context.Event()
+        def hold():
+            writer = lock.FileLock(f"{self.repo_path}/index.db.lock")
+            writer.acquire()
+            ready.set()
+            release.wait(10)
+            writer.release()
+        process = context.Process(target=hold)
+        process.start()
+        repo = datastore.FileSystemRepo(self.repo_path)
+        try:
+            self.assertTrue(ready.wait(10))
+            with self.assertRaises(datastore.RepoDBError):
+                with repo.database._transaction(timeout=0.1):
+                    pass
+            # the use of an image is recorded while another process is writing
+            repo.mark_used(prgenvgnu_records[0])
+        finally:
+            release.set()
+            process.join()
+        self.assertEqual(1, repo.image_usage()["a"*64]["uses"])
+
+    def test_retry_busy(self):
+        attempts = []
+        def busy():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise sqlite3.OperationalError("database is locked")
+            return "done"
+        self.assertEqual("done", datastore.retry_busy(busy))
+        self.assertEqual(3, len(attempts))
+
+        # other errors, and errors after the timeout, are raised
+        def corrupt():
+            raise sqlite3.OperationalError("no such table: records")
+        def locked():
+            raise sqlite3.OperationalError("database is locked")
+        with self.assertRaises(sqlite3.OperationalError):
+            datastore.retry_busy(corrupt)
+        with self.assertRaises(sqlite3.OperationalError):
+            datastore.retry_busy(locked, timeout=0.1)
+
+    def test_readers_and_writer(self):
+        # hundreds of processes resolve images while another adds records one at a time
+        context = multiprocessing.get_context("fork")
+        start = context.Event()
+        def write():
+            start.wait(10)
+            repo = datastore.FileSystemRepo(self.repo_path)
+            for i in range(50):
+                repo.add_record(record.Record("santis", "gh200", "icon", f"{i}", "v1", "monday", 1024, f"{i:04d}"*16))
+            os._exit(0)
+        def read():
+            start.wait(10)
+            try:
+                for i in range(5):
+                    repo = datastore.FileSystemRepo(self.repo_path, readonly=True)
+                    results = repo.database.find_records(name="prgenv-gnu", version="24.2", tag="v1")
+                    if not results.is_unique_sha or results.records[0].sha256 != "b"*64:
+                        os._exit(2)
+                    repo.database.find_records(name="icon").records
+                    repo.database.close()
+            except Exception:
+                os._exit(1)
+            os._exit(0)
+        processes = [context.Process(target=write)] + [context.Process(target=read) for _ in range(200)]
+        for process in processes:
+            process.start()
+        start.set()
+        for process in processes:
+            process.join(120)
+        self.assertEqual([0]*len(processes), [process.exitcode for process in processes])
+        self.assertEqual(50, len(datastore.FileSystemRepo(self.repo_path).database.find_records(name="icon").records))
+
+def table_definitions(db_path) -> dict:
+    """the columns of each table in a database, as returned by PRAGMA table_info"""
+    store = sqlite3.connect(db_path)
+    tables = [row[0] for row in store.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    definitions = {table: store.execute(f"PRAGMA table_info({table})").fetchall() for table in tables}
+    store.close()
+    return definitions
+
 class TestUpgrade(unittest.TestCase):
 
     def setUp(self):
@@ -275,7 +1062,7 @@ class TestUpgrade(unittest.TestCase):
 
         # TODO: add checks that a v2 database is correctly identified and no action is taken
 
-    def test_v1_to_v2(self):
+    def test_v1_upgrade(self):
 
         repo_path = self.path.as_posix()
 
@@ -285,10 +1072,17 @@ class TestUpgrade(unittest.TestCase):
         self.assertEqual(datastore.repo_status(repo_path), 0)
 
         # perform upgrade
-        datastore.repo_upgrade(repo_path)
+        report = datastore.repo_upgrade(repo_path)
+        self.assertEqual((1, datastore.db_version), (report["from"], report["to"]))
+
+        # the original database is saved before it is upgraded in place
+        backup = sqlite3.connect(report["backup"])
+        self.assertEqual(["date", "id", "sha256", "size", "system", "uarch"],
+                         sorted(row[1] for row in backup.execute("PRAGMA table_info(images)")))
+        backup.close()
 
         # open the upgraded database and check contents
-        self.assertEqual(datastore.repo_version(repo_path), 2) 
+        self.assertEqual(datastore.repo_version(repo_path), datastore.db_version)
 
         store = datastore.FileSystemRepo(self.path.as_posix())
         db = store.database
@@ -298,6 +1092,50 @@ class TestUpgrade(unittest.TestCase):
         self.assertEqual(len(db.find_records(sha="c"*64).records),  1)
         self.assertEqual(len(db.find_records(name="prgenv-gnu").records),  5)
         self.assertEqual(len(db.find_records(tag="v1").records),  2)
+        self.assertEqual(["24.2"]*2, [r.version for r in db.find_records(name="prgenv-gnu", version="latest").records])
+        self.assertEqual(db.version, datastore.db_version)
+        self.assertEqual(sorted(datastore.indexes),
+                         sorted(row[0] for row in db._store.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+                                if row[0] in datastore.indexes))
+
+        # an up to date database is not modified
+        self.assertIsNone(datastore.repo_upgrade(repo_path))
+
+        # the upgraded tables are the same as those of a new repository
+        datastore.FileSystemRepo.create((self.path / "new").as_posix())
+        self.assertEqual(table_definitions(self.path / "new" / "index.db"), table_definitions(self.db_path))
+
+    def test_v2_upgrade(self):
+        os.remove(self.db_path)
+        create_v2_db(self.db_path)
+        repo_path = self.path.as_posix()
+        self.assertEqual(datastore.repo_version(repo_path), 2)
+        self.assertEqual(datastore.repo_status(repo_path), 0)
+
+        report = datastore.repo_upgrade(repo_path)
+        self.assertEqual((2, datastore.db_version), (report["from"], report["to"]))
+
+        # the version key of each existing uenv is computed
+        db = datastore.FileSystemRepo(repo_path).database
+        self.assertEqual({("23.11", "0223.0211"), ("24.2", "0224.012")},
+                         set(db._store.execute("SELECT version, version_key FROM uenv")))
+        self.assertEqual(sorted(prgenvgnu_records), sorted(db.images.records))
+        self.assertEqual(["b"*64]*2, [r.sha256 for r in db.find_records(name="prgenv-gnu", version="latest").records])
+        db.close()
+
+        datastore.FileSystemRepo.create((self.path / "new").as_posix())
+        self.assertEqual(table_definitions(self.path / "new" / "index.db"), table_definitions(self.db_path))
+
+    def test_unknown_version(self):
+        store = datastore.DataStore(self.db_path.as_posix())
+        store._version = datastore.db_version + 1
+        with self.assertRaises(datastore.RepoDBError):
+            store.upgrade()
+        store._version = -1
+        with self.assertRaises(datastore.RepoDBError):
+            store.upgrade()
+        store.close()
+        self.assertEqual(datastore.repo_version(self.path.as_posix()), 1)
 
     def tearDown(self):
         shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,141 @@
+import gzip
+import time
+import unittest
+
+import httpclient
+import standin
+
+class ScriptedServer(standin.StandinServer):
+    """
+    Responds to each request with the next (status, delay) pair in a script,
+    repeating the last pair when the script is exhausted.
+    """
+    def __init__(self, script, body=b"hello"):
+        super().__init__()
+        self.script = list(script)
+        self.body = body
+
+    def respond(self, request):
+        status, delay = self.script.pop(0) if len(self.script) > 1 else self.script[0]
+        time.sleep(delay)
+        return (status, {}, self.body if status == 200 else b"")
+
+class GzipServer(standin.StandinServer):
+    def respond(self, request):
+        return (200, {"Content-Encoding": "gzip"}, gzip.compress(b"compressed " * 100))
+
+def make_client(**kwargs):
+    options = {"retries": 3, "backoff": 0.01, "max_backoff": 0.05, "timeout": (1.0, 1.0), "hedge_delay": 0.2}
+    options.update(kwargs)
+    return httpclient.Client(**options)
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def server(self, *args, **kwargs):
+        server = ScriptedServer(*args, **kwargs)
+        self.servers.append(server)
+        return server
+
+    def test_transient_error(self):
+        server = self.server([(503, 0), (502, 0), (200, 0)])
+        client = make_client()
+        response = client.get(server.url)
+        self.assertEqual(response.content, b"hello")
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(client.stats["retries"], 2)
+        self.assertEqual(client.stats["failures"], 0)
+
+    def test_retries_exhausted(self):
+        server = self.server([(503, 0)])
+        client = make_client(retries=2)
+        with self.assertRaises(httpclient.RequestError) as context:
+            client.get(server.url)
+        self.assertEqual(context.exception.status, 503)
+        self.assertEqual(len(server.requests), 3)
+
+    def test_no_retry(self):
+        server = self.server([(404, 0)])
+        client = make_client()
+        with self.assertRaises(httpclient.RequestError) as context:
+            client.get(server.url)
+        self.assertEqual(context.exception.status, 404)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_timeout(self):
+        server = self.server([(200, 0.5), (200, 0)])
+        client = make_client(timeout=(1.0, 0.2))
+        self.assertEqual(client.get(server.url).content, b"hello")
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(client.stats["retries"], 1)
+
+    def test_connection_refused(self):
+        server = self.server([(200, 0)])
+        url = server.url
+        server.close()
+        client = make_client(retries=1)
+        with self.assertRaises(httpclient.RequestError):
+            client.get(url)
+        self.assertEqual(client.stats["requests"], 2)
+
+    def test_compression(self):
+        server = GzipServer()
+        self.servers.append(server)
+        response = make_client().get(server.url)
+        self.assertEqual(response.content, b"compressed " * 100)
+        self.assertIn("gzip", server.requests[0]["headers"]["Accept-Encoding"])
+
+class TestHedging(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def server(self, *args, **kwargs):
+        server = ScriptedServer(*args, **kwargs)
+        self.servers.append(server)
+        return server
+
+    def test_fast_primary(self):
+        primary = self.server([(200, 0)], b"primary")
+        mirror = self.server([(200, 0)], b"mirror")
+        client = make_client()
+        self.assertEqual(client.get(primary.url, hedge_url=mirror.url).content, b"primary")
+        self.assertEqual(len(mirror.requests), 0)
+        self.assertEqual(client.stats["hedged"], 0)
+
+    def test_slow_primary(self):
+        primary = self.server([(200, 0.8)], b"primary")
+        mirror = self.server([(200, 0)], b"mirror")
+        client = make_client(timeout=(1.0, 2.0))
+        self.assertEqual(client.get(primary.url, hedge_url=mirror.url).content, b"mirror")
+        self.assertEqual(client.stats["hedged"], 1)
+        self.assertEqual(client.stats["hedge_wins"], 1)
+
+    def test_failed_primary(self):
+        primary = self.server([(500, 0)], b"primary")
+        mirror = self.server([(200, 0)], b"mirror")
+        client = make_client(retries=0, hedge_delay=5.0)
+        start = time.perf_counter()
+        self.assertEqual(client.get(primary.url, hedge_url=mirror.url).content, b"mirror")
+        # the mirror is queried as soon as the primary fails
+        self.assertLess(time.perf_counter() - start, 2.0)
+
+    def test_both_fail(self):
+        primary = self.server([(404, 0)])
+        mirror = self.server([(404, 0)])
+        client = make_client()
+        with self.assertRaises(httpclient.RequestError):
+            client.get(primary.url, hedge_url=mirror.url)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import json
+import unittest
+
+import jfrog
+import record
+import standin
+
+entries = [
+    ("deploy/santis/gh200/prgenv-gnu/24.2/v1",   "a"*64, "2024-03-04T09:05:44.034Z"),
+    ("deploy/santis/gh200/prgenv-gnu/24.2/v2",   "b"*64, "2024-04-04T09:05:44.000Z"),
+    ("build/santis/gh200/prgenv-gnu/24.2/12345", "b"*64, "2024-04-03T19:15:04.123Z"),
+    ("build/santis/gh200/icon/2024/12346",       "c"*64, "2024-04-05T10:00:00.000Z"),
+    ("build/santis/gh200/ünicode/2024/12347",    "d"*64, "2024-04-05T10:00:00.000Z"),
+]
+
+def chunked(body: bytes, size: int):
+    return [body[i:i+size] for i in range(0, len(body), size)]
+
+class TestListingReader(unittest.TestCase):
+
+    def test_chunk_sizes(self):
+        # the range object is placed first to check that other keys are skipped
+        listing = standin.listing(entries)
+        body = json.dumps({"range": listing["range"], "results": listing["results"]}, indent=2).encode()
+        for size in [1, 2, 7, 64, len(body)]:
+            results = list(jfrog.ListingReader(chunked(body, size)).results())
+            self.assertEqual(results, listing["results"])
+
+    def test_numbers(self):
+        # numbers that are split between chunks, e.g. "1." and "5e10", are decoded whole
+        listing = standin.listing(entries)
+        listing["results"][0]["score"] = 1.5e10
+        listing["results"][1]["score"] = [-0.25, 12, 3E-7, 1e5]
+        listing["range"]["elapsed"] = 104.125
+        body = json.dumps({"results": listing["results"], "range": listing["range"]}).encode()
+        for size in [1, 2, 3]:
+            results = list(jfrog.ListingReader(chunked(body, size)).results())
+            self.assertEqual(results, listing["results"])
+        body = b'{"results": [1.5, 2e10, 100]}'
+        self.assertEqual(list(jfrog.ListingReader(chunked(body, 1)).results()), [1.5, 2e10, 100])
+
+    def test_empty(self):
+        body = json.dumps(standin.listing([])).encode()
+        self.assertEqual(list(jfrog.ListingReader(chunked(body, 3)).results()), [])
+
+    def test_truncated(self):
+        body = json.dumps(standin.listing(entries)).encode()
+        with self.assertRaises(ValueError):
+            list(jfrog.ListingReader(chunked(body[:-40], 16)).results())
+
+    def test_load_namespace(self):
+        body = json.dumps(standin.listing(entries)).encode()
+        deploy = jfrog.load_namespace(chunked(body, 10), "deploy")
+        build = jfrog.load_namespace(chunked(body, 10), "build")
+
+        self.assertEqual(len(deploy.images.records), 2)
+        self.assertEqual(len(build.images.records), 3)
+        r = deploy.find_records(tag="v1").records[0]
+        self.assertEqual(r.date, str(record.Record.to_datetime("2024-03-04T09:05:44.034Z")))
+        self.assertEqual(r.size, 1024)
+        self.assertEqual(len(build.find_records(name="ünicode").records), 1)
+
+    def test_prefilter(self):
+        body = json.dumps(standin.listing(entries)).encode()
+
+        build = jfrog.load_namespace([body], "build", name="prgenv-gnu")
+        self.assertEqual(["12345"], [r.tag for r in build.images.records])
+
+        build = jfrog.load_namespace([body], "build", system="santis", uarch="gh200")
+        self.assertEqual(3, len(build.images.records))
+
+        build = jfrog.load_namespace([body], "build", system="todi")
+        self.assertTrue(build.images.is_empty)
+
+        with self.assertRaises(RuntimeError):
+            jfrog.load_namespace([body], "foo")
+
+    def test_load_namespaces(self):
+        body = json.dumps(standin.listing(entries)).encode()
+        databases = jfrog.load_namespaces(chunked(body, 10), {"deploy": None, "build": lambda r: r.name == "icon"},
+                                          batch_size=1)
+        self.assertEqual(["v1", "v2"], sorted(r.tag for r in databases["deploy"].images.records))
+        self.assertEqual(["12346"], [r.tag for r in databases["build"].images.records])
+
+        with self.assertRaises(RuntimeError):
+            jfrog.load_namespaces([body], {"foo": None})
+
+class TestDates(unittest.TestCase):
+
+    def test_to_datestring(self):
+        for date in ["2023-12-04T09:05:44.034Z", "2023-12-04T09:05:44.000Z",
+                     "2023-12-04T09:05:44.100Z", "2024-02-29T23:59:59.999Z",
+                     "2023-12-04T09:05:44.5Z"]:
+            self.assertEqual(record.Record.to_datestring(date), str(record.Record.to_datetime(date)))
+
+if __name__ == '__main__':
+    unittest.main()
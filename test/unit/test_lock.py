@@ -0,0 +1,82 @@
+import multiprocessing
+import os
+import shutil
+import socket
+import time
+import unittest
+
+import lock
+import scratch
+
+def hold(path, ready, release, heartbeat, age):
+    """hold the lock on path in another process until release is set"""
+    held = lock.FileLock(path, heartbeat=heartbeat)
+    held.acquire()
+    if age:
+        old = time.time() - age
+        os.utime(path, (old, old))
+    ready.set()
+    release.wait(10)
+    held.release()
+
+class TestFileLock(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("lock")
+        self.lock_path = (self.path / "locks" / "image.lock").as_posix()
+        # POSIX locks are per process, so the lock is held by a child process
+        self.context = multiprocessing.get_context("fork")
+        self.ready = self.context.Event()
+        self.release = self.context.Event()
+        self.process = None
+
+    def tearDown(self):
+        if self.process is not None:
+            self.release.set()
+            self.process.join()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def hold(self, heartbeat=None, age=0):
+        self.process = self.context.Process(target=hold,
+                args=(self.lock_path, self.ready, self.release, heartbeat, age))
+        self.process.start()
+        self.assertTrue(self.ready.wait(10))
+
+    def test_acquire(self):
+        image_lock = lock.FileLock(self.lock_path)
+        self.assertTrue(image_lock.acquire(timeout=0))
+        self.assertTrue(image_lock.locked)
+        image_lock.release()
+        self.assertFalse(image_lock.locked)
+
+    def test_wait(self):
+        self.hold()
+        image_lock = lock.FileLock(self.lock_path, poll=0.05)
+        self.assertFalse(image_lock.acquire(timeout=0))
+        self.assertEqual(image_lock.holder(), f"{socket.gethostname()} {self.process.pid}")
+        start = time.monotonic()
+        self.assertFalse(image_lock.acquire(timeout=0.3))
+        self.assertGreater(time.monotonic() - start, 0.25)
+
+        # the lock is acquired as soon as it is released
+        self.release.set()
+        self.assertTrue(image_lock.acquire(timeout=5))
+        image_lock.release()
+
+    def test_stale(self):
+        # a holder that stopped updating the lock
+        self.hold(heartbeat=100, age=120)
+        image_lock = lock.FileLock(self.lock_path, stale=60, poll=0.05)
+        self.assertTrue(image_lock.acquire(timeout=1))
+        image_lock.release()
+        self.assertEqual(image_lock.holder(), f"{socket.gethostname()} {os.getpid()}")
+
+    def test_heartbeat(self):
+        # a holder that updates the lock is not stale
+        self.hold(heartbeat=0.05, age=120)
+        time.sleep(0.2)
+        image_lock = lock.FileLock(self.lock_path, stale=60, poll=0.05)
+        self.assertFalse(image_lock.acquire(timeout=0.2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,3 +20,11 @@ class TestUenvParsing(unittest.TestCase):
                          {'name': None, 'version': None, 'tag': None, 'sha': '1736b4bb5ad9b3c5cae8878c71782a8bf2f2f739dbce8e039b629de418cb4dab'})
         self.assertEqual(names.parse_uenv_string('1736b4bb5ad9b3c5'),
                          {'name': None, 'version': None, 'tag': None, 'sha': '1736b4bb5ad9b3c5'})
+
+    def test_version_key(self):
+        self.assertEqual(names.version_key("24.10"), "0224.0210")
+        self.assertEqual(names.version_key("v2-rc1"), "v.012.rc.011")
+        self.assertEqual(names.version_key("24.07"), names.version_key("24.7"))
+        versions = ["2024", "24.10", "23.11", "24.2-rc1", "24.2", "24.2.1", "v10", "v9"]
+        self.assertEqual(["23.11", "24.2", "24.2.1", "24.2-rc1", "24.10", "2024", "v9", "v10"],
+                         sorted(versions, key=names.version_key))
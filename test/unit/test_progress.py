@@ -0,0 +1,33 @@
+import unittest
+
+import progress
+
+class TestThroughput(unittest.TestCase):
+
+    def test_rates(self):
+        meter = progress.Throughput(window=2.0)
+        start = meter._start
+        mb = 1024*1024
+        # 10 MB/s for 4 seconds, then 1 MB/s for 2 seconds
+        for i in range(1, 5):
+            meter.update(10*mb*i, start + i)
+        self.assertAlmostEqual(meter.rate, 10*mb)
+        meter.update(41*mb, start + 5)
+        meter.update(42*mb, start + 6)
+        self.assertAlmostEqual(meter.rate, mb)
+        self.assertAlmostEqual(meter.average, 7*mb)
+        self.assertAlmostEqual(meter.eta(10*mb), 10.0)
+
+    def test_message(self):
+        meter = progress.Throughput()
+        self.assertIsNone(meter.eta(100))
+        meter.update(2*1024*1024, meter._start + 2)
+        self.assertEqual(meter.message(3*1024*1024, 5*1024*1024), "3/5 MB 1.0 MB/s (avg 1.0 MB/s) ETA 0:02")
+
+    def test_format_duration(self):
+        self.assertEqual(progress.format_duration(8), "0:08")
+        self.assertEqual(progress.format_duration(605.5), "10:05")
+        self.assertEqual(progress.format_duration(3725), "1:02:05")
+
+if __name__ == '__main__':
+    unittest.main()
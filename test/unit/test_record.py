@@ -0,0 +1,54 @@
+import copy
+import unittest
+
+import names
+import record
+
+def make(system="santis", uarch="gh200", name="prgenv-gnu", version="24.7", tag="v1", sha="a"*64):
+    return record.Record(system, uarch, name, version, tag, "2024-07-01 09:05:44+00:00", 1024, sha)
+
+class TestRecord(unittest.TestCase):
+
+    def test_fields(self):
+        r = make()
+        self.assertEqual("prgenv-gnu/24.7:v1", r.full_name)
+        self.assertEqual("a"*16, r.id)
+        self.assertEqual(1024, r.size)
+        self.assertEqual({"system": "santis", "uarch": "gh200", "name": "prgenv-gnu",
+                          "date": "2024-07-01 09:05:44+00:00", "version": "24.7", "tag": "v1",
+                          "sha256": "a"*64, "id": "a"*16, "size": 1024},
+                         r.dictionary)
+        # the fields are stored in slots
+        with self.assertRaises(AttributeError):
+            r.extra = 1
+
+    def test_order(self):
+        records = [make(tag="v2", sha="b"*64), make(system="todi"), make(version="24.2"),
+                   make(sha="c"*64), make(), make(uarch="zen2"), make(name="icon")]
+        expected = [(r.system, r.uarch, r.name, names.version_key(r.version), names.version_key(r.tag), r.id)
+                    for r in records]
+        expected.sort()
+        self.assertEqual(expected, [r.sort_key for r in sorted(records)])
+        self.assertTrue(make() < make(sha="c"*64))
+        self.assertFalse(make() < make())
+
+    def test_version_order(self):
+        # versions and tags are ordered by the value of their numeric fields
+        records = [make(version="24.10"), make(version="24.2"), make(version="24.2", tag="v10"),
+                   make(version="24.2", tag="v9"), make(version="2024")]
+        self.assertEqual(["24.2:v1", "24.2:v9", "24.2:v10", "24.10:v1", "2024:v1"],
+                         [f"{r.version}:{r.tag}" for r in sorted(records)])
+
+    def test_set_tag(self):
+        r = make(tag="v1")
+        s = make(tag="v2", sha="b"*64)
+        self.assertTrue(r < s)
+        r.tag = "v3"
+        self.assertEqual(names.version_key("v3"), r.sort_key[4])
+        self.assertTrue(s < r)
+
+        # copies are independent
+        c = copy.deepcopy(r)
+        c.tag = "v0"
+        self.assertEqual("v3", r.tag)
+        self.assertTrue(c < s)
@@ -0,0 +1,327 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+import time
+import unittest
+
+import record
+import registry
+import scratch
+import standin
+import verify
+
+repository = "uenv/deploy/santis/gh200/prgenv-gnu/24.2"
+
+def squashfs(size: int) -> bytes:
+    return bytes(i % 251 for i in range(size))
+
+def meta_archive() -> bytes:
+    data = b'{"name": "prgenv-gnu"}'
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        info = tarfile.TarInfo("meta/env.json")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+class TestAddress(unittest.TestCase):
+
+    def test_parse_address(self):
+        self.assertEqual(registry.parse_address(f"jfrog.svc.cscs.ch/{repository}:v2"),
+                         ("jfrog.svc.cscs.ch", repository, "v2"))
+        self.assertEqual(registry.parse_address(f"localhost:5000/{repository}:v2"),
+                         ("localhost:5000", repository, "v2"))
+        self.assertEqual(registry.parse_address(f"localhost:5000/{repository}"),
+                         ("localhost:5000", repository, "latest"))
+        self.assertEqual(registry.parse_address(f"jfrog.svc.cscs.ch/{repository}@sha256:abc"),
+                         ("jfrog.svc.cscs.ch", repository, "sha256:abc"))
+        with self.assertRaises(registry.RegistryError):
+            registry.parse_address("jfrog.svc.cscs.ch")
+
+class TestPull(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("registry")
+        self.image_path = (self.path / "image").as_posix()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def server(self, **kwargs):
+        server = standin.RegistryServer(**kwargs)
+        self.servers.append(server)
+        return server
+
+    def store(self):
+        with open(self.image_path + "/store.squashfs", "rb") as fid:
+            return fid.read()
+
+    def test_range_requests(self):
+        server = self.server()
+        data = squashfs(10000)
+        server.add_image(repository, "v2", {"store.squashfs": data})
+
+        client = registry.Registry(server.url, concurrency=4, chunk_size=1000)
+        stats = client.pull(repository, "v2", self.image_path)
+        self.assertEqual(self.store(), data)
+        self.assertEqual(stats["source"], server.url)
+        self.assertEqual(stats["bytes"], 10000)
+        self.assertEqual(stats["retries"], 0)
+
+        ranges = [r["headers"].get("Range") for r in server.requests if "/blobs/" in r["path"]]
+        self.assertEqual(len(ranges), 10)
+        self.assertIn("bytes=9000-9999", ranges)
+        self.assertFalse(registry.is_partial_pull(self.image_path))
+        self.assertTrue(os.path.isfile(self.image_path + "/manifest.json"))
+
+    def test_uneven_chunks(self):
+        server = self.server()
+        data = squashfs(10001)
+        server.add_image(repository, "v2", {"store.squashfs": data})
+        registry.Registry(server.url, concurrency=3, chunk_size=1000).pull(repository, "v2", self.image_path)
+        self.assertEqual(self.store(), data)
+
+    def test_small_blob(self):
+        server = self.server()
+        data = squashfs(500)
+        server.add_image(repository, "v2", {"store.squashfs": data})
+        registry.Registry(server.url, concurrency=4, chunk_size=1000).pull(repository, "v2", self.image_path)
+        self.assertEqual(self.store(), data)
+        ranges = [r["headers"].get("Range") for r in server.requests if "/blobs/" in r["path"]]
+        self.assertEqual(ranges, [None])
+
+    def test_no_range_support(self):
+        server = self.server(ranges=False)
+        data = squashfs(10000)
+        server.add_image(repository, "v2", {"store.squashfs": data})
+        registry.Registry(server.url, concurrency=4, chunk_size=1000).pull(repository, "v2", self.image_path)
+        self.assertEqual(self.store(), data)
+        self.assertEqual(len([r for r in server.requests if "/blobs/" in r["path"]]), 1)
+
+    def test_short_ranges(self):
+        # a range that is cut short is resumed from the last byte written
+        server = self.server(max_range=600)
+        data = squashfs(10000)
+        server.add_image(repository, "v2", {"store.squashfs": data})
+        stats = registry.Registry(server.url, concurrency=4, chunk_size=1000).pull(repository, "v2", self.image_path)
+        self.assertEqual(self.store(), data)
+        self.assertEqual(stats["retries"], 10)
+
+    def test_empty_ranges(self):
+        # a registry that returns no data fails after a bounded number of attempts
+        server = self.server(max_range=0)
+        server.add_image(repository, "v2", {"store.squashfs": squashfs(10000)})
+        with self.assertRaises(registry.RegistryError):
+            registry.Registry(server.url, concurrency=4, chunk_size=1000).pull(repository, "v2", self.image_path)
+        self.assertLessEqual(len([r for r in server.requests if "/blobs/" in r["path"]]), 40)
+
+    def test_meta_directory(self):
+        server = self.server()
+        server.add_image(repository, "v2", {"store.squashfs": squashfs(100)})
+        server.add_directory(repository, "v2", "meta", meta_archive())
+        registry.Registry(server.url).pull(repository, "v2", self.image_path)
+        self.assertTrue(os.path.isfile(self.image_path + "/meta/env.json"))
+        self.assertEqual(sorted(os.listdir(self.image_path)), ["manifest.json", "meta", "store.squashfs"])
+
+    def test_token(self):
+        server = self.server(token="secret")
+        data = squashfs(5000)
+        server.add_image(repository, "v2", {"store.squashfs": data})
+        registry.Registry(server.url, concurrency=2, chunk_size=1000).pull(repository, "v2", self.image_path)
+        self.assertEqual(self.store(), data)
+        token_requests = [r for r in server.requests if r["path"].startswith("/token")]
+        self.assertEqual(len(token_requests), 1)
+        self.assertIn(f"repository%3A{repository.replace('/', '%2F')}%3Apull", token_requests[0]["path"])
+
+    def test_stamps(self):
+        server = self.server()
+        data = squashfs(5000)
+        server.add_image(repository, "v2", {"store.squashfs": data})
+        stamps = verify.Stamps(self.path.as_posix())
+        registry.Registry(server.url, concurrency=2, chunk_size=1000).pull(
+                repository, "v2", self.image_path, stamps=stamps)
+
+        # the files downloaded by the pull do not need to be hashed again
+        with open(self.image_path + "/manifest.json", "rb") as fid:
+            sha = hashlib.sha256(fid.read()).hexdigest()
+        self.assertTrue(stamps.is_verified(f"{sha}/store.squashfs", self.image_path + "/store.squashfs",
+                                           hashlib.sha256(data).hexdigest()))
+        self.assertEqual(verify.verify_image(self.image_path, sha), verify.OK)
+
+    def test_manifest_digest(self):
+        server = self.server()
+        server.add_image(repository, "v2", {"store.squashfs": squashfs(100)})
+        client = registry.Registry(server.url)
+        with self.assertRaises(registry.RegistryError):
+            client.pull(repository, "v2", self.image_path, digest="0"*64)
+
+    def test_missing_image(self):
+        server = self.server()
+        client = registry.Registry(server.url)
+        with self.assertRaises(registry.RegistryError):
+            client.pull(repository, "v3", self.image_path)
+
+class TestPullMany(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("registry_many")
+        self.server = standin.RegistryServer()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_pull_many(self):
+        images = []
+        for i, tag in enumerate(["v1", "v2", "v3"]):
+            data = squashfs(3000 + i)
+            self.server.add_image(repository, tag, {"store.squashfs": data})
+            sha = self.server.digest(repository, tag)
+            target = record.Record("santis", "gh200", "prgenv-gnu", "24.2", tag, "", len(data), sha)
+            path = (self.path / tag).as_posix()
+            images.append((f"{self.server.url}/{repository}:{tag}", path, target, tag))
+        # an image that is not in the registry
+        target = record.Record("santis", "gh200", "prgenv-gnu", "24.2", "v4", "", 100, "0"*64)
+        images.append((f"{self.server.url}/{repository}:v4", (self.path / "v4").as_posix(), target, "v4"))
+
+        errors, statistics = registry.pull_many(images, parallel=2)
+        self.assertEqual(list(errors.keys()), [3])
+        self.assertEqual(sorted(statistics.keys()), [0, 1, 2])
+        self.assertEqual(statistics[2]["bytes"], 3002)
+        for i, tag in enumerate(["v1", "v2", "v3"]):
+            with open((self.path / tag / "store.squashfs").as_posix(), "rb") as fid:
+                self.assertEqual(fid.read(), squashfs(3000 + i))
+
+class TestRateLimit(unittest.TestCase):
+
+    def test_parse_rate(self):
+        self.assertEqual(registry.parse_rate("1000"), 1000)
+        self.assertEqual(registry.parse_rate("500K"), 500*1024)
+        self.assertEqual(registry.parse_rate("1.5m"), 1.5*1024*1024)
+        self.assertEqual(registry.parse_rate("2GB"), 2*1024**3)
+        for rate in ["", "fast", "-1M", "0"]:
+            with self.assertRaises(ValueError):
+                registry.parse_rate(rate)
+
+    def test_rate_limiter(self):
+        limiter = registry.RateLimiter(10000)
+        start = time.monotonic()
+        # the first second is a burst
+        limiter.consume(10000)
+        self.assertLess(time.monotonic() - start, 0.2)
+        limiter.consume(5000)
+        self.assertGreater(time.monotonic() - start, 0.4)
+
+    def test_limited_pull(self):
+        path = scratch.make_scratch_path("registry_rate")
+        server = standin.RegistryServer()
+        try:
+            data = squashfs(40000)
+            server.add_image(repository, "v2", {"store.squashfs": data})
+            client = registry.Registry(server.url, concurrency=4, chunk_size=5000,
+                                       limiter=registry.RateLimiter(40000))
+            start = time.monotonic()
+            client.pull(repository, "v2", (path / "image").as_posix())
+            # 40 kB at 40 kB/s, after a burst of 40 kB
+            self.assertLess(time.monotonic() - start, 0.5)
+            client = registry.Registry(server.url, concurrency=4, chunk_size=5000,
+                                       limiter=registry.RateLimiter(20000))
+            start = time.monotonic()
+            client.pull(repository, "v2", (path / "image").as_posix())
+            self.assertGreater(time.monotonic() - start, 0.8)
+        finally:
+            server.close()
+            shutil.rmtree(path, ignore_errors=True)
+
+class FailingRegistryServer(standin.RegistryServer):
+    """a registry that fails all blob requests after the first limit requests"""
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+
+    def respond(self, request):
+        if "/blobs/" in request.path:
+            if self.limit == 0:
+                return (404, {}, b"")
+            self.limit -= 1
+        return super().respond(request)
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("registry_resume")
+        self.image_path = (self.path / "image").as_posix()
+        self.data = squashfs(10000)
+        self.server = FailingRegistryServer(limit=4)
+        self.server.add_image(repository, "v2", {"store.squashfs": self.data})
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def client(self):
+        return registry.Registry(self.server.url, concurrency=2, chunk_size=1000)
+
+    def blob_requests(self):
+        return len([r for r in self.server.requests if "/blobs/" in r["path"]])
+
+    def interrupt(self):
+        with self.assertRaises(registry.RegistryError):
+            self.client().pull(repository, "v2", self.image_path)
+        self.assertTrue(registry.is_partial_pull(self.image_path))
+        with open(self.image_path + "/" + registry.state_file) as fid:
+            layers = json.load(fid)["layers"]
+        return list(layers.values())[0]["ranges"]
+
+    def test_resume(self):
+        # ranges that were in flight when the pull failed may not have completed
+        completed = self.interrupt()
+        self.assertTrue(0 < len(completed) <= 4)
+
+        # only the missing ranges are downloaded when the pull is resumed
+        self.server.limit = -1
+        before = self.blob_requests()
+        stats = self.client().pull(repository, "v2", self.image_path)
+        self.assertEqual(self.blob_requests() - before, 10 - len(completed))
+        # the bytes that were downloaded by the first pull are not counted
+        self.assertEqual(stats["bytes"], 10000 - sum(end-start+1 for start, end in completed))
+        with open(self.image_path + "/store.squashfs", "rb") as fid:
+            self.assertEqual(fid.read(), self.data)
+        self.assertFalse(registry.is_partial_pull(self.image_path))
+
+    def test_corrupt_partial(self):
+        completed = self.interrupt()
+
+        # corrupt a completed range: the digest check fails and the layer is restarted
+        start = completed[0][0]
+        with open(self.image_path + "/store.squashfs", "r+b") as fid:
+            fid.seek(start)
+            fid.write(b"x")
+        self.server.limit = -1
+        with self.assertRaises(registry.RegistryError):
+            self.client().pull(repository, "v2", self.image_path)
+        self.assertFalse(os.path.exists(self.image_path + "/store.squashfs"))
+
+        self.client().pull(repository, "v2", self.image_path)
+        with open(self.image_path + "/store.squashfs", "rb") as fid:
+            self.assertEqual(fid.read(), self.data)
+
+    def test_other_image(self):
+        self.interrupt()
+        with open(self.image_path + "/" + registry.state_file, "w") as fid:
+            json.dump({"digest": "0"*64, "layers": {}}, fid)
+
+        # a partial pull of another image is discarded
+        self.server.limit = -1
+        before = self.blob_requests()
+        self.client().pull(repository, "v2", self.image_path)
+        self.assertEqual(self.blob_requests() - before, 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import shutil
+import unittest
+
+import scratch
+import verify
+
+def make_image(image_path: str, files: dict) -> str:
+    """create an image with a manifest in image_path, returning the sha256 of the image"""
+    os.makedirs(image_path)
+    layers = []
+    for title, contents in files.items():
+        with open(f"{image_path}/{title}", "wb") as fid:
+            fid.write(contents)
+        layers.append({
+            "digest": "sha256:" + hashlib.sha256(contents).hexdigest(),
+            "size": len(contents),
+            "annotations": {"org.opencontainers.image.title": title},
+        })
+    raw = json.dumps({"schemaVersion": 2, "layers": layers}).encode()
+    with open(f"{image_path}/manifest.json", "wb") as fid:
+        fid.write(raw)
+    return hashlib.sha256(raw).hexdigest()
+
+class TestVerify(unittest.TestCase):
+
+    def setUp(self):
+        self.path = scratch.make_scratch_path("verify")
+        self.repo = self.path.as_posix()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_file_sha256(self):
+        data = os.urandom(3*verify.buffer_size + 17)
+        with open(self.repo + "/file", "wb") as fid:
+            fid.write(data)
+        self.assertEqual(verify.file_sha256(self.repo + "/file"), hashlib.sha256(data).hexdigest())
+
+    def test_verify_image(self):
+        image = self.repo + "/images/a"
+        sha = make_image(image, {"store.squashfs": b"squashfs"})
+        self.assertEqual(verify.verify_image(image, sha), verify.OK)
+        self.assertEqual(verify.verify_image(image, "0"*64), verify.MISMATCH)
+        self.assertEqual(verify.verify_image(self.repo + "/images/b", sha), verify.MISSING)
+
+        with open(image + "/store.squashfs", "wb") as fid:
+            fid.write(b"truncated")
+        self.assertEqual(verify.verify_image(image, sha), verify.MISMATCH)
+
+        os.remove(image + "/store.squashfs")
+        self.assertEqual(verify.verify_image(image, sha), verify.MISSING)
+
+        os.remove(image + "/manifest.json")
+        self.assertEqual(verify.verify_image(image, sha), verify.UNVERIFIED)
+
+    def test_verify_images(self):
+        images = []
+        for i in range(4):
+            image = f"{self.repo}/images/{i}"
+            images.append((image, make_image(image, {"store.squashfs": bytes([i])*1000})))
+        with open(images[2][0] + "/store.squashfs", "ab") as fid:
+            fid.write(b"x")
+
+        results = verify.verify_images(images, verify.Stamps(self.repo), jobs=2)
+        self.assertEqual([results[sha] for _, sha in images], [verify.OK, verify.OK, verify.MISMATCH, verify.OK])
+        self.assertTrue(os.path.isfile(self.repo + "/verified.json"))
+
+    def test_stamps(self):
+        image = self.repo + "/images/a"
+        sha = make_image(image, {"store.squashfs": b"squashfs"})
+        verify.verify_images([(image, sha)], verify.Stamps(self.repo))
+
+        # files that have a stamp are not hashed again
+        file_sha256 = verify.file_sha256
+        def fail(path):
+            raise AssertionError(f"{path} was hashed")
+        verify.file_sha256 = fail
+        try:
+            self.assertEqual(verify.verify_images([(image, sha)], verify.Stamps(self.repo)), {sha: verify.OK})
+        finally:
+            verify.file_sha256 = file_sha256
+
+        # a stamp is invalidated when the file is modified
+        with open(image + "/store.squashfs", "wb") as fid:
+            fid.write(b"modified")
+        self.assertEqual(verify.verify_images([(image, sha)], verify.Stamps(self.repo)), {sha: verify.MISMATCH})
+
+        # stamps remain valid when the image is moved
+        shutil.rmtree(image)
+        sha = make_image(self.repo + "/staging/a", {"store.squashfs": b"squashfs"})
+        stamps = verify.Stamps(self.repo)
+        self.assertEqual(verify.verify_image(self.repo + "/staging/a", sha, stamps), verify.OK)
+        os.rename(self.repo + "/staging/a", image)
+        self.assertTrue(stamps.is_verified(f"{sha}/store.squashfs", image + "/store.squashfs",
+                                           hashlib.sha256(b"squashfs").hexdigest()))
+
+if __name__ == '__main__':
+    unittest.main()